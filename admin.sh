@@ -68,6 +68,12 @@ function migration() {
     else
         echo -e "Migration:                 [\033[31m fail \033[0m]"
     fi
+    python3 manage.py rollup_slow_query && python3 manage.py refresh_dashboard_stats
+    if [ $? == "0" ]; then
+        echo -e "Rollup:                    [\033[32m ok \033[0m]"
+    else
+        echo -e "Rollup:                    [\033[31m fail \033[0m]"
+    fi
 }
 
 case "$1" in
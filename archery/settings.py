@@ -67,6 +67,46 @@ env = environ.Env(
         ],
     ),
     CURRENT_AUDITOR=(str, "sql.utils.workflow_audit:AuditV2"),
+    # 目标库连接池，按进程维护
+    CONN_POOL_ENABLED=(bool, False),
+    CONN_POOL_MAX_SIZE=(int, 10),
+    CONN_POOL_MAX_IDLE_TIME=(int, 300),
+    CONN_POOL_CHECK_INTERVAL=(int, 30),
+    # SSH隧道
+    SSH_TUNNEL_KEEPALIVE=(float, 30),
+    SSH_TUNNEL_IDLE_TIMEOUT=(int, 300),
+    # 查询语句语法树预解析线程数，0表示不预解析
+    QUERY_PREFETCH_WORKERS=(int, 4),
+    # 流式查询每批读取的行数
+    QUERY_STREAM_CHUNK_SIZE=(int, 1000),
+    # 异步查询
+    ASYNC_QUERY_WORKERS=(int, 4),
+    ASYNC_QUERY_MAX_PENDING=(int, 16),
+    ASYNC_QUERY_RESULT_TTL=(int, 600),
+    # 查询历史总数统计上限
+    QUERY_LOG_COUNT_LIMIT=(int, 10000),
+    # 消息通知
+    NOTIFY_RETRIES=(int, 3),
+    NOTIFY_FLUSH_TIMEOUT=(float, 30),
+    # SQL工单分批执行
+    EXECUTE_CHUNK_SIZE=(int, 0),
+    # 回滚语句每批读写备份库的行数
+    ROLLBACK_BATCH_SIZE=(int, 500),
+    # 执行结束工单的回滚语句缓存时间(秒)，翻页、搜索不再重复查询备份库，0表示不缓存
+    ROLLBACK_CACHE_TTL=(int, 3600),
+    # Mongo集合字段采样结果缓存时间(秒)
+    MONGO_SCHEMA_CACHE_TTL=(int, 300),
+    # Mongo查询每批从服务端读取的文档数
+    MONGO_QUERY_BATCH_SIZE=(int, 1000),
+    # 整个实例导出数据字典时的并发库数
+    DATA_DICTIONARY_EXPORT_WORKERS=(int, 4),
+    # 实例账号、数据库列表缓存时间(秒)
+    INSTANCE_SUMMARY_CACHE_TTL=(int, 300),
+    # 实例元数据缓存保留时间、后台刷新间隔(秒)
+    METADATA_CATALOG_TTL=(int, 86400),
+    METADATA_CATALOG_REFRESH=(int, 300),
+    # SQL优化诊断的实例版本、系统参数缓存时间(秒)
+    SQL_TUNING_CACHE_TTL=(int, 300),
 )
 
 # SECURITY WARNING: keep the secret key used in production secret!
@@ -106,6 +146,76 @@ ENABLED_ENGINES = env("ENABLED_ENGINES")
 
 CURRENT_AUDITOR = env("CURRENT_AUDITOR")
 
+# 目标库连接池，MAX_SIZE为单个实例/库最多保留的空闲连接数，MAX_IDLE_TIME为空闲连接最长保留时间(秒)，
+# CHECK_INTERVAL为空闲超过该时间(秒)的连接复用前先做健康检查
+CONN_POOL = {
+    "ENABLED": env("CONN_POOL_ENABLED"),
+    "MAX_SIZE": env("CONN_POOL_MAX_SIZE"),
+    "MAX_IDLE_TIME": env("CONN_POOL_MAX_IDLE_TIME"),
+    "CHECK_INTERVAL": env("CONN_POOL_CHECK_INTERVAL"),
+}
+
+# SSH隧道在进程内按 隧道配置、远端地址、端口 共享，KEEPALIVE为SSH保活间隔(秒)，
+# IDLE_TIMEOUT为没有引擎使用的隧道保留时间(秒)，超时后关闭
+SSH_TUNNEL = {
+    "KEEPALIVE": env("SSH_TUNNEL_KEEPALIVE"),
+    "IDLE_TIMEOUT": env("SSH_TUNNEL_IDLE_TIMEOUT"),
+}
+
+# 在线查询时goInception脱敏、权限解析与查询并行执行的线程数，设置为0时在查询结束后串行解析
+QUERY_PREFETCH_WORKERS = env("QUERY_PREFETCH_WORKERS")
+
+# 流式查询(stream=true)每批从服务端游标读取并输出的行数，决定了单次查询的内存占用
+QUERY_STREAM_CHUNK_SIZE = env("QUERY_STREAM_CHUNK_SIZE")
+
+# 异步查询(async=true)，WORKERS为每个进程执行查询的线程数，MAX_PENDING为排队的查询数上限，
+# RESULT_TTL为结果在缓存中保留的时间(秒)，每批QUERY_STREAM_CHUNK_SIZE行作为一页
+ASYNC_QUERY = {
+    "WORKERS": env("ASYNC_QUERY_WORKERS"),
+    "MAX_PENDING": env("ASYNC_QUERY_MAX_PENDING"),
+    "RESULT_TTL": env("ASYNC_QUERY_RESULT_TTL"),
+}
+
+# 查询历史列表的总数最多统计到该值，避免每次翻页都扫描全部匹配记录，设置为0时精确统计
+QUERY_LOG_COUNT_LIMIT = env("QUERY_LOG_COUNT_LIMIT")
+
+# 消息通知，RETRIES为推送失败(连接建立失败、限流)的重试次数，
+# FLUSH_TIMEOUT为django-q任务返回前等待通知发送完成的最长时间(秒)
+NOTIFY = {
+    "RETRIES": env("NOTIFY_RETRIES"),
+    "FLUSH_TIMEOUT": env("NOTIFY_FLUSH_TIMEOUT"),
+}
+
+# PgSQL、Oracle工单每批在一个事务中执行的语句数，每批提交后记录执行进度，中断后可以继续执行，0表示逐条执行并提交
+EXECUTE_CHUNK_SIZE = env("EXECUTE_CHUNK_SIZE")
+
+# Oracle工单备份时每批从LogMiner读取并写入备份库的回滚语句行数，goInception工单获取回滚语句时每批查询的语句数
+ROLLBACK_BATCH_SIZE = env("ROLLBACK_BATCH_SIZE")
+
+# 执行结束的工单回滚语句不再变化，获取后在缓存中保留的时间(秒)，0表示每次都从备份库查询
+ROLLBACK_CACHE_TTL = env("ROLLBACK_CACHE_TTL")
+
+# Mongo查询结果的默认列取自集合首尾文档的字段，采样结果在进程内缓存的时间(秒)，0表示每次查询都采样
+MONGO_SCHEMA_CACHE_TTL = env("MONGO_SCHEMA_CACHE_TTL")
+
+# Mongo查询游标每批从服务端读取的文档数，返回行数限制更小时按行数限制读取
+MONGO_QUERY_BATCH_SIZE = env("MONGO_QUERY_BATCH_SIZE")
+
+# 管理员导出整个实例的数据字典时同时导出的库数，每个库占用一个实例连接
+DATA_DICTIONARY_EXPORT_WORKERS = env("DATA_DICTIONARY_EXPORT_WORKERS")
+
+# 实例账号管理、数据库管理的列表缓存时间(秒)，平台内变更账号、权限、数据库时清除，页面可以手动从实例刷新，0表示不缓存
+INSTANCE_SUMMARY_CACHE_TTL = env("INSTANCE_SUMMARY_CACHE_TTL")
+
+# 实例库表、字段、表结构等元数据缓存的保留时间(秒)，DDL工单执行结束或创建数据库后对应的库立即失效
+METADATA_CATALOG_TTL = env("METADATA_CATALOG_TTL")
+
+# 元数据缓存超过该时间(秒)后读取时仍返回缓存，同时在后台从实例刷新
+METADATA_CATALOG_REFRESH = env("METADATA_CATALOG_REFRESH")
+
+# SQLTuning诊断时实例版本号、系统参数、优化器开关在进程内缓存的时间(秒)，0表示每次都从实例获取
+SQL_TUNING_CACHE_TTL = env("SQL_TUNING_CACHE_TTL")
+
 # Application definition
 INSTALLED_APPS = (
     "django.contrib.admin",
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+"""
+数据脱敏耗时对比：逐行逐列重建+每次编译正则的旧实现 与 按列一次遍历的mask_rows
+结果集共30列，其中4个脱敏列，分别测试1k/10k/100k行，每组取3次最优耗时
+
+用法：python benchmarks/data_masking.py [rows ...]
+"""
+import gc
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+from sql.utils.data_masking import mask_rows
+
+MASKING_RULES = {
+    1: {"rule_regex": "(.{3})(.*)(.{4})", "hide_group": 2},
+    2: {"rule_regex": "(.*)(.{4})$", "hide_group": 2},
+    3: {"rule_regex": "(.{1})(.*)", "hide_group": 2},
+    4: {"rule_regex": "(.*)(@.*)", "hide_group": 1},
+}
+HIT_COLUMNS = [
+    {"index": 1, "rule_type": 1},
+    {"index": 2, "rule_type": 2},
+    {"index": 3, "rule_type": 3},
+    {"index": 4, "rule_type": 4},
+]
+
+
+def legacy_regex(masking_rule, value):
+    rule_regex = masking_rule["rule_regex"]
+    hide_group = masking_rule["hide_group"]
+    try:
+        p = re.compile(rule_regex, re.I)
+        m = p.search(str(value))
+        masking_str = ""
+        for i in range(m.lastindex):
+            if i == hide_group - 1:
+                group = "****"
+            else:
+                group = m.group(i + 1)
+            masking_str = masking_str + group
+        return masking_str
+    except AttributeError:
+        return value
+
+
+def legacy_mask_rows(rows, hit_columns, masking_rules):
+    rows = list(rows)
+    for column in hit_columns:
+        index, rule_type = column["index"], column["rule_type"]
+        masking_rule = masking_rules.get(rule_type)
+        if not masking_rule:
+            continue
+        for idx, item in enumerate(rows):
+            rows[idx] = list(item)
+            rows[idx][index] = legacy_regex(masking_rule, rows[idx][index])
+    return rows
+
+
+def make_rows(n):
+    return tuple(
+        (
+            i,
+            f"188{i:08d}",
+            f"4403011990{i:08d}",
+            f"name{i}",
+            f"user{i}@example.com",
+        )
+        + tuple(f"value_{i}_{j}" for j in range(25))
+        for i in range(n)
+    )
+
+
+def timeit(func, rows, repeat=3):
+    # 不保留上一次的结果，避免存活对象过多影响另一方的GC耗时
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(rows, HIT_COLUMNS, MASKING_RULES)
+        cost = (time.perf_counter() - start) * 1000
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'rows':>8} {'legacy(ms)':>12} {'mask_rows(ms)':>14} {'speedup':>8}")
+    for n in sizes:
+        rows = make_rows(n)
+        assert legacy_mask_rows(rows, HIT_COLUMNS, MASKING_RULES) == mask_rows(
+            rows, HIT_COLUMNS, MASKING_RULES
+        )
+        legacy_cost = timeit(legacy_mask_rows, rows)
+        new_cost = timeit(mask_rows, rows)
+        print(
+            f"{n:>8} {legacy_cost:>12.1f} {new_cost:>14.1f} {legacy_cost / new_cost:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
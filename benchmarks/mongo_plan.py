@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+"""
+Mongo查询语句解析耗时对比：每次解析语句、拼接命令字符串后eval执行的旧实现 与 按语句缓存执行计划、直接调用pymongo接口的新实现
+使用记录调用的假集合对象代替pymongo集合，只统计语句解析和构造查询的CPU耗时，不需要连接数据库
+
+用法：python benchmarks/mongo_plan.py [times]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+from sql.engines.mongo import JsonDecoder, MongoEngine, compile_query
+
+STATEMENTS = [
+    'db.orders.find({"status": 1, "amount": {"$gt": 100}}, {"order_no": 1, "amount": 1}).sort({"created_at": -1}).limit(50)',
+    'db.orders.find({"user_id": NumberLong("1024"), "_id": {"$gt": ObjectId("5f10162029684728e70045ab")}}).skip(20)',
+    'db.getCollection("orders").find({"status": {"$in": [1, 2, 3]}}).count()',
+    'db.orders.aggregate([{"$match": {"status": 1}}, {"$group": {"_id": "$user_id", "total": {"$sum": "$amount"}}}, {"$sort": {"total": -1}}])',
+]
+
+
+class FakeCollection:
+    """任意方法调用都返回自身，支持链式调用"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+
+def legacy_query(engine, sql, collection, limit_num):
+    """旧实现：解析语句并拼接成python表达式，eval执行"""
+    find_cmd = ""
+    query_dict = engine.parse_query_sentence(sql)
+    de = JsonDecoder()
+    if "method" in query_dict and query_dict["method"]:
+        method = query_dict["method"]
+        find_cmd = "collection." + method
+        if method == "index_information":
+            find_cmd += "()"
+    if "condition" in query_dict:
+        if method == "aggregate":
+            condition = query_dict["condition"]
+            condition.append({"$limit": limit_num})
+        if method == "find":
+            condition = de.decode(query_dict["condition"])
+        find_cmd += "(condition)"
+    if "projection" in query_dict and query_dict["projection"]:
+        projection = de.decode(query_dict["projection"])
+        find_cmd = find_cmd[:-1] + ",projection)"
+    if "sort" in query_dict and query_dict["sort"]:
+        sorting = []
+        for k, v in de.decode(query_dict["sort"]).items():
+            sorting.append((k, v))
+        find_cmd += ".sort(sorting)"
+    if method == "find" and "limit" not in query_dict and "explain" not in query_dict:
+        find_cmd += ".limit(limit_num)"
+    if "limit" in query_dict and query_dict["limit"]:
+        query_limit = int(query_dict["limit"])
+        limit = min(limit_num, query_limit) if query_limit else limit_num
+        find_cmd += f".limit({limit})"
+    if "skip" in query_dict and query_dict["skip"]:
+        query_skip = int(query_dict["skip"])
+        find_cmd += f".skip({query_skip})"
+    if "count" in query_dict:
+        find_cmd += ".count()"
+    if "explain" in query_dict:
+        find_cmd += ".explain()"
+    # find_cmd中引用了condition、projection、sorting等局部变量，显式传入局部命名空间
+    return eval(find_cmd, globals(), locals())
+
+
+def planned_query(engine, sql, collection, limit_num):
+    """新实现：按语句文本缓存执行计划，直接调用pymongo接口"""
+    return compile_query(sql).execute(collection, limit_num)
+
+
+def run(func, times):
+    engine = MongoEngine()
+    collection = FakeCollection()
+    start = time.perf_counter()
+    for _ in range(times):
+        for sql in STATEMENTS:
+            func(engine, sql, collection, 1000)
+    return time.perf_counter() - start
+
+
+def main():
+    times = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    total = times * len(STATEMENTS)
+    legacy_cost = run(legacy_query, times)
+    planned_cost = run(planned_query, times)
+    print(
+        f"{total}次查询：{legacy_cost * 1000:.1f}ms -> {planned_cost * 1000:.1f}ms，"
+        f"单次 {legacy_cost / total * 1e6:.1f}us -> {planned_cost / total * 1e6:.1f}us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+Mongo查询结果转换耗时对比：整体dump/load为扩展JSON+逐单元格正则替换的旧实现 与 逐条文档按类型转换的parse_tuple
+模拟包含ObjectId、时间、数组、嵌套文档的订单集合，默认5万条文档，每组取3次最优耗时
+字段采样使用固定列，不需要连接数据库
+
+用法：python benchmarks/mongo_query.py [docs ...]
+"""
+import datetime
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+import simplejson as json
+from bson import json_util
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+
+from sql.engines.mongo import MongoEngine
+
+COLUMNS = ["_id", "order_no", "user_id", "amount", "status", "created_at"]
+
+
+def documents(count):
+    now = datetime.datetime(2023, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "order_no": f"NO{i:010d}",
+            "user_id": Int64(i % 1000),
+            "amount": i * 0.01,
+            "status": i % 5,
+            "created_at": now + datetime.timedelta(seconds=i),
+            "items": [{"sku": f"SKU{i % 97}", "qty": 1}],
+            "address": {"city": "杭州", "updated_at": now, "ref": ObjectId()},
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_parse(docs):
+    """旧实现：整体转换为扩展JSON后再解析，逐单元格编译正则并替换$oid、$date"""
+    cursor = json.loads(json_util.dumps(docs))
+    columns = ["mongodballdata"] + COLUMNS
+    for ro in cursor:
+        for key in ro.keys():
+            if key not in columns:
+                columns.append(key)
+    rows = []
+    row = []
+    for ro in cursor:
+        row.insert(
+            0, json.dumps(ro, ensure_ascii=False, indent=2, separators=(",", ":"))
+        )
+        for key in columns[1:]:
+            if key in ro:
+                value = ro[key]
+                if isinstance(value, list):
+                    value = "(array) %d Elements" % len(value)
+                re_oid = re.compile(r"{\'\$oid\': \'[0-9a-f]{24}\'}")
+                re_date = re.compile(r"{\'\$date\': [0-9]{13}}")
+                for ii in re.findall(re_oid, str(value)):
+                    value = str(value).replace(
+                        ii, "ObjectId(" + ii.split(":")[1].strip()[:-1] + ")"
+                    )
+                for d in re.findall(re_date, str(value)):
+                    t = int(d.split(":")[1].strip()[:-1])
+                    e = datetime.datetime.fromtimestamp(t / 1000)
+                    value = str(value).replace(
+                        d, e.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                    )
+                row.append(str(value))
+            else:
+                row.append("(N/A)")
+        rows.append(tuple(row))
+        row.clear()
+    return tuple(rows), columns
+
+
+def best_of(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def main():
+    sizes = [int(i) for i in sys.argv[1:]] or [50000]
+    engine = MongoEngine()
+    engine.sampled_columns = lambda db_name, tb_name: list(COLUMNS)
+    for size in sizes:
+        docs = documents(size)
+        old_cost, old_result = best_of(legacy_parse, docs)
+        new_cost, new_result = best_of(
+            lambda: engine.parse_tuple(iter(docs), "some_db", "orders")
+        )
+        assert old_result == new_result
+        print(
+            f"{size}条文档：{old_cost * 1000:.1f}ms -> {new_cost * 1000:.1f}ms，"
+            f"提升{old_cost / new_cost:.1f}倍"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+SQL查询接口的数据库往返次数对比，模拟网络延迟，不依赖真实的目标实例
+旧流程：query_check的explain单独建连，再建连获取主从延迟、设置max_execution_time、执行查询
+新流程：explain、会话准备(批量设置+主从延迟)、执行查询复用同一个会话
+
+用法：python benchmarks/query_round_trips.py [rtt_ms] [loops]
+"""
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+import MySQLdb
+
+from sql.engines.mysql import MysqlEngine
+from sql.models import Instance
+
+# 建立连接的握手+认证按3个往返计算
+CONNECT_ROUND_TRIPS = 3
+
+
+class Counter:
+    rtt = 0.001
+    connects = 0
+    round_trips = 0
+
+    @classmethod
+    def reset(cls):
+        cls.connects = 0
+        cls.round_trips = 0
+
+    @classmethod
+    def trip(cls, n=1):
+        cls.round_trips += n
+        time.sleep(cls.rtt * n)
+
+
+class FakeCursor:
+    def __init__(self):
+        self.description = (("c", 3),)
+        self._rows = ()
+
+    def execute(self, sql, parameters=None):
+        Counter.trip()
+        if "show slave status" in sql:
+            self._rows = ({"Seconds_Behind_Master": 0},)
+        else:
+            self._rows = ((1,),)
+        return len(self._rows)
+
+    def nextset(self):
+        return None
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchmany(self, size=None):
+        return self._rows[:size]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, *args, **kwargs):
+        Counter.connects += 1
+        Counter.trip(CONNECT_ROUND_TRIPS)
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor()
+
+    def thread_id(self):
+        return 1
+
+    def autocommit(self, on):
+        pass
+
+    def get_autocommit(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def legacy_flow(instance, sql):
+    engine = MysqlEngine(instance=instance)
+    engine.query(db_name="db", sql=f"explain {sql}")
+    engine.get_connection(db_name="db")
+    seconds_behind_master = engine.seconds_behind_master
+    engine.query("db", sql, 100, max_execution_time=60000)
+    return seconds_behind_master
+
+
+def pipeline_flow(instance, sql):
+    engine = MysqlEngine(instance=instance)
+    engine.query_check(db_name="db", sql=sql)
+    engine.get_connection(db_name="db")
+    seconds_behind_master = engine.prepare_query_session(
+        db_name="db", max_execution_time=60000
+    )
+    engine.query("db", sql, 100, max_execution_time=60000)
+    return seconds_behind_master
+
+
+def run(name, func, instance, loops):
+    Counter.reset()
+    start = time.perf_counter()
+    for _ in range(loops):
+        func(instance, "select c from t where id=1")
+    cost = (time.perf_counter() - start) / loops * 1000
+    print(
+        f"{name:<10} connects/query={Counter.connects / loops:.1f} "
+        f"round_trips/query={Counter.round_trips / loops:.1f} "
+        f"latency={cost:.2f}ms"
+    )
+
+
+def main():
+    Counter.rtt = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.001
+    loops = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    instance = Instance(
+        instance_name="bench", db_type="mysql", host="127.0.0.1", port=3306
+    )
+    with patch.object(MySQLdb, "connect", FakeConnection):
+        run("legacy", legacy_flow, instance, loops)
+        run("pipeline", pipeline_flow, instance, loops)
+
+
+if __name__ == "__main__":
+    main()
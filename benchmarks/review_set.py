@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+审核结果处理耗时对比：逐行判断语句类型+字典列表序列化的旧实现 与 批量判断语句类型+列式序列化的新实现
+模拟goInception对纯DML数据订正工单返回的审核结果，分别统计1千/1万/10万条语句的
+语句类型判断、ReviewSet.json()、解析review_content的耗时和保存的JSON大小，每组取3次最优耗时
+不需要连接数据库
+
+用法：python benchmarks/review_set.py [rows ...]
+"""
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+from sql.engines.models import ReviewResult, ReviewSet
+from sql.utils.sql_utils import get_syntax_types, remove_comments
+
+
+def inception_rows(rows):
+    return [
+        (
+            i + 1,
+            "CHECKED",
+            0,
+            "Audit completed",
+            None,
+            f"update t_order set status = 2, remark = '订正' where id = {i}",
+            1,
+            f"'0_0_{i}'",
+            "None",
+            "0",
+            "",
+            "",
+        )
+        for i in range(rows)
+    ]
+
+
+def old_check(rows):
+    """旧实现：每行去除注释后使用正则判断，直到找到DDL"""
+    syntax_type = 2
+    for r in rows:
+        if syntax_type == 2:
+            sql = remove_comments(sql=r[5], db_type="mysql")
+            if re.match(r"^alter|^create|^drop|^rename|^truncate", sql, re.I):
+                syntax_type = 1
+    return syntax_type
+
+
+def new_check(rows):
+    return 1 if "DDL" in get_syntax_types([r[5] for r in rows]) else 2
+
+
+def old_json(review_set):
+    return json.dumps([r.__dict__ for r in review_set.rows])
+
+
+def best_of(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def main():
+    sizes = [int(i) for i in sys.argv[1:]] or [1000, 10000, 100000]
+    for size in sizes:
+        rows = inception_rows(size)
+        review_set = ReviewSet(rows=[ReviewResult(inception_result=r) for r in rows])
+        old_type_cost, old_type = best_of(old_check, rows)
+        new_type_cost, new_type = best_of(new_check, rows)
+        assert old_type == new_type
+        old_json_cost, old_content = best_of(old_json, review_set)
+        new_json_cost, new_content = best_of(review_set.json)
+        old_load_cost, old_rows = best_of(json.loads, old_content)
+        new_load_cost, new_rows = best_of(ReviewSet.load_rows, new_content)
+        assert old_rows == new_rows
+        print(
+            f"{size}条语句：语句类型 {old_type_cost * 1000:.1f}ms -> {new_type_cost * 1000:.1f}ms，"
+            f"序列化 {old_json_cost * 1000:.1f}ms -> {new_json_cost * 1000:.1f}ms，"
+            f"解析 {old_load_cost * 1000:.1f}ms -> {new_load_cost * 1000:.1f}ms，"
+            f"大小 {len(old_content.encode()) / 1024:.0f}KB -> {len(new_content.encode()) / 1024:.0f}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志统计耗时对比：明细表join+分组+count的旧查询 与 从天汇总表分组的新查询
+在Archery库中生成指定行数的慢日志明细(默认1000万行，20台主机、5000个checksum、最近180天)，
+回填汇总后分别执行统计页面的查询和一次增量汇总，每组取3次最优耗时
+会清空慢日志明细和汇总表，只能在测试库中执行
+
+用法：python benchmarks/slowquery_rollup.py [rows]
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archery.settings")
+
+import django
+
+django.setup()
+
+from django.db import connection
+from django.db.models import F, Max, Sum
+
+from sql.models import (
+    SlowQuery,
+    SlowQueryHistory,
+    SlowQueryRollupDaily,
+    SlowQueryRollupHourly,
+    SlowQueryRollupState,
+)
+from sql.utils.slow_query_rollup import rebuild_slow_query_rollup, rollup_slow_query
+
+HOSTS = [f"10.0.0.{i}:3306" for i in range(20)]
+CHECKSUMS = [f"{i:032x}" for i in range(5000)]
+DAYS = 180
+INSERT_BATCH = 10000
+
+
+def generate(rows):
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE TABLE mysql_slow_query_review_history")
+        cursor.execute("TRUNCATE TABLE mysql_slow_query_review")
+    SlowQueryRollupHourly.objects.all().delete()
+    SlowQueryRollupDaily.objects.all().delete()
+    SlowQueryRollupState.objects.all().delete()
+    SlowQuery.objects.bulk_create(
+        [
+            SlowQuery(
+                checksum=c,
+                fingerprint=f"select * from tb_{i % 300} where id = ?",
+                sample=f"select * from tb_{i % 300} where id = 1",
+            )
+            for i, c in enumerate(CHECKSUMS)
+        ],
+        batch_size=INSERT_BATCH,
+    )
+    sql = """insert into mysql_slow_query_review_history
+(hostname_max, user_max, db_max, checksum, sample, ts_min, ts_max, ts_cnt,
+Query_time_sum, Query_time_pct_95, Lock_time_sum, Rows_sent_sum, Rows_examined_sum)
+values (%s, 'bench', %s, %s, 'select 1', %s, %s, %s, %s, %s, %s, %s, %s)"""
+    start = datetime.datetime.now() - datetime.timedelta(days=DAYS)
+    rnd = random.Random(0)
+    # 明细按时间顺序写入，ts_min递增，与pt-query-digest定期分析一致
+    step = DAYS * 86400 / rows
+    with connection.cursor() as cursor:
+        for offset in range(0, rows, INSERT_BATCH):
+            values = []
+            for i in range(offset, min(offset + INSERT_BATCH, rows)):
+                ts_min = start + datetime.timedelta(seconds=i * step)
+                cnt = rnd.randint(1, 20)
+                qt = cnt * rnd.random()
+                values.append(
+                    (
+                        rnd.choice(HOSTS),
+                        f"db_{rnd.randint(0, 9)}",
+                        rnd.choice(CHECKSUMS),
+                        ts_min,
+                        ts_min + datetime.timedelta(minutes=5),
+                        cnt,
+                        qt,
+                        qt / cnt,
+                        qt / 100,
+                        cnt * 10,
+                        cnt * 1000,
+                    )
+                )
+            cursor.executemany(sql, values)
+
+
+def old_review(hostname, start_time, end_time):
+    qs = (
+        SlowQuery.objects.filter(
+            slowqueryhistory__hostname_max=hostname,
+            slowqueryhistory__ts_min__range=(start_time, end_time),
+            fingerprint__icontains="",
+        )
+        .annotate(SQLText=F("fingerprint"), SQLId=F("checksum"))
+        .values("SQLText", "SQLId")
+        .annotate(
+            CreateTime=Max("slowqueryhistory__ts_max"),
+            DBName=Max("slowqueryhistory__db_max"),
+            QueryTimeAvg=Sum("slowqueryhistory__query_time_sum")
+            / Sum("slowqueryhistory__ts_cnt"),
+            MySQLTotalExecutionCounts=Sum("slowqueryhistory__ts_cnt"),
+            MySQLTotalExecutionTimes=Sum("slowqueryhistory__query_time_sum"),
+            ParseTotalRowCounts=Sum("slowqueryhistory__rows_examined_sum"),
+            ReturnTotalRowCounts=Sum("slowqueryhistory__rows_sent_sum"),
+            ParseRowAvg=Sum("slowqueryhistory__rows_examined_sum")
+            / Sum("slowqueryhistory__ts_cnt"),
+            ReturnRowAvg=Sum("slowqueryhistory__rows_sent_sum")
+            / Sum("slowqueryhistory__ts_cnt"),
+        )
+    )
+    return qs.count(), list(qs.order_by("-MySQLTotalExecutionCounts")[:14])
+
+
+def new_review(hostname, start_time, end_time):
+    qs = (
+        SlowQueryRollupDaily.objects.filter(
+            hostname=hostname, bucket__gte=start_time, bucket__lt=end_time
+        )
+        .annotate(SQLText=F("checksum__fingerprint"), SQLId=F("checksum"))
+        .values("SQLText", "SQLId")
+        .annotate(
+            CreateTime=Max("ts_max"),
+            DBName=Max("db_name"),
+            QueryTimeAvg=Sum("query_time_sum") / Sum("ts_cnt"),
+            MySQLTotalExecutionCounts=Sum("ts_cnt"),
+            MySQLTotalExecutionTimes=Sum("query_time_sum"),
+            ParseTotalRowCounts=Sum("rows_examined_sum"),
+            ReturnTotalRowCounts=Sum("rows_sent_sum"),
+            ParseRowAvg=Sum("rows_examined_sum") / Sum("ts_cnt"),
+            ReturnRowAvg=Sum("rows_sent_sum") / Sum("ts_cnt"),
+        )
+    )
+    return qs.count(), list(qs.order_by("-MySQLTotalExecutionCounts")[:14])
+
+
+def best_of(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    start = time.perf_counter()
+    generate(rows)
+    print(f"生成明细 {rows} 行：{time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    rebuild_slow_query_rollup(safety_lag=0)
+    print(
+        f"回填汇总：{time.perf_counter() - start:.1f}s，"
+        f"小时表 {SlowQueryRollupHourly.objects.count()} 行，"
+        f"天表 {SlowQueryRollupDaily.objects.count()} 行"
+    )
+
+    today = datetime.date.today()
+    end_time = today + datetime.timedelta(days=1)
+    for days in (1, 30, DAYS):
+        start_time = today - datetime.timedelta(days=days - 1)
+        old_cost, old_result = best_of(old_review, HOSTS[0], start_time, end_time)
+        new_cost, new_result = best_of(new_review, HOSTS[0], start_time, end_time)
+        assert old_result[0] == new_result[0]
+        print(
+            f"最近{days}天：旧查询 {old_cost * 1000:.1f}ms，"
+            f"新查询 {new_cost * 1000:.1f}ms，提升 {old_cost / new_cost:.1f}x"
+        )
+
+    # 模拟pt-query-digest一次分析写入的增量明细
+    max_id = SlowQueryHistory.objects.aggregate(max_id=Max("id"))["max_id"]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """insert into mysql_slow_query_review_history
+(hostname_max, user_max, db_max, checksum, sample, ts_min, ts_max, ts_cnt)
+select hostname_max, user_max, db_max, checksum, sample,
+date_add(ts_min, interval 1 day), date_add(ts_max, interval 1 day), ts_cnt
+from mysql_slow_query_review_history where id > %s""",
+            (max_id - 2000,),
+        )
+    start = time.perf_counter()
+    rollup_slow_query(safety_lag=0)
+    print(f"增量汇总2000行明细：{(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,108 @@
 # -*- coding: UTF-8 -*-
 import logging
+import threading
+import time
 import traceback
 
 import simplejson as json
+from django.core.cache import cache
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
 from django.http import HttpResponse
+from mirage.crypto import Crypto
 
 from common.utils.permission import superuser_required
 from sql.models import Config
-from django.db import transaction
+from django.db import connection, transaction
 
 logger = logging.getLogger("default")
 
+# 系统配置快照，进程内缓存全部配置，共享缓存中保存版本号和加密后的配置，
+# set/replace/purge后递增版本号，各进程在版本号变化后才重新加载
+CONFIG_VERSION_KEY = "sys_config_version"
+CONFIG_SNAPSHOT_KEY = "sys_config_snapshot"
+_snapshot = (None, {})
+_snapshot_lock = threading.Lock()
+_snapshot_stats = {"hits": 0, "cache_loads": 0, "db_loads": 0, "bypasses": 0}
+
+
+def _load_config():
+    """从数据库加载全部配置，字段在这里统一解密"""
+    return dict(Config.objects.values_list("item", "value"))
+
+
+def config_snapshot():
+    """
+    获取系统配置快照，{item: value}，值已经过filter_bool转换
+    版本号未变化时直接使用进程内缓存，否则优先从共享缓存获取，都没有再查询数据库
+    事务中可能读取到未提交或将被回滚的配置，此时不使用缓存，返回None
+    """
+    global _snapshot
+    if connection.in_atomic_block:
+        _snapshot_stats["bypasses"] += 1
+        return None
+    try:
+        version = cache.get_or_set(CONFIG_VERSION_KEY, time.time_ns, timeout=None)
+        if _snapshot[0] == version:
+            _snapshot_stats["hits"] += 1
+            return _snapshot[1]
+        cached = cache.get(CONFIG_SNAPSHOT_KEY)
+    except Exception as e:
+        logger.warning(f"获取系统配置缓存失败，直接查询数据库，错误信息：{e}")
+        _snapshot_stats["bypasses"] += 1
+        return None
+    with _snapshot_lock:
+        if _snapshot[0] == version:
+            return _snapshot[1]
+        crypto = Crypto()
+        if cached and cached[0] == version:
+            raw_config = {k: crypto.decrypt(v) for k, v in cached[1].items()}
+            _snapshot_stats["cache_loads"] += 1
+        else:
+            raw_config = _load_config()
+            _snapshot_stats["db_loads"] += 1
+            try:
+                cache.set(
+                    CONFIG_SNAPSHOT_KEY,
+                    (version, {k: crypto.encrypt(v) for k, v in raw_config.items()}),
+                    timeout=None,
+                )
+            except Exception as e:
+                logger.warning(f"保存系统配置缓存失败，错误信息：{e}")
+        config = {
+            k: SysConfig.filter_bool(v) if isinstance(v, str) else v
+            for k, v in raw_config.items()
+        }
+        _snapshot = (version, config)
+    return config
+
+
+def config_stats():
+    """配置快照的命中统计"""
+    return {"version": _snapshot[0], "items": len(_snapshot[1]), **_snapshot_stats}
+
+
+def invalidate_config():
+    """配置变更提交后递增版本号，所有进程中的配置快照失效"""
+
+    def bump():
+        try:
+            try:
+                cache.incr(CONFIG_VERSION_KEY)
+            except ValueError:
+                cache.set(CONFIG_VERSION_KEY, time.time_ns(), timeout=None)
+        except Exception as e:
+            logger.warning(f"系统配置缓存失效失败，错误信息：{e}")
+
+    transaction.on_commit(bump)
+
+
+@receiver(post_migrate)
+def invalidate_config_on_migrate(sender, **kwargs):
+    """迁移或清空数据表后配置可能已变化"""
+    if sender.label == "sql":
+        invalidate_config()
+
 
 class SysConfig(object):
     def __init__(self):
@@ -36,11 +128,15 @@ class SysConfig(object):
         value = self.sys_config.get(key)
         if value:
             return value
-        # 尝试去数据库里取
-        config_entry = Config.objects.filter(item=key).last()
-        if config_entry:
-            # 清洗成 python 的 bool
-            value = self.filter_bool(config_entry.value)
+        # 优先从配置快照中获取，快照不可用时尝试去数据库里取
+        snapshot = config_snapshot()
+        if snapshot is not None:
+            value = snapshot.get(key)
+        else:
+            config_entry = Config.objects.filter(item=key).last()
+            if config_entry:
+                # 清洗成 python 的 bool
+                value = self.filter_bool(config_entry.value)
         # 是字符串的话, 如果是空, 或者全是空格, 返回默认值
         if isinstance(value, str) and value.strip() == "":
             return default_value
@@ -67,6 +163,7 @@ class SysConfig(object):
         obj, created = Config.objects.update_or_create(
             item=key, defaults={"value": db_value}
         )
+        invalidate_config()
         if created:
             self.sys_config.update({key: value})
 
@@ -84,6 +181,7 @@ class SysConfig(object):
                         for items in json.loads(configs)
                     ]
                 )
+                invalidate_config()
         except Exception as e:
             logger.error(traceback.format_exc())
             result["status"] = 1
@@ -97,6 +195,7 @@ class SysConfig(object):
         try:
             with transaction.atomic():
                 Config.objects.all().delete()
+                invalidate_config()
                 self.sys_config = {}
         except Exception as m:
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
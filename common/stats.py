@@ -0,0 +1,28 @@
+# -*- coding: UTF-8 -*-
+"""进程内运行状态统计，如连接池命中情况等"""
+
+import simplejson as json
+from django.http import HttpResponse
+
+from common.config import config_stats
+from common.utils.permission import superuser_required
+from sql.utils.connection_pool import pool_stats
+from sql.utils.notify_dispatcher import notify_dispatcher
+from sql.utils.query_tree_cache import query_tree_cache
+from sql.utils.query_watchdog import query_watchdog
+from sql.utils.ssh_tunnel import ssh_tunnel_manager
+
+
+@superuser_required
+def runtime_stats(request):
+    """获取当前进程的运行统计信息"""
+    data = {
+        "conn_pool": pool_stats(),
+        "query_tree_cache": query_tree_cache.stats(),
+        "sys_config": config_stats(),
+        "query_watchdog": query_watchdog.stats(),
+        "notify": notify_dispatcher.stats(),
+        "ssh_tunnel": ssh_tunnel_manager.stats(),
+    }
+    result = {"status": 0, "msg": "ok", "data": data}
+    return HttpResponse(json.dumps(result), content_type="application/json")
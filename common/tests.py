@@ -1,12 +1,15 @@
 import json
 import smtplib
-from unittest.mock import patch, ANY
+from unittest.mock import patch, ANY, Mock
 import datetime
+import requests
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.test import Client, TestCase, TransactionTestCase
 
-from common.config import SysConfig
-from common.utils.sendmsg import MsgSender
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from common.config import SysConfig, config_snapshot
+from common.utils.sendmsg import MsgSender, close_smtp_connections, http_post
 from sql.engines import EngineBase, ResultSet
 from sql.models import (
     Instance,
@@ -14,8 +17,11 @@ from sql.models import (
     SqlWorkflowContent,
     QueryLog,
     ResourceGroup,
+    DailyStatistics,
+    DailyStatisticsState,
 )
 from common.utils.chart_dao import ChartDao
+from common.utils.dashboard_stats import refresh_dashboard_stats
 from common.auth import init_user
 
 User = get_user_model()
@@ -74,6 +80,34 @@ class ConfigOpsTests(TestCase):
         self.assertEqual(archer_config.sys_config["other_config"], "testvalue3")
 
 
+class ConfigSnapshotTests(TransactionTestCase):
+    """配置快照缓存测试，TestCase在事务中执行不会使用快照"""
+
+    def tearDown(self):
+        SysConfig().purge()
+
+    def test_snapshot(self):
+        archer_config = SysConfig()
+        archer_config.set("snapshot_config", "value1")
+        archer_config.set("snapshot_bool", "true")
+        self.assertEqual(SysConfig().get("snapshot_config"), "value1")
+        with self.assertNumQueries(0):
+            self.assertEqual(SysConfig().get("snapshot_config"), "value1")
+            self.assertIs(SysConfig().get("snapshot_bool"), True)
+            self.assertEqual(SysConfig().get("not_exist_config", "default"), "default")
+
+    def test_snapshot_invalidate(self):
+        SysConfig().set("snapshot_config", "value1")
+        self.assertEqual(SysConfig().get("snapshot_config"), "value1")
+        SysConfig().set("snapshot_config", "value2")
+        self.assertEqual(SysConfig().get("snapshot_config"), "value2")
+        SysConfig().replace(json.dumps([{"key": "other_config", "value": "v"}]))
+        self.assertIsNone(SysConfig().get("snapshot_config"))
+        self.assertEqual(config_snapshot(), {"other_config": "v"})
+        SysConfig().purge()
+        self.assertEqual(config_snapshot(), {})
+
+
 class SendMessageTest(TestCase):
     """发送消息测试"""
 
@@ -117,6 +151,7 @@ class SendMessageTest(TestCase):
         sender2 = MsgSender()
         sender2.send_email(some_sub, some_body, some_to)
         login.assert_not_called()
+        close_smtp_connections()
 
     @patch.object(smtplib.SMTP, "__init__", return_value=None)
     @patch.object(smtplib.SMTP, "login")
@@ -132,8 +167,13 @@ class SendMessageTest(TestCase):
         archer_config.set("mail_smtp_password", self.smtp_password)
         sender = MsgSender()
         sender.send_email(some_sub, some_body, some_to)
+        sender.send_email(some_sub, some_body, some_to)
         login.assert_called_once()
+        self.assertEqual(sendmail.call_count, 2)
         sendmail.assert_called_with(self.smtp_user, some_to, ANY)
+        # 连接复用，关闭连接池时才quit
+        _quit.assert_not_called()
+        close_smtp_connections()
         _quit.assert_called_once()
 
     @patch.object(smtplib.SMTP, "__init__", return_value=None)
@@ -150,6 +190,9 @@ class SendMessageTest(TestCase):
         sender = MsgSender()
         sender.send_email(some_sub, some_body, some_to)
         sendmail.assert_called_with(self.smtp_user, some_to, ANY)
+        # 连接复用，关闭连接池时才quit
+        _quit.assert_not_called()
+        close_smtp_connections()
         _quit.assert_called_once()
 
     def tearDown(self):
@@ -166,15 +209,17 @@ class DingTest(TestCase):
         self.url = "some_url"
         self.content = "some_content"
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def testDing(self, post):
         sender = MsgSender()
+        post.return_value.status_code = 200
         post.return_value.json.return_value = {"errcode": 0}
         with self.assertLogs("default", level="DEBUG") as lg:
             sender.send_ding(self.url, self.content)
             post.assert_called_once_with(
                 url=self.url,
                 json={"msgtype": "text", "text": {"content": self.content}},
+                timeout=5,
             )
             self.assertIn("钉钉Webhook推送成功", lg.output[0])
         post.return_value.json.return_value = {"errcode": 1, "errmsg": "test_error"}
@@ -182,6 +227,29 @@ class DingTest(TestCase):
             sender.send_ding(self.url, self.content)
             self.assertIn("test_error", lg.output[0])
 
+    @patch("common.utils.sendmsg.time.sleep")
+    @patch("requests.Session.post")
+    def test_http_post_retry(self, post, _sleep):
+        """只重试连接建立失败和限流，读取超时、服务端错误不重试，避免重复推送"""
+        post.side_effect = [
+            requests.ConnectionError(
+                MaxRetryError(None, "some_url", NewConnectionError(None, "refused"))
+            ),
+            Mock(status_code=200),
+        ]
+        self.assertEqual(http_post("some_url").status_code, 200)
+        self.assertEqual(post.call_count, 2)
+        post.reset_mock()
+        post.side_effect = requests.ReadTimeout("read timeout")
+        with self.assertRaises(requests.ReadTimeout):
+            http_post("some_url")
+        post.assert_called_once()
+        # 服务端错误时消息可能已经推送，只重试限流
+        post.reset_mock()
+        post.side_effect = [Mock(status_code=429), Mock(status_code=502)]
+        self.assertEqual(http_post("some_url").status_code, 502)
+        self.assertEqual(post.call_count, 2)
+
     def tearDown(self):
         pass
 
@@ -457,6 +525,7 @@ class ChartTest(TestCase):
         SqlWorkflowContent.objects.bulk_create(
             ddl_workflow_content + dml_workflow_content
         )
+        refresh_dashboard_stats(safety_lag=0)
 
     # query_logs = [QueryLog(
     #    instance_name = 'some_instance',
@@ -468,6 +537,8 @@ class ChartTest(TestCase):
         SqlWorkflowContent.objects.all().delete()
         SqlWorkflow.objects.all().delete()
         QueryLog.objects.all().delete()
+        DailyStatistics.objects.all().delete()
+        DailyStatisticsState.objects.all().delete()
         cls.u1.delete()
         cls.u2.delete()
         cls.superuser1.delete()
@@ -509,6 +580,44 @@ class ChartTest(TestCase):
         expected_rows = ((self.u2.display, 3), (self.u1.display, 2))
         self.assertEqual(result["rows"], expected_rows)
 
+    def testQueryLogStats(self):
+        """查询日志增量汇总测试，重复执行不会重复累加"""
+        dao = ChartDao()
+        QueryLog.objects.bulk_create(
+            [
+                QueryLog(
+                    username=self.u1.username,
+                    user_display=self.u1.display,
+                    db_name="some_db",
+                    instance_name=self.slave1.instance_name,
+                    sqllog="select 1",
+                    effect_row=10,
+                )
+                for i in range(2)
+            ]
+        )
+        refresh_dashboard_stats(safety_lag=0)
+        refresh_dashboard_stats(safety_lag=0)
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        self.assertEqual(dao.querylog_count_by_date(30)["rows"], ((today, 2),))
+        self.assertEqual(
+            dao.querylog_effect_row_by_user(30)["rows"], ((self.u1.display, 20),)
+        )
+        QueryLog.objects.create(
+            username=self.u2.username,
+            user_display=self.u2.display,
+            db_name="some_db",
+            instance_name=self.slave1.instance_name,
+            sqllog="select 1",
+            effect_row=5,
+        )
+        # 安全延迟内新建的记录留到下次汇总
+        refresh_dashboard_stats()
+        self.assertEqual(dao.querylog_count_by_date(30)["rows"], ((today, 2),))
+        refresh_dashboard_stats(safety_lag=0)
+        self.assertEqual(dao.querylog_count_by_date(30)["rows"], ((today, 3),))
+        self.assertEqual(dao.querylog_effect_row_by_db(30)["rows"], (("some_db", 25),))
+
 
 class AuthTest(TestCase):
     def setUp(self):
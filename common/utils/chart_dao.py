@@ -5,7 +5,7 @@ from django.db import connection
 
 
 class ChartDao(object):
-    # 直接在Archery数据库查询数据，用于报表
+    # 直接在Archery数据库查询数据，用于报表，工单和查询日志从common.utils.dashboard_stats的按天汇总表读取
     @staticmethod
     def __query(sql):
         cursor = connection.cursor()
@@ -32,26 +32,28 @@ class ChartDao(object):
     def syntax_type(self):
         sql = """
         select
-          case when syntax_type = 1
+          case when dim_value = '1'
             then 'DDL'
-          when syntax_type = 2
+          when dim_value = '2'
             then 'DML'
           else '其他'
           end as syntax_type,
-          count(*)
-        from sql_workflow
-        group by syntax_type;"""
+          cast(sum(cnt) as signed)
+        from statistics_daily
+        where source = 'sql_workflow' and dim_type = 'syntax_type'
+        group by dim_value;"""
         return self.__query(sql)
 
     # 工单数量统计
     def workflow_by_date(self, cycle):
         sql = """
         select
-          date_format(create_time, '%Y-%m-%d'),
-          count(*)
-        from sql_workflow
-        where create_time >= date_add(now(), interval -{} day)
-        group by date_format(create_time, '%Y-%m-%d')
+          date_format(stat_date, '%Y-%m-%d'),
+          cast(sum(cnt) as signed)
+        from statistics_daily
+        where source = 'sql_workflow' and dim_type = 'date'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by stat_date
         order by 1 asc;""".format(
             cycle
         )
@@ -61,27 +63,28 @@ class ChartDao(object):
     def workflow_by_group(self, cycle):
         sql = """
         select
-          group_name,
-          count(*)
-        from sql_workflow
-        where create_time >= date_add(now(), interval -{} day )
-        group by group_id
-        order by count(*) desc;""".format(
+          dim_value,
+          cast(sum(cnt) as signed)
+        from statistics_daily
+        where source = 'sql_workflow' and dim_type = 'group'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by dim_value
+        order by sum(cnt) desc;""".format(
             cycle
         )
         return self.__query(sql)
 
     def workflow_by_user(self, cycle):
         """工单按人统计"""
-        # TODO select 的对象应该为engineer ID, 查询时应作联合查询查出用户中文名
         sql = """
         select
-          engineer_display,
-          count(*)
-        from sql_workflow
-        where create_time >= date_add(now(), interval -{} day)
-        group by engineer_display
-        order by count(*) desc;""".format(
+          dim_value,
+          cast(sum(cnt) as signed)
+        from statistics_daily
+        where source = 'sql_workflow' and dim_type = 'user'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by dim_value
+        order by sum(cnt) desc;""".format(
             cycle
         )
         return self.__query(sql)
@@ -90,11 +93,12 @@ class ChartDao(object):
     def querylog_effect_row_by_date(self, cycle):
         sql = """
         select
-          date_format(create_time, '%Y-%m-%d'),
-          sum(effect_row)
-        from query_log
-        where create_time >= date_add(now(), interval -{} day )
-        group by date_format(create_time, '%Y-%m-%d')
+          date_format(stat_date, '%Y-%m-%d'),
+          cast(sum(effect_row) as signed)
+        from statistics_daily
+        where source = 'query_log' and dim_type = 'date'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by stat_date
         order by sum(effect_row) desc;""".format(
             cycle
         )
@@ -104,12 +108,13 @@ class ChartDao(object):
     def querylog_count_by_date(self, cycle):
         sql = """
         select
-          date_format(create_time, '%Y-%m-%d'),
-          count(*)
-        from query_log
-        where create_time >= date_add(now(), interval -{} day )
-        group by date_format(create_time, '%Y-%m-%d')
-        order by count(*) desc;""".format(
+          date_format(stat_date, '%Y-%m-%d'),
+          cast(sum(cnt) as signed)
+        from statistics_daily
+        where source = 'query_log' and dim_type = 'date'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by stat_date
+        order by sum(cnt) desc;""".format(
             cycle
         )
         return self.__query(sql)
@@ -117,12 +122,13 @@ class ChartDao(object):
     # SQL查询统计(用户检索行数)
     def querylog_effect_row_by_user(self, cycle):
         sql = """
-        select 
-          user_display,
-          sum(effect_row)
-        from query_log
-        where create_time >= date_add(now(), interval -{} day)
-        group by user_display
+        select
+          dim_value,
+          cast(sum(effect_row) as signed)
+        from statistics_daily
+        where source = 'query_log' and dim_type = 'user'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by dim_value
         order by sum(effect_row) desc
         limit 10;""".format(
             cycle
@@ -132,12 +138,13 @@ class ChartDao(object):
     # SQL查询统计(DB检索行数)
     def querylog_effect_row_by_db(self, cycle):
         sql = """
-       select
-          db_name,
-          sum(effect_row)
-        from query_log
-        where create_time >= date_add(now(), interval -{} day)
-        group by db_name
+        select
+          dim_value,
+          cast(sum(effect_row) as signed)
+        from statistics_daily
+        where source = 'query_log' and dim_type = 'db'
+          and stat_date >= date(date_add(now(), interval -{} day))
+        group by dim_value
         order by sum(effect_row) desc
         limit 10;""".format(
             cycle
@@ -146,18 +153,18 @@ class ChartDao(object):
 
     # 慢日志历史趋势图(按次数)
     def slow_query_review_history_by_cnt(self, checksum):
-        sql = f"""select sum(ts_cnt),date(date_add(ts_min, interval 8 HOUR))
-from mysql_slow_query_review_history
+        sql = f"""select sum(ts_cnt),date(date_add(bucket, interval 8 HOUR))
+from mysql_slow_query_rollup_hourly
 where checksum = '{checksum}'
-group by date(date_add(ts_min, interval 8 HOUR));"""
+group by date(date_add(bucket, interval 8 HOUR));"""
         return self.__query(sql)
 
     # 慢日志历史趋势图(按时长)
     def slow_query_review_history_by_pct_95_time(self, checksum):
-        sql = f"""select truncate(Query_time_pct_95,6),date(date_add(ts_min, interval 8 HOUR))
-from mysql_slow_query_review_history
+        sql = f"""select truncate(max(query_time_pct_95_max),6),date(date_add(bucket, interval 8 HOUR))
+from mysql_slow_query_rollup_hourly
 where checksum = '{checksum}'
-group by date(date_add(ts_min, interval 8 HOUR));"""
+group by date(date_add(bucket, interval 8 HOUR));"""
         return self.__query(sql)
 
     # 慢日志db/user维度统计
@@ -0,0 +1,121 @@
+# -*- coding: UTF-8 -*-
+"""
+dashboard统计数据，按天汇总工单和查询日志，ChartDao从汇总表读取，页面耗时与日志表大小无关
+按照各表自增ID增量处理，汇总和进度在同一个事务中提交，由django-q定时任务定期执行
+自增ID在插入时分配、事务提交后才可见，只汇总创建时间早于安全延迟的记录，避免跳过晚提交的较小ID
+统计维度只使用创建后不再变化的字段，已汇总的记录删除后统计数据不会扣减
+"""
+import datetime
+import logging
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from sql.models import DailyStatistics, DailyStatisticsState, QueryLog, SqlWorkflow
+
+logger = logging.getLogger("default")
+
+# 每批处理的ID范围
+REFRESH_BATCH_SIZE = 50000
+
+# 安全延迟(秒)，创建时间在此之内的记录可能还有更小ID的记录未提交，留到下次汇总
+REFRESH_SAFETY_LAG = 300
+
+# 数据来源: (模型, 返回行数字段, {统计维度: 维度字段})
+STAT_SOURCES = {
+    "sql_workflow": (
+        SqlWorkflow,
+        "0",
+        {
+            "date": "''",
+            "group": "group_name",
+            "user": "engineer_display",
+            "syntax_type": "CAST(syntax_type AS CHAR)",
+        },
+    ),
+    "query_log": (
+        QueryLog,
+        "effect_row",
+        {
+            "date": "''",
+            "user": "user_display",
+            "db": "db_name",
+        },
+    ),
+}
+
+_refresh_sql = """
+INSERT INTO statistics_daily (source, dim_type, dim_value, stat_date, cnt, effect_row)
+SELECT * FROM (
+    SELECT %s AS source, %s AS dim_type, IFNULL({dim}, '') AS dim_value,
+        DATE(create_time) AS stat_date, COUNT(*) AS cnt,
+        IFNULL(SUM({effect_row}), 0) AS effect_row
+    FROM {table}
+    WHERE id > %s AND id <= %s
+    GROUP BY dim_value, stat_date
+) AS r
+ON DUPLICATE KEY UPDATE
+    cnt = statistics_daily.cnt + r.cnt,
+    effect_row = statistics_daily.effect_row + r.effect_row"""
+
+
+def _safe_max_id(model, safety_lag):
+    """创建时间早于安全延迟的最大ID，按主键倒序查找，只扫描安全延迟内的记录"""
+    cutoff = timezone.now() - datetime.timedelta(seconds=safety_lag)
+    return (
+        model.objects.filter(create_time__lte=cutoff)
+        .order_by("-id")
+        .values_list("id", flat=True)
+        .first()
+        or 0
+    )
+
+
+def _refresh_source(source, batch_size, safety_lag):
+    model, effect_row, dims = STAT_SOURCES[source]
+    max_id = _safe_max_id(model, safety_lag)
+    while True:
+        with transaction.atomic():
+            # 锁定进度，定时任务与手动执行的命令不会重复汇总同一批数据
+            state, _ = DailyStatisticsState.objects.select_for_update().get_or_create(
+                source=source
+            )
+            if state.last_id >= max_id:
+                return state.last_id
+            end_id = min(state.last_id + batch_size, max_id)
+            with connection.cursor() as cursor:
+                for dim_type, dim in dims.items():
+                    cursor.execute(
+                        _refresh_sql.format(
+                            dim=dim, effect_row=effect_row, table=model._meta.db_table
+                        ),
+                        (source, dim_type, state.last_id, end_id),
+                    )
+            logger.debug(f"{source}统计汇总完成，ID范围：({state.last_id}, {end_id}]")
+            state.last_id = end_id
+            state.save(update_fields=["last_id", "update_time"])
+
+
+def refresh_dashboard_stats(
+    batch_size=REFRESH_BATCH_SIZE, safety_lag=REFRESH_SAFETY_LAG
+):
+    """
+    汇总上次汇总之后新增的工单和查询日志
+    :param safety_lag: 安全延迟(秒)，只汇总创建时间早于该延迟的记录
+    :return: 各数据来源已汇总的最大ID
+    """
+    return {
+        source: _refresh_source(source, batch_size, safety_lag)
+        for source in STAT_SOURCES
+    }
+
+
+def rebuild_dashboard_stats(
+    batch_size=REFRESH_BATCH_SIZE, safety_lag=REFRESH_SAFETY_LAG
+):
+    """清空统计数据和进度，从头汇总"""
+    with transaction.atomic():
+        list(DailyStatisticsState.objects.select_for_update())
+        DailyStatistics.objects.all().delete()
+        DailyStatisticsState.objects.all().delete()
+    return refresh_dashboard_stats(batch_size=batch_size, safety_lag=safety_lag)
@@ -3,6 +3,8 @@
 import re
 import email
 import smtplib
+import threading
+import time
 import requests
 import logging
 import traceback
@@ -10,6 +12,10 @@ from email import encoders
 from email.header import Header
 from email.utils import formataddr
 
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
 from common.config import SysConfig
 from common.utils.ding_api import get_access_token
 from common.utils.wx_api import get_wx_access_token
@@ -17,6 +23,104 @@ from common.utils.feishu_api import *
 
 logger = logging.getLogger("default")
 
+# 各渠道共用的HTTP连接池，避免每条消息重新建立TLS连接
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+_http.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+# 服务端错误时消息可能已经推送，只重试限流
+_retry_status = {429}
+
+
+def _is_connect_error(e):
+    """
+    请求发出前的连接异常(建立连接失败、连接超时)，可以安全重试
+    读取超时、连接中途断开时服务端可能已经收到消息，重试会重复推送
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", e.args[0]), NewConnectionError)
+    return False
+
+
+def http_post(url, **kwargs):
+    """
+    复用连接发送POST请求，连接建立失败和限流按指数退避重试NOTIFY["RETRIES"]次
+    :return: 最后一次请求的响应
+    """
+    retries = settings.NOTIFY["RETRIES"]
+    kwargs.setdefault("timeout", 5)
+    for attempt in range(retries + 1):
+        try:
+            r = _http.post(url=url, **kwargs)
+            if r.status_code not in _retry_status or attempt == retries:
+                return r
+            logger.warning(f"消息推送失败，{url}响应状态码：{r.status_code}，准备重试")
+        except requests.RequestException as e:
+            if attempt == retries or not _is_connect_error(e):
+                raise
+            logger.warning(f"消息推送失败，{url}连接异常：{e}，准备重试")
+        time.sleep(0.5 * 2**attempt)
+
+
+class _SmtpPool:
+    """按 服务器/端口/用户 复用SMTP连接，连接断开时重新连接一次，空闲超时的连接直接关闭"""
+
+    def __init__(self, max_idle_time=60):
+        self.max_idle_time = max_idle_time
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def sendmail(self, key, connect, from_addr, to_addrs, msg):
+        with self._lock:
+            item = self._conns.pop(key, None)
+        server = None
+        if item and time.monotonic() - item[1] < self.max_idle_time:
+            server = item[0]
+        elif item:
+            self._quit(item[0])
+        if server is not None:
+            try:
+                server.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                server = None
+            except Exception:
+                self._quit(server)
+                raise
+        if server is None:
+            server = connect()
+            try:
+                server.sendmail(from_addr, to_addrs, msg)
+            except Exception:
+                self._quit(server)
+                raise
+        with self._lock:
+            if key not in self._conns:
+                self._conns[key] = (server, time.monotonic())
+                return
+        self._quit(server)
+
+    def clear(self):
+        with self._lock:
+            conns, self._conns = self._conns, {}
+        for server, _ in conns.values():
+            self._quit(server)
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+
+_smtp_pool = _SmtpPool()
+
+
+def close_smtp_connections():
+    """关闭复用的SMTP连接"""
+    _smtp_pool.clear()
+
 
 class MsgSender(object):
     def __init__(self, **kwargs):
@@ -68,6 +172,20 @@ class MsgSender(object):
 
         return file_msg
 
+    def _smtp_connect(self):
+        if self.MAIL_SSL:
+            server = smtplib.SMTP_SSL(
+                self.MAIL_REVIEW_SMTP_SERVER, self.MAIL_REVIEW_SMTP_PORT, timeout=3
+            )
+        else:
+            server = smtplib.SMTP(
+                self.MAIL_REVIEW_SMTP_SERVER, self.MAIL_REVIEW_SMTP_PORT, timeout=3
+            )
+        # 如果提供的密码为空，则不需要登录
+        if self.MAIL_REVIEW_FROM_PASSWORD:
+            server.login(self.MAIL_REVIEW_FROM_ADDR, self.MAIL_REVIEW_FROM_PASSWORD)
+        return server
+
     def send_email(self, subject, body, to, **kwargs):
         """
         发送邮件
@@ -110,22 +228,20 @@ class MsgSender(object):
             main_msg["Cc"] = ", ".join(str(cc) for cc in list(set(list_cc)))
             main_msg["Date"] = email.utils.formatdate()
 
-            if self.MAIL_SSL:
-                server = smtplib.SMTP_SSL(
-                    self.MAIL_REVIEW_SMTP_SERVER, self.MAIL_REVIEW_SMTP_PORT, timeout=3
-                )
-            else:
-                server = smtplib.SMTP(
-                    self.MAIL_REVIEW_SMTP_SERVER, self.MAIL_REVIEW_SMTP_PORT, timeout=3
-                )
-
-                # 如果提供的密码为空，则不需要登录
-            if self.MAIL_REVIEW_FROM_PASSWORD:
-                server.login(self.MAIL_REVIEW_FROM_ADDR, self.MAIL_REVIEW_FROM_PASSWORD)
-            server.sendmail(
-                self.MAIL_REVIEW_FROM_ADDR, to + list_cc, main_msg.as_string()
+            # 相同服务器和用户的连接复用，不再每封邮件重新连接和登录
+            _smtp_pool.sendmail(
+                (
+                    self.MAIL_REVIEW_SMTP_SERVER,
+                    self.MAIL_REVIEW_SMTP_PORT,
+                    self.MAIL_SSL,
+                    self.MAIL_REVIEW_FROM_ADDR,
+                    self.MAIL_REVIEW_FROM_PASSWORD,
+                ),
+                self._smtp_connect,
+                self.MAIL_REVIEW_FROM_ADDR,
+                to + list_cc,
+                main_msg.as_string(),
             )
-            server.quit()
             logger.debug(f"邮件推送成功\n消息标题:{subject}\n通知对象：{to + list_cc}\n消息内容：{body}")
             return "success"
         except Exception:
@@ -145,7 +261,7 @@ class MsgSender(object):
             "msgtype": "text",
             "text": {"content": "{}".format(content)},
         }
-        r = requests.post(url=url, json=data)
+        r = http_post(url, json=data)
         r_json = r.json()
         if r_json["errcode"] == 0:
             logger.debug(f"钉钉Webhook推送成功\n通知对象：{url}\n消息内容：{content}")
@@ -166,7 +282,7 @@ class MsgSender(object):
             "agent_id": self.ding_agent_id,
             "msg": {"msgtype": "text", "text": {"content": f"{content}"}},
         }
-        r = requests.post(url=send_url, json=data, timeout=5)
+        r = http_post(send_url, json=data)
         r_json = r.json()
         if r_json["errcode"] == 0:
             logger.debug(f"钉钉推送成功\n通知对象：{userid_list}\n消息内容：{content}")
@@ -186,7 +302,7 @@ class MsgSender(object):
             "agentid": self.wx_agent_id,
             "text": {"content": msg},
         }
-        res = requests.post(url=send_url, json=data, timeout=5)
+        res = http_post(send_url, json=data)
         r_json = res.json()
         if r_json["errcode"] == 0:
             logger.debug(f"企业微信推送成功\n通知对象：{to_user}")
@@ -207,7 +323,7 @@ class MsgSender(object):
             "msgtype": "markdown",
             "markdown": {"content": msg},
         }
-        res = requests.post(url=send_url, json=data, timeout=5)
+        res = http_post(send_url, json=data)
         r_json = res.json()
         if r_json["errcode"] == 0:
             logger.debug(f"企业微信机器人推送成功\n通知对象：机器人")
@@ -230,7 +346,7 @@ class MsgSender(object):
                 },
             }
 
-        r = requests.post(url=url, json=data)
+        r = http_post(url, json=data)
         r_json = r.json()
         if (
             "ok" in r_json
@@ -253,8 +369,8 @@ class MsgSender(object):
             "msg_type": "text",
             "content": {"text": f"{title}\n{content}"},
         }
-        r = requests.post(
-            url=url,
+        r = http_post(
+            url,
             json=data,
             headers={"Authorization": "Bearer " + get_feishu_access_token()},
         ).json()
@@ -1,10 +1,12 @@
 # -*- coding: UTF-8 -*-
 import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 import MySQLdb
 import simplejson as json
+from django.db import connections
 from django.template import loader
 from archery import settings
 from sql.engines import get_engine
@@ -100,6 +102,38 @@ def get_export_full_path(base_dir: str, instance_name: str, db_name: str) -> str
     return fullpath
 
 
+def export_dictionary(query_engine, db_name: str, fullpath: str):
+    """
+    导出单个库的数据字典，表结构由引擎一次查询后分组返回，
+    页面按表逐个渲染后增量写入文件，不在内存中拼接整个页面
+    """
+    table_metas = query_engine.get_tables_metas_data(db_name=db_name)
+    context = {
+        "db_name": db_name,
+        "table_count": len(table_metas),
+        "export_time": datetime.datetime.now(),
+    }
+    head, tail = loader.render_to_string(
+        template_name="dictionaryexport.html", context=context
+    ).split("<!-- tables -->", 1)
+    table_template = loader.get_template("dictionaryexport_table.html")
+    with open(fullpath, "w", encoding="utf-8") as fp:
+        fp.write(head)
+        for tb in table_metas:
+            fp.write(table_template.render({"tb": tb}))
+        fp.write(tail)
+
+
+def export_instance_db(instance, db_name: str, fullpath: str):
+    """并发导出时每个库使用独立的引擎连接，导出后关闭"""
+    query_engine = get_engine(instance=instance)
+    try:
+        export_dictionary(query_engine, db_name, fullpath)
+    finally:
+        query_engine.close()
+        connections.close_all()
+
+
 @permission_required("sql.data_dictionary_export", raise_exception=True)
 def export(request):
     """导出数据字典"""
@@ -123,42 +157,44 @@ def export(request):
     else:
         return JsonResponse({"status": 1, "msg": "仅管理员可以导出整个实例的字典信息！", "data": []})
 
-    # 获取数据，存入目录
+    # 先校验所有导出路径，再获取数据存入目录
     path = os.path.join(settings.BASE_DIR, "downloads", "dictionary")
     os.makedirs(path, exist_ok=True)
+    export_paths = []
     for db in dbs:
-        table_metas = query_engine.get_tables_metas_data(db_name=db)
-        context = {
-            "db_name": db_name,
-            "tables": table_metas,
-            "export_time": datetime.datetime.now(),
-        }
-        data = loader.render_to_string(
-            template_name="dictionaryexport.html", context=context, request=request
-        )
         fullpath = get_export_full_path(path, instance_name, db)
         if not fullpath:
+            query_engine.close()
             return JsonResponse({"status": 1, "msg": "实例名或db名不合法", "data": []})
-        with open(fullpath, "w", encoding="utf-8") as fp:
-            fp.write(data)
-    # 关闭连接
-    query_engine.close()
+        export_paths.append((db, fullpath))
+
     if db_name:
-        fullpath = get_export_full_path(path, instance_name, db)
-        if not fullpath:
-            return JsonResponse({"status": 1, "msg": "实例名或db名不合法", "data": []})
-        response = FileResponse(open(fullpath, "rb"))
+        try:
+            export_dictionary(query_engine, *export_paths[0])
+        finally:
+            query_engine.close()
+        response = FileResponse(open(export_paths[0][1], "rb"))
         response["Content-Type"] = "application/octet-stream"
         response[
             "Content-Disposition"
         ] = f'attachment;filename="{quote(instance_name)}_{quote(db_name)}.html"'
         return response
 
-    else:
-        return JsonResponse(
-            {
-                "status": 0,
-                "msg": f"实例{instance_name}数据字典导出成功，请到downloads目录下载！",
-                "data": [],
-            }
-        )
+    # 整个实例按库并发导出，并发数即同时占用的实例连接数
+    query_engine.close()
+    with ThreadPoolExecutor(
+        max_workers=settings.DATA_DICTIONARY_EXPORT_WORKERS
+    ) as executor:
+        futures = [
+            executor.submit(export_instance_db, instance, db, fullpath)
+            for db, fullpath in export_paths
+        ]
+        for future in futures:
+            future.result()
+    return JsonResponse(
+        {
+            "status": 0,
+            "msg": f"实例{instance_name}数据字典导出成功，请到downloads目录下载！",
+            "data": [],
+        }
+    )
@@ -42,10 +42,11 @@ class EngineBase:
                 self.host, self.port = self.ssh.get_ssh()
 
     def __del__(self):
+        # 隧道在进程内共享，这里只释放引用，空闲后由隧道管理回收
         if hasattr(self, "ssh"):
-            del self.ssh
+            self.ssh.close()
         if hasattr(self, "remotessh"):
-            del self.remotessh
+            self.remotessh.close()
 
     def remote_instance_conn(self, instance=None):
         # 判断如果配置了隧道则连接隧道
@@ -78,6 +79,13 @@ class EngineBase:
     def get_connection(self, db_name=None):
         """返回一个conn实例"""
 
+    def close(self):
+        """关闭连接"""
+
+    def discard_connection(self):
+        """丢弃当前连接，使用连接池的引擎不再放回连接池"""
+        self.close()
+
     def test_connection(self):
         """测试实例链接是否正常"""
         return self.query(sql=self.test_query)
@@ -101,6 +109,11 @@ class EngineBase:
         """返回引擎服务器版本，返回对象为tuple (x,y,z)"""
         return tuple()
 
+    def prepare_query_session(self, db_name=None, max_execution_time=0):
+        """查询前的会话准备，建立查询连接并返回实例同步延迟，后续query复用该会话"""
+        self.get_connection(db_name=db_name)
+        return self.seconds_behind_master
+
     def kill_connection(self, thread_id):
         """终止数据库连接"""
 
@@ -179,11 +192,37 @@ class EngineBase:
         """实际查询 返回一个ResultSet"""
         return ResultSet()
 
+    def query_stream(
+        self, db_name=None, sql="", limit_num=0, chunk_size=1000, **kwargs
+    ):
+        """
+        流式查询，返回一个ResultSet，rows为按chunk_size分批产出行数据的生成器
+        默认一次性查询后再分批返回，支持服务端游标的引擎可以覆盖实现
+        """
+        result_set = self.query(db_name=db_name, sql=sql, limit_num=limit_num, **kwargs)
+        result_set.rows = iter_chunks(result_set.rows, chunk_size)
+        return result_set
+
+    def prefetch_query_masking(self, db_name=None, sql=""):
+        """在查询执行前提交脱敏所需的语句解析，与查询并行执行，不需要解析的引擎无需实现"""
+
     def query_masking(self, db_name=None, sql="", resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
         return resultset
 
+    def query_masking_stream(self, db_name=None, sql="", resultset=None):
+        """
+        流式结果集脱敏，rows为分批的行数据生成器，返回rows同样分批的结果集
+        默认合并全部批次后调用query_masking，支持按批次脱敏的引擎可以覆盖实现
+        """
+        chunks = list(resultset.rows)
+        chunk_size = max(len(chunks[0]), 1) if chunks else 1
+        resultset.rows = [row for chunk in chunks for row in chunk]
+        resultset = self.query_masking(db_name=db_name, sql=sql, resultset=resultset)
+        resultset.rows = iter_chunks(resultset.rows, chunk_size)
+        return resultset
+
     def execute_check(self, db_name=None, sql=""):
         """执行语句的检查 返回一个ReviewSet"""
         return ReviewSet()
@@ -192,8 +231,11 @@ class EngineBase:
         """执行语句 返回一个ReviewSet"""
         return ReviewSet()
 
-    def get_execute_percentage(self):
-        """获取执行进度"""
+    def get_execute_percentage(self, workflow=None):
+        """获取执行进度，分批执行的工单返回已提交语句的百分比"""
+        from sql.utils.execute_progress import execute_percentage
+
+        return execute_percentage(workflow.id) if workflow else None
 
     def get_rollback(self, workflow):
         """获取工单回滚语句"""
@@ -208,6 +250,12 @@ class EngineBase:
         return ResultSet()
 
 
+def iter_chunks(rows, chunk_size):
+    """将行数据按chunk_size分批"""
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i : i + chunk_size]
+
+
 def get_engine_map():
     available_engines = settings.AVAILABLE_ENGINES
     enabled_engines = {}
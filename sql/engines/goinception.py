@@ -2,13 +2,17 @@
 import logging
 import re
 import traceback
+from collections import defaultdict
+
 import MySQLdb
 import pymysql
 import simplejson as json
+from django.conf import settings
 
 from common.config import SysConfig
 from sql.models import AliyunRdsConfig
-from sql.utils.sql_utils import get_syntax_type
+from sql.utils.connection_pool import get_pool, pool_enabled, pooled_connection
+from sql.utils.sql_utils import get_syntax_types
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
 
@@ -22,6 +26,11 @@ class GoInceptionEngine(EngineBase):
 
     info = "GoInception engine"
 
+    def __init__(self, instance=None):
+        super().__init__(instance=instance)
+        self._pool = None
+        self._conn_broken = False
+
     def get_connection(self, db_name=None):
         if self.conn:
             return self.conn
@@ -36,6 +45,20 @@ class GoInceptionEngine(EngineBase):
         archer_config = SysConfig()
         go_inception_host = archer_config.get("go_inception_host")
         go_inception_port = int(archer_config.get("go_inception_port", 4000))
+        if pool_enabled():
+            self._pool = get_pool(
+                ("goinception", go_inception_host, go_inception_port),
+                lambda: MySQLdb.connect(
+                    host=go_inception_host,
+                    port=go_inception_port,
+                    charset="utf8mb4",
+                    connect_timeout=10,
+                ),
+                label=f"goInception/{go_inception_host}:{go_inception_port}",
+                rollback_on_release=False,
+            )
+            self.conn = self._pool.acquire()
+            return self.conn
         self.conn = MySQLdb.connect(
             host=go_inception_host,
             port=go_inception_port,
@@ -80,16 +103,19 @@ class GoInceptionEngine(EngineBase):
                             inception_magic_commit;"""
         inception_result = self.query(sql=inception_sql)
         check_result.syntax_type = 2  # TODO 工单类型 0、其他 1、DDL，2、DML 仅适用于MySQL，待调整
+        check_result.rows = [
+            ReviewResult(inception_result=r) for r in inception_result.rows
+        ]
         for r in inception_result.rows:
-            check_result.rows += [ReviewResult(inception_result=r)]
             if r[2] == 1:  # 警告
                 check_result.warning_count += 1
             elif r[2] == 2:  # 错误
                 check_result.error_count += 1
-            # 没有找出DDL语句的才继续执行此判断
-            if check_result.syntax_type == 2:
-                if get_syntax_type(r[5], parser=False, db_type="mysql") == "DDL":
-                    check_result.syntax_type = 1
+        # 批量判断语句类型，存在DDL语句即为DDL工单
+        if "DDL" in get_syntax_types(
+            [r[5] for r in inception_result.rows], db_type="mysql"
+        ):
+            check_result.syntax_type = 1
         check_result.column_list = inception_result.column_list
         check_result.checked = True
         check_result.error = inception_result.error
@@ -164,6 +190,8 @@ class GoInceptionEngine(EngineBase):
         except Exception as e:
             logger.warning(f"goInception语句执行报错，错误信息{traceback.format_exc()}")
             result_set.error = str(e)
+            # 执行异常的会话状态不确定，不再放回连接池
+            self._conn_broken = True
         if close_conn:
             self.close()
         return result_set
@@ -214,59 +242,87 @@ class GoInceptionEngine(EngineBase):
     def get_rollback(self, workflow):
         """
         获取回滚语句，并且按照执行顺序倒序展示，return ['源语句'，'回滚语句']
+        按备份库批量查询备份表名，再按备份表批量查询回滚语句
         """
-        list_execute_result = json.loads(
+        # 兼容列式格式和旧数据'[{}]'、'[[]]'格式
+        list_execute_result = ReviewSet.load_rows(
             workflow.sqlworkflowcontent.execute_result or "[]"
         )
         # 回滚语句倒序展示
         list_execute_result.reverse()
-        list_backup_sql = []
-        # 创建连接
-        conn = self.get_backup_connection()
-        cur = conn.cursor()
+        # 有备份的语句，[(备份库, opid_time, 源语句)]
+        backup_rows = []
+        opid_by_db = defaultdict(list)
         for row in list_execute_result:
-            try:
-                # 获取backup_db_name， 兼容旧数据'[[]]'格式
-                if isinstance(row, list):
-                    if row[8] == "None":
-                        continue
-                    backup_db_name = row[8]
-                    sequence = row[7]
-                    sql = row[5]
-                # 新数据
-                else:
-                    if row.get("backup_dbname") in ("None", ""):
-                        continue
-                    backup_db_name = row.get("backup_dbname")
-                    sequence = row.get("sequence")
-                    sql = row.get("sql")
+            backup_db_name = row.get("backup_dbname")
+            if backup_db_name in ("None", "", None):
+                continue
+            opid_time = row.get("sequence").replace("'", "")
+            backup_rows.append((backup_db_name, opid_time, row.get("sql")))
+            opid_by_db[backup_db_name].append(opid_time)
+
+        archer_config = SysConfig()
+        backup_host = archer_config.get("inception_remote_backup_host")
+        backup_port = int(archer_config.get("inception_remote_backup_port", 3306))
+        backup_user = archer_config.get("inception_remote_backup_user")
+        # {(备份库, opid_time): 备份表}
+        tables = {}
+        # {(备份库, opid_time): [回滚语句]}
+        statements = defaultdict(list)
+        try:
+            with pooled_connection(
+                ("inception_backup", backup_host, backup_port, backup_user),
+                self.get_backup_connection,
+                label=f"inception_backup {backup_host}:{backup_port}",
+                errors=MySQLdb.Error,
+            ) as conn:
+                cur = conn.cursor()
                 # 获取备份表名
-                opid_time = sequence.replace("'", "")
-                sql_table = f"""select tablename
-                                from {backup_db_name}.$_$Inception_backup_information$_$
-                                where opid_time='{opid_time}';"""
-
-                cur.execute(sql_table)
-                list_tables = cur.fetchall()
-                if list_tables:
-                    # 获取备份语句
-                    table_name = list_tables[0][0]
-                    sql_back = f"""select rollback_statement
-                                   from {backup_db_name}.{table_name}
-                                   where opid_time='{opid_time}'"""
-                    cur.execute(sql_back)
-                    list_backup = cur.fetchall()
-                    # 拼接成回滚语句列表,['源语句'，'回滚语句']
-                    list_backup_sql.append(
-                        [sql, "\n".join([back_info[0] for back_info in list_backup])]
-                    )
-            except Exception as e:
-                logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
-                raise Exception(e)
-        # 关闭连接
-        if conn:
-            conn.close()
-        return list_backup_sql
+                for backup_db_name, opid_times in opid_by_db.items():
+                    sql_table = f"""select opid_time,tablename
+                                    from `{backup_db_name}`.`$_$Inception_backup_information$_$`
+                                    where opid_time in ({{}});"""
+                    for opid_time, table_name in self._query_in_batches(
+                        cur, sql_table, opid_times
+                    ):
+                        tables.setdefault((backup_db_name, opid_time), table_name)
+                # 获取备份语句
+                opid_by_table = defaultdict(list)
+                for (backup_db_name, opid_time), table_name in tables.items():
+                    opid_by_table[(backup_db_name, table_name)].append(opid_time)
+                for (backup_db_name, table_name), opid_times in opid_by_table.items():
+                    sql_back = f"""select opid_time,rollback_statement
+                                   from `{backup_db_name}`.`{table_name}`
+                                   where opid_time in ({{}}) order by id;"""
+                    for opid_time, rollback_statement in self._query_in_batches(
+                        cur, sql_back, opid_times
+                    ):
+                        statements[(backup_db_name, opid_time)].append(
+                            rollback_statement
+                        )
+        except Exception as e:
+            logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
+            raise Exception(e)
+        # 拼接成回滚语句列表,['源语句'，'回滚语句']
+        return [
+            [sql, "\n".join(statements[(backup_db_name, opid_time)])]
+            for backup_db_name, opid_time, sql in backup_rows
+            if (backup_db_name, opid_time) in tables
+        ]
+
+    @staticmethod
+    def _query_in_batches(cur, sql, values):
+        """values去重后分批填充到sql的IN (...)中查询，分批读取查询结果"""
+        batch_size = settings.ROLLBACK_BATCH_SIZE
+        values = list(dict.fromkeys(values))
+        for i in range(0, len(values), batch_size):
+            batch = values[i : i + batch_size]
+            cur.execute(sql.format(",".join(["%s"] * len(batch))), batch)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
 
     def get_variables(self, variables=None):
         """获取实例参数"""
@@ -333,8 +389,12 @@ class GoInceptionEngine(EngineBase):
 
     def close(self):
         if self.conn:
-            self.conn.close()
+            if self._pool:
+                self._pool.release(self.conn, broken=self._conn_broken)
+            else:
+                self.conn.close()
             self.conn = None
+            self._conn_broken = False
 
 
 class DictTree(dict):
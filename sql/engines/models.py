@@ -2,6 +2,11 @@
 """engine 结果集定义"""
 import json
 
+# 审核结果保存到数据库时使用的紧凑编码, 不转义中文
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+# 序列化时每次编码的行数
+_JSON_CHUNK_ROWS = 1000
+
 
 class SqlItem:
     def __init__(
@@ -86,7 +91,7 @@ class ReviewSet:
         status=None,
         affected_rows=0,
         column_list=None,
-        **kwargs
+        **kwargs,
     ):
         self.full_sql = full_sql
         self.is_execute = False
@@ -103,15 +108,42 @@ class ReviewSet:
         self.status = status
         self.affected_rows = affected_rows
 
+    def iter_json(self):
+        """
+        按列式格式逐行输出JSON片段, {"columns": [列名], "rows": [[值]]}
+        列名只保存一次, 不需要先构造完整的字典列表
+        """
+        rows = [r if isinstance(r, dict) else r.__dict__ for r in self.rows]
+        # 各行的列通常相同, 自定义属性按出现顺序追加
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        yield f'{{"columns":{_compact_encoder.encode(columns)},"rows":['
+        for start in range(0, len(rows), _JSON_CHUNK_ROWS):
+            values = [
+                list(row.values())
+                if list(row) == columns
+                else [row.get(key) for key in columns]
+                for row in rows[start : start + _JSON_CHUNK_ROWS]
+            ]
+            chunk = _compact_encoder.encode(values)[1:-1]
+            yield f",{chunk}" if start else chunk
+        yield "]}"
+
     def json(self):
-        tmp_list = []
-        for r in self.rows:
-            if isinstance(r, dict):
-                tmp_list += [r]
-            else:
-                tmp_list += [r.__dict__]
+        return "".join(self.iter_json())
 
-        return json.dumps(tmp_list)
+    @staticmethod
+    def load_rows(content):
+        """
+        解析json()保存的审核/执行结果, 返回字典列表
+        兼容旧版本保存的[{}]格式以及inception的[[]]格式
+        """
+        data = json.loads(content) if isinstance(content, (str, bytes)) else content
+        if isinstance(data, dict):
+            columns = data["columns"]
+            return [dict(zip(columns, row)) for row in data["rows"]]
+        if data and isinstance(data[-1], list):
+            return [ReviewResult(inception_result=r).__dict__ for r in data]
+        return data
 
     def to_dict(self):
         tmp_list = []
@@ -131,7 +163,7 @@ class ResultSet:
         affected_rows=0,
         column_list=None,
         column_type=None,
-        **kwargs
+        **kwargs,
     ):
         self.full_sql = full_sql
         self.is_execute = False
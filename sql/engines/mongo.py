@@ -6,13 +6,18 @@ import traceback
 import subprocess
 import simplejson as json
 import datetime
+import calendar
 import tempfile
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
 from bson.son import SON
 from bson import json_util
 from pymongo.errors import OperationFailure
 from dateutil.parser import parse
 from bson.objectid import ObjectId
 from bson.int64 import Int64
+from django.conf import settings
 
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -22,6 +27,85 @@ logger = logging.getLogger("default")
 # mongo客户端安装在本机的位置
 mongo = "mongo"
 
+# 集合首尾文档的字段采样结果，按 实例、库、集合 缓存，{key: (采样时间, [字段])}
+_sampled_columns_cache = {}
+_sampled_columns_lock = threading.Lock()
+
+
+class _Display(str):
+    """嵌套在dict、list中展示时不带引号，与ObjectId(...)、时间的原展示格式一致"""
+
+    def __repr__(self):
+        return str(self)
+
+
+def _format_date(value):
+    """bson时间为UTC时间，转换为毫秒时间戳后按本地时间展示"""
+    if isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            value = value - value.utcoffset()
+        millis = calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+    else:
+        millis = value
+    try:
+        date = datetime.datetime.fromtimestamp(millis / 1000)
+    except (OverflowError, OSError, ValueError):
+        return str(value)
+    return date.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def _display_value(value):
+    """嵌套值的展示形式，ObjectId和时间转换为可读格式，兼容$oid、$date格式的扩展JSON"""
+    if isinstance(value, ObjectId):
+        return _Display(f"ObjectId('{value}')")
+    if isinstance(value, datetime.datetime):
+        return _Display(_format_date(value))
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if isinstance(value.get("$oid"), str):
+                return _Display(f"ObjectId('{value['$oid']}')")
+            if isinstance(value.get("$date"), int):
+                return _Display(_format_date(value["$date"]))
+        return {k: _display_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_display_value(v) for v in value]
+    if type(value) is Int64:
+        return int(value)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    # 其他bson类型与json_util的序列化结果保持一致
+    return _display_value(json.loads(json_util.dumps(value)))
+
+
+# 常见类型直接转换，无需递归
+_cell_converters = {
+    str: str,
+    int: str,
+    float: str,
+    bool: str,
+    type(None): str,
+    Int64: lambda value: str(int(value)),
+    ObjectId: lambda value: f"ObjectId('{value}')",
+    datetime.datetime: _format_date,
+    list: lambda value: "(array) %d Elements" % len(value),
+}
+
+
+# 隐藏的JSON结果列，bson类型按json_util的扩展JSON格式序列化
+_json_col_encoder = json.JSONEncoder(
+    ensure_ascii=False, indent=2, separators=(",", ":"), default=json_util.default
+)
+
+
+def _display_cell(value):
+    """查询结果单元格的展示内容"""
+    convert = _cell_converters.get(type(value))
+    if convert:
+        return convert(value)
+    if isinstance(value, list):
+        return "(array) %d Elements" % len(value)
+    return str(_display_value(value))
+
 
 # 自定义异常
 class mongo_error(Exception):
@@ -274,6 +358,105 @@ class JsonDecoder:
             return self.__cur_token
 
 
+# 不带参数的new Date()、ISODate()解析为当前时间，包含这类写法的语句不缓存执行计划
+_current_date_regex = re.compile(r"(?:new\s*Date|ISODate)\s*\(\s*\)", re.I)
+
+
+@dataclass(frozen=True)
+class MongoQueryPlan:
+    """解析后的查询语句，执行时直接调用pymongo接口，缓存后只读，不可修改其中的条件"""
+
+    collection: str
+    method: str
+    filter: dict = None
+    projection: dict = None
+    sort: tuple = ()
+    skip: int = 0
+    limit: int = None
+    pipeline: tuple = ()
+    count: bool = False
+    explain: bool = False
+
+    def execute(self, collection, limit_num):
+        """
+        执行查询，返回游标，count返回数量，explain、index_information返回字典
+        :param collection: pymongo集合对象
+        :param limit_num: 最大返回行数
+        """
+        batch_size = settings.MONGO_QUERY_BATCH_SIZE
+        if self.method == "index_information":
+            return collection.index_information()
+        if self.method == "aggregate":
+            if self.count or self.explain or self.sort or self.skip or self.limit:
+                raise ValueError("aggregate查询不支持sort、skip、limit、count、explain")
+            # 给aggregate查询加limit行数限制，防止返回结果过多导致archery挂掉
+            pipeline = list(self.pipeline) + [{"$limit": limit_num}]
+            return collection.aggregate(
+                pipeline, batchSize=min(limit_num, batch_size) or batch_size
+            )
+        if self.method != "find":
+            raise ValueError(f"不支持的查询方法：{self.method}")
+        if self.count:
+            # 和Cursor.count()一样忽略skip、limit，无条件时使用集合元数据
+            if self.filter:
+                return collection.count_documents(self.filter)
+            return collection.estimated_document_count()
+        if self.projection is None:
+            cursor = collection.find(self.filter)
+        else:
+            cursor = collection.find(self.filter, self.projection)
+        if self.sort:
+            cursor = cursor.sort(list(self.sort))
+        if self.limit:
+            limit = min(limit_num, self.limit)
+        elif self.explain:
+            limit = 0
+        else:
+            limit = limit_num
+        if limit:
+            cursor = cursor.limit(limit)
+        if self.skip:
+            cursor = cursor.skip(self.skip)
+        if self.explain:
+            return cursor.explain()
+        return cursor.batch_size(min(limit, batch_size) or batch_size)
+
+
+def _compile_query(sql):
+    """解析查询语句，生成执行计划"""
+    query_dict = MongoEngine().parse_query_sentence(sql)
+    if not query_dict or not query_dict.get("method"):
+        raise ValueError("对不起，只支持查询相关方法")
+    de = JsonDecoder()
+    method = query_dict["method"]
+    plan = {"collection": query_dict["collection"], "method": method}
+    if method == "find":
+        plan["filter"] = de.decode(query_dict["condition"])
+        if query_dict.get("projection"):
+            plan["projection"] = de.decode(query_dict["projection"])
+    elif method == "aggregate":
+        plan["pipeline"] = tuple(query_dict["condition"])
+    if query_dict.get("sort"):
+        plan["sort"] = tuple(de.decode(query_dict["sort"]).items())
+    if query_dict.get("limit"):
+        plan["limit"] = int(query_dict["limit"])
+    if query_dict.get("skip"):
+        plan["skip"] = int(query_dict["skip"])
+    plan["count"] = "count" in query_dict
+    plan["explain"] = "explain" in query_dict
+    return MongoQueryPlan(**plan)
+
+
+_compile_query_cached = lru_cache(maxsize=1024)(_compile_query)
+
+
+def compile_query(sql):
+    """按语句文本缓存执行计划，包含当前时间的语句每次重新解析"""
+    if _current_date_regex.search(sql):
+        return _compile_query(sql)
+    return _compile_query_cached(sql)
+
+
 class MongoEngine(EngineBase):
     error = None
     warning = None
@@ -855,6 +1038,25 @@ class MongoEngine(EngineBase):
         result.rows = columns
         return result
 
+    def sampled_columns(self, db_name, tb_name):
+        """集合首尾文档的字段，查询结果的默认列，采样结果缓存MONGO_SCHEMA_CACHE_TTL秒"""
+        ttl = settings.MONGO_SCHEMA_CACHE_TTL
+        key = (self.instance.id, db_name, tb_name)
+        now = time.monotonic()
+        entry = _sampled_columns_cache.get(key)
+        if ttl and entry and now - entry[0] < ttl:
+            return list(entry[1])
+        columns = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name).rows
+        if ttl:
+            with _sampled_columns_lock:
+                # 清理过期的采样结果
+                for k in [
+                    k for k, v in _sampled_columns_cache.items() if now - v[0] >= ttl
+                ]:
+                    del _sampled_columns_cache[k]
+                _sampled_columns_cache[key] = (now, list(columns))
+        return list(columns)
+
     def describe_table(self, db_name, tb_name, **kwargs):
         """return ResultSet 类似查询"""
         result = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name)
@@ -1010,78 +1212,31 @@ class MongoEngine(EngineBase):
         """执行查询"""
 
         result_set = ResultSet(full_sql=sql)
-        find_cmd = ""
-
-        # 提取命令中()中的内容
-        query_dict = self.parse_query_sentence(sql)
-        # 创建一个解析对象
-        de = JsonDecoder()
-
-        collection_name = query_dict["collection"]
-        if "method" in query_dict and query_dict["method"]:
-            method = query_dict["method"]
-            find_cmd = "collection." + method
-            if method == "index_information":
-                find_cmd += "()"
-        if "condition" in query_dict:
-            if method == "aggregate":
-                condition = query_dict["condition"]
-                # 给aggregate查询加limit行数限制，防止返回结果过多导致archery挂掉
-                condition.append({"$limit": limit_num})
-            if method == "find":
-                condition = de.decode(query_dict["condition"])
-            find_cmd += "(condition)"
-        if "projection" in query_dict and query_dict["projection"]:
-            projection = de.decode(query_dict["projection"])
-            find_cmd = find_cmd[:-1] + ",projection)"
-        if "sort" in query_dict and query_dict["sort"]:
-            sorting = []
-            for k, v in de.decode(query_dict["sort"]).items():
-                sorting.append((k, v))
-            find_cmd += ".sort(sorting)"
-        if (
-            method == "find"
-            and "limit" not in query_dict
-            and "explain" not in query_dict
-        ):
-            find_cmd += ".limit(limit_num)"
-        if "limit" in query_dict and query_dict["limit"]:
-            query_limit = int(query_dict["limit"])
-            limit = min(limit_num, query_limit) if query_limit else limit_num
-            find_cmd += f".limit({limit})"
-        if "skip" in query_dict and query_dict["skip"]:
-            query_skip = int(query_dict["skip"])
-            find_cmd += f".skip({query_skip})"
-        if "count" in query_dict:
-            find_cmd += ".count()"
-        if "explain" in query_dict:
-            find_cmd += ".explain()"
-
         try:
+            plan = compile_query(sql)
             conn = self.get_connection()
-            db = conn[db_name]
-            collection = db[collection_name]
+            collection = conn[db_name][plan.collection]
 
             # 执行语句
-            logger.debug(find_cmd)
-            cursor = eval(find_cmd)
+            logger.debug(plan)
+            cursor = plan.execute(collection, limit_num)
 
             columns = []
             rows = []
-            if "count" in query_dict:
+            if plan.count:
                 columns.append("count")
                 rows.append({"count": cursor})
-            elif "explain" in query_dict:  # 生成执行计划数据
+            elif plan.explain:  # 生成执行计划数据
                 columns.append("explain")
                 cursor = json.loads(json_util.dumps(cursor))  # bson转换成json
                 for k, v in cursor.items():
                     if k not in ("serverInfo", "ok"):
                         rows.append({k: v})
-            elif method == "index_information":  # 生成返回索引数据
+            elif plan.method == "index_information":  # 生成返回索引数据
                 columns.append("index_list")
                 for k, v in cursor.items():
                     rows.append({k: v})
-            elif method == "aggregate" and sql.find("$group") >= 0:  # 生成聚合数据
+            elif plan.method == "aggregate" and sql.find("$group") >= 0:  # 生成聚合数据
                 row = []
                 columns.insert(0, "mongodballdata")
                 for ro in cursor:
@@ -1098,9 +1253,9 @@ class MongoEngine(EngineBase):
                 rows = tuple(rows)
                 result_set.rows = rows
             else:
-                cursor = json.loads(json_util.dumps(cursor))
-                cols = projection if "projection" in dir() else None
-                rows, columns = self.parse_tuple(cursor, db_name, collection_name, cols)
+                rows, columns = self.parse_tuple(
+                    cursor, db_name, plan.collection, plan.projection
+                )
                 result_set.rows = rows
             result_set.column_list = columns
             result_set.affected_rows = len(rows)
@@ -1120,61 +1275,31 @@ class MongoEngine(EngineBase):
         return result_set
 
     def parse_tuple(self, cursor, db_name, tb_name, projection=None):
-        """前端bootstrap-table显示，需要转化mongo查询结果为tuple((),())的格式"""
-        columns = []
-        rows = []
-        row = []
+        """
+        前端bootstrap-table显示，需要转化mongo查询结果为tuple((),())的格式
+        文档从游标中逐条读取并转换，列为投影字段或采样字段，加上结果中出现的其他字段
+        """
         if projection:
-            for k in projection.keys():
-                columns.append(k)
+            columns = list(projection.keys())
         else:
-            result = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name)
-            columns = result.rows
-        columns.insert(0, "mongodballdata")  # 隐藏JSON结果列
-        columns = self.fill_query_columns(cursor, columns)
-
-        for ro in cursor:
-            json_col = json.dumps(
-                ro, ensure_ascii=False, indent=2, separators=(",", ":")
-            )
-            row.insert(0, json_col)
-            for key in columns[1:]:
-                if key in ro:
-                    value = ro[key]
-                    if isinstance(value, list):
-                        value = "(array) %d Elements" % len(value)
-                    re_oid = re.compile(r"{\'\$oid\': \'[0-9a-f]{24}\'}")
-                    re_date = re.compile(r"{\'\$date\': [0-9]{13}}")
-                    # 转换$oid
-                    ff = re.findall(re_oid, str(value))
-                    for ii in ff:
-                        value = str(value).replace(
-                            ii, "ObjectId(" + ii.split(":")[1].strip()[:-1] + ")"
-                        )
-                    # 转换时间戳$date
-                    dd = re.findall(re_date, str(value))
-                    for d in dd:
-                        t = int(d.split(":")[1].strip()[:-1])
-                        e = datetime.datetime.fromtimestamp(t / 1000)
-                        value = str(value).replace(
-                            d, e.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                        )
-                    row.append(str(value))
-                else:
-                    row.append("(N/A)")
-            rows.append(tuple(row))
-            row.clear()
-        return tuple(rows), columns
-
-    @staticmethod
-    def fill_query_columns(cursor, columns):
-        """补充结果集中`get_all_columns_by_tb`未获取的字段"""
-        cols = columns
+            columns = self.sampled_columns(db_name, tb_name)
+        column_set = set(columns)
+        docs = []
         for ro in cursor:
-            for key in ro.keys():
-                if key not in cols:
-                    cols.append(key)
-        return cols
+            json_col = _json_col_encoder.encode(ro)
+            values = {}
+            for key, value in ro.items():
+                if key not in column_set:
+                    column_set.add(key)
+                    columns.append(key)
+                values[key] = _display_cell(value)
+            docs.append((json_col, values))
+        rows = tuple(
+            (json_col, *[values.get(key, "(N/A)") for key in columns])
+            for json_col, values in docs
+        )
+        columns.insert(0, "mongodballdata")  # 隐藏JSON结果列
+        return rows, columns
 
     def current_op(self, command_type):
         """
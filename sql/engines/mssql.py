@@ -186,40 +186,42 @@ i.index_id = t.index_id and t.is_included_column = 0 order by key_ordinal for xm
         AND     td.minor_id = 0
         AND     td.name = 'MS_Description'
         WHERE t.type = 'u' ORDER BY t.name;"""
-        result = self.query(db_name=db_name, sql=sql)
+        result = self.query(db_name=db_name, sql=sql, close_conn=False)
         # query result to dict
         tbs = []
         for row in result.rows:
             tbs.append(dict(zip(result.column_list, row)))
-        table_metas = []
-        for tb in tbs:
-            _meta = dict()
-            engine_keys = [
-                {"key": "COLUMN_NAME", "value": "字段名"},
-                {"key": "COLUMN_TYPE", "value": "数据类型"},
-                {"key": "COLLATION_NAME", "value": "列字符集"},
-                {"key": "IS_NULLABLE", "value": "允许非空"},
-                {"key": "COLUMN_DEFAULT", "value": "默认值"},
-            ]
-            _meta["ENGINE_KEYS"] = engine_keys
-            _meta["TABLE_INFO"] = tb
-            sql_cols = f"""select COLUMN_NAME, case when ISNUMERIC(CHARACTER_MAXIMUM_LENGTH)=1 
+        # 所有表的字段一次查询后按表分组
+        sql_cols = """select TABLE_NAME, COLUMN_NAME, case when ISNUMERIC(CHARACTER_MAXIMUM_LENGTH)=1 
 then DATA_TYPE + '(' + convert(varchar(max), CHARACTER_MAXIMUM_LENGTH) + ')' else DATA_TYPE end COLUMN_TYPE,
                 COLLATION_NAME,
                 IS_NULLABLE,
                 COLUMN_DEFAULT
-            from INFORMATION_SCHEMA.columns where TABLE_CATALOG=? and TABLE_NAME = '{tb["TABLE_NAME"]}';"""
-            query_result = self.query(
-                db_name=db_name, sql=sql_cols, close_conn=False, parameters=(db_name,)
-            )
-
-            columns = []
+            from INFORMATION_SCHEMA.columns where TABLE_CATALOG=?
+            order by TABLE_NAME, ORDINAL_POSITION;"""
+        query_result = self.query(
+            db_name=db_name, sql=sql_cols, close_conn=False, parameters=(db_name,)
+        )
+        tb_cols = {}
+        for row in query_result.rows:
             # 转换查询结果为dict
-            for row in query_result.rows:
-                columns.append(dict(zip(query_result.column_list, row)))
-            _meta["COLUMNS"] = tuple(columns)
-            table_metas.append(_meta)
-        return table_metas
+            column = dict(zip(query_result.column_list, row))
+            tb_cols.setdefault(column.pop("TABLE_NAME"), []).append(column)
+        engine_keys = [
+            {"key": "COLUMN_NAME", "value": "字段名"},
+            {"key": "COLUMN_TYPE", "value": "数据类型"},
+            {"key": "COLLATION_NAME", "value": "列字符集"},
+            {"key": "IS_NULLABLE", "value": "允许非空"},
+            {"key": "COLUMN_DEFAULT", "value": "默认值"},
+        ]
+        return [
+            {
+                "ENGINE_KEYS": engine_keys,
+                "TABLE_INFO": tb,
+                "COLUMNS": tuple(tb_cols.get(tb["TABLE_NAME"], ())),
+            }
+            for tb in tbs
+        ]
 
     def get_all_columns_by_tb(self, db_name, tb_name, **kwargs):
         """获取所有字段, 返回一个ResultSet"""
@@ -1,4 +1,5 @@
 # -*- coding: UTF-8 -*-
+import hashlib
 import logging
 import traceback
 import MySQLdb
@@ -14,11 +15,19 @@ from sql.engines.goinception import GoInceptionEngine
 from sql.utils.sql_utils import get_syntax_type, remove_comments
 from . import EngineBase
 from .models import ResultSet, ReviewResult, ReviewSet
-from sql.utils.data_masking import data_masking
+from sql.utils.connection_pool import changes_session_state, get_pool, pool_enabled
+from sql.utils.data_masking import (
+    data_masking,
+    data_masking_stream,
+    prefetch_masking,
+)
 from common.config import SysConfig
 
 logger = logging.getLogger("default")
 
+# 获取账号权限时每次请求合并发送的SHOW GRANTS语句数
+SHOW_GRANTS_BATCH_SIZE = 200
+
 # https://github.com/mysql/mysql-connector-python/blob/master/lib/mysql/connector/constants.py#L168
 column_types_map = {
     0: "DECIMAL",
@@ -59,6 +68,14 @@ class MysqlEngine(EngineBase):
         super().__init__(instance=instance)
         self.config = SysConfig()
         self.inc_engine = GoInceptionEngine()
+        self._pool = None
+        self._conn_broken = False
+        # 当前连接执行过修改会话状态的语句，归还时不放回连接池
+        self._session_changed = False
+        # 当前连接建立时的默认库
+        self._conn_db = None
+        # 当前会话已设置的max_execution_time，避免同一会话重复设置
+        self._session_max_execution_time = None
 
     def get_connection(self, db_name=None):
         # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
@@ -67,27 +84,37 @@ class MysqlEngine(EngineBase):
         if self.conn:
             self.thread_id = self.conn.thread_id()
             return self.conn
+        conn_params = dict(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            passwd=self.password,
+            charset=self.instance.charset or "utf8mb4",
+            conv=conversions,
+            connect_timeout=10,
+        )
         if db_name:
-            self.conn = MySQLdb.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                passwd=self.password,
-                db=db_name,
-                charset=self.instance.charset or "utf8mb4",
-                conv=conversions,
-                connect_timeout=10,
+            conn_params["db"] = db_name
+        self._conn_db = db_name or ""
+        # 隧道回收或重建后本地端口会变化，不放入连接池
+        if pool_enabled() and not self.instance.tunnel:
+            pool_key = (
+                "mysql",
+                self.host,
+                self.port,
+                self.user,
+                hashlib.sha1(str(self.password).encode()).hexdigest(),
+                conn_params["charset"],
+                db_name or "",
             )
-        else:
-            self.conn = MySQLdb.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                passwd=self.password,
-                charset=self.instance.charset or "utf8mb4",
-                conv=conversions,
-                connect_timeout=10,
+            self._pool = get_pool(
+                pool_key,
+                lambda: MySQLdb.connect(**conn_params),
+                label=f"{self.instance_name}/{db_name or ''}",
             )
+            self.conn = self._pool.acquire()
+        else:
+            self.conn = MySQLdb.connect(**conn_params)
         self.thread_id = self.conn.thread_id()
         return self.conn
 
@@ -117,6 +144,28 @@ class MysqlEngine(EngineBase):
             else None
         )
 
+    def prepare_query_session(self, db_name=None, max_execution_time=0):
+        """在查询会话上一次性设置max_execution_time并获取主从延迟"""
+        conn = self.get_connection(db_name=db_name)
+        cursor = conn.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            cursor.execute(
+                f"set session max_execution_time={max_execution_time};show slave status;"
+            )
+            cursor.nextset()
+            slave_status = cursor.fetchall()
+        except MySQLdb.Error:
+            # 不支持max_execution_time或show slave status的版本，单独获取主从延迟
+            self._session_max_execution_time = max_execution_time
+            return self.seconds_behind_master
+        finally:
+            try:
+                cursor.close()
+            except MySQLdb.Error:
+                pass
+        self._session_max_execution_time = max_execution_time
+        return slave_status[0].get("Seconds_Behind_Master") if slave_status else None
+
     @property
     def server_version(self):
         def numeric_part(s):
@@ -255,7 +304,7 @@ class MysqlEngine(EngineBase):
         return {"column_list": _index_data.column_list, "rows": _index_data.rows}
 
     def get_tables_metas_data(self, db_name, **kwargs):
-        """获取数据库所有表格信息，用作数据字典导出接口"""
+        """获取数据库所有表格信息，用作数据字典导出接口，所有表的字段一次查询后按表分组"""
         sql_tbs = (
             f"SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA=%(db_name)s;"
         )
@@ -265,27 +314,35 @@ class MysqlEngine(EngineBase):
             close_conn=False,
             parameters={"db_name": db_name},
         ).rows
-        table_metas = []
-        for tb in tbs:
-            _meta = dict()
-            engine_keys = [
-                {"key": "COLUMN_NAME", "value": "字段名"},
-                {"key": "COLUMN_TYPE", "value": "数据类型"},
-                {"key": "COLUMN_DEFAULT", "value": "默认值"},
-                {"key": "IS_NULLABLE", "value": "允许非空"},
-                {"key": "EXTRA", "value": "自动递增"},
-                {"key": "COLUMN_KEY", "value": "是否主键"},
-                {"key": "COLUMN_COMMENT", "value": "备注"},
-            ]
-            _meta["ENGINE_KEYS"] = engine_keys
-            _meta["TABLE_INFO"] = tb
-            sql_cols = f"""SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                            WHERE TABLE_SCHEMA='{tb['TABLE_SCHEMA']}' AND TABLE_NAME='{tb['TABLE_NAME']}';"""
-            _meta["COLUMNS"] = self.query(
-                sql=sql_cols, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False
-            ).rows
-            table_metas.append(_meta)
-        return table_metas
+        sql_cols = """SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                        WHERE TABLE_SCHEMA=%(db_name)s
+                        ORDER BY TABLE_NAME, ORDINAL_POSITION;"""
+        cols = self.query(
+            sql=sql_cols,
+            cursorclass=MySQLdb.cursors.DictCursor,
+            close_conn=False,
+            parameters={"db_name": db_name},
+        ).rows
+        tb_cols = {}
+        for col in cols:
+            tb_cols.setdefault(col["TABLE_NAME"], []).append(col)
+        engine_keys = [
+            {"key": "COLUMN_NAME", "value": "字段名"},
+            {"key": "COLUMN_TYPE", "value": "数据类型"},
+            {"key": "COLUMN_DEFAULT", "value": "默认值"},
+            {"key": "IS_NULLABLE", "value": "允许非空"},
+            {"key": "EXTRA", "value": "自动递增"},
+            {"key": "COLUMN_KEY", "value": "是否主键"},
+            {"key": "COLUMN_COMMENT", "value": "备注"},
+        ]
+        return [
+            {
+                "ENGINE_KEYS": engine_keys,
+                "TABLE_INFO": tb,
+                "COLUMNS": tuple(tb_cols.get(tb["TABLE_NAME"], ())),
+            }
+            for tb in tbs
+        ]
 
     def get_bind_users(self, db_name: str):
         sql_get_bind_users = f"""select group_concat(distinct(GRANTEE)),TABLE_SCHEMA
@@ -299,6 +356,19 @@ class MysqlEngine(EngineBase):
             parameters={"db_name": db_name},
         ).rows
 
+    def get_all_bind_users(self):
+        """获取所有库关联的用户，一次查询后按库分组"""
+        sql_get_bind_users = """select TABLE_SCHEMA,GRANTEE
+                from information_schema.SCHEMA_PRIVILEGES
+                group by TABLE_SCHEMA,GRANTEE
+                order by TABLE_SCHEMA,GRANTEE;"""
+        bind_users = {}
+        for db_name, grantee in self.query(
+            "information_schema", sql_get_bind_users, close_conn=False
+        ).rows:
+            bind_users.setdefault(db_name, []).append(grantee)
+        return bind_users
+
     def get_all_databases_summary(self):
         """实例数据库管理功能，获取实例所有的数据库描述信息"""
         # 获取所有数据库
@@ -309,20 +379,49 @@ class MysqlEngine(EngineBase):
         if not query_result.error:
             dbs = query_result.rows
             # 获取数据库关联用户信息
+            bind_users = self.get_all_bind_users()
             rows = []
             for db in dbs:
-                bind_users = self.get_bind_users(db_name=db[0])
                 row = {
                     "db_name": db[0],
                     "charset": db[1],
                     "collation": db[2],
-                    "grantees": bind_users[0][0].split(",") if bind_users else [],
+                    "grantees": bind_users.get(db[0], []),
                     "saved": False,
                 }
                 rows.append(row)
             query_result.rows = rows
         return query_result
 
+    def get_users_grants(self, user_hosts):
+        """
+        批量获取账号权限，每批SHOW GRANTS语句合并为一次多语句请求后逐个读取结果集，
+        批内有语句报错时该批退回逐条查询，返回{user_host: grants}
+        """
+        grants = {}
+        for i in range(0, len(user_hosts), SHOW_GRANTS_BATCH_SIZE):
+            batch = user_hosts[i : i + SHOW_GRANTS_BATCH_SIZE]
+            sql = "".join(f"show grants for {user_host};" for user_host in batch)
+            try:
+                cursor = self.get_connection(db_name="mysql").cursor()
+                try:
+                    cursor.execute(sql)
+                    for user_host in batch:
+                        grants[user_host] = cursor.fetchall()
+                        cursor.nextset()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                logger.warning(f"批量获取账号权限报错，退回逐条查询，错误信息{e}")
+                if isinstance(e, (MySQLdb.OperationalError, MySQLdb.InterfaceError)):
+                    self._conn_broken = True
+                    self.close()
+                for user_host in batch:
+                    grants[user_host] = self.query(
+                        "mysql", f"show grants for {user_host};", close_conn=False
+                    ).rows
+        return grants
+
     def get_instance_users_summary(self):
         """实例账号管理功能，获取实例所有账号信息"""
         server_version = self.server_version
@@ -331,21 +430,19 @@ class MysqlEngine(EngineBase):
             sql_get_user = "select concat('`', user, '`', '@', '`', host,'`') as query,user,host,account_locked from mysql.user;"
         else:
             sql_get_user = "select concat('`', user, '`', '@', '`', host,'`') as query,user,host from mysql.user;"
-        query_result = self.query("mysql", sql_get_user)
+        query_result = self.query("mysql", sql_get_user, close_conn=False)
         if not query_result.error:
             db_users = query_result.rows
             # 获取用户权限信息
+            user_grants = self.get_users_grants([db_user[0] for db_user in db_users])
             rows = []
             for db_user in db_users:
                 user_host = db_user[0]
-                user_priv = self.query(
-                    "mysql", "show grants for {};".format(user_host), close_conn=False
-                ).rows
                 row = {
                     "user_host": user_host,
                     "user": db_user[1],
                     "host": db_user[2],
-                    "privileges": user_priv,
+                    "privileges": user_grants[user_host],
                     "saved": False,
                     "is_locked": db_user[3] if server_version >= (5, 7, 6) else None,
                 }
@@ -460,11 +557,9 @@ class MysqlEngine(EngineBase):
         try:
             conn = self.get_connection(db_name=db_name)
             conn.autocommit(True)
+            self._track_session_state(sql)
             cursor = conn.cursor(cursorclass)
-            try:
-                cursor.execute(f"set session max_execution_time={max_execution_time};")
-            except MySQLdb.OperationalError:
-                pass
+            self._set_max_execution_time(cursor, max_execution_time)
             effect_row = cursor.execute(sql, parameters)
             if int(limit_num) > 0:
                 rows = cursor.fetchmany(size=int(limit_num))
@@ -483,11 +578,140 @@ class MysqlEngine(EngineBase):
         except Exception as e:
             logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
             result_set.error = str(e)
+            # 连接已断开或被kill，不能再放回连接池
+            if isinstance(e, (MySQLdb.OperationalError, MySQLdb.InterfaceError)):
+                self._conn_broken = True
         finally:
             if close_conn:
                 self.close()
         return result_set
 
+    def _track_session_state(self, sql):
+        """记录连接是否执行过修改会话状态的语句，如use、set、创建临时表"""
+        if changes_session_state(sql):
+            self._session_changed = True
+
+    def _set_max_execution_time(self, cursor, max_execution_time):
+        """设置会话的max_execution_time，会话中已经是该值时跳过"""
+        if max_execution_time == self._session_max_execution_time:
+            return
+        try:
+            cursor.execute(f"set session max_execution_time={max_execution_time};")
+        except MySQLdb.OperationalError:
+            pass
+        self._session_max_execution_time = max_execution_time
+
+    def query_batch(self, db_name=None, sqls=()):
+        """
+        多条互不依赖的只读语句合并为一次多语句请求，按顺序返回每条语句的ResultSet
+        合并执行报错时退回逐条执行，每条语句的报错记录在各自的ResultSet中
+        """
+        sqls = [sql.strip().rstrip(";") for sql in sqls]
+        # 已持有的连接不在目标库时归还，重新获取目标库的连接，不在连接上切换库
+        if self.conn and db_name and self._conn_db != db_name:
+            self.close()
+        results = []
+        try:
+            conn = self.get_connection(db_name=db_name)
+            conn.autocommit(True)
+            self._track_session_state(";".join(sqls))
+            cursor = conn.cursor()
+            try:
+                cursor.execute(";".join(sqls))
+                for index, sql in enumerate(sqls):
+                    if index > 0:
+                        cursor.nextset()
+                    fields = cursor.description
+                    rows = cursor.fetchall()
+                    result_set = ResultSet(full_sql=sql)
+                    result_set.column_list = [i[0] for i in fields] if fields else []
+                    result_set.column_type = (
+                        [column_types_map.get(i[1], "") for i in fields]
+                        if fields
+                        else []
+                    )
+                    result_set.rows = rows
+                    results.append(result_set)
+            finally:
+                cursor.close()
+        except Exception as e:
+            logger.warning(f"MySQL多语句合并执行报错，退回逐条执行，错误信息{e}")
+            if isinstance(e, (MySQLdb.OperationalError, MySQLdb.InterfaceError)):
+                self._conn_broken = True
+                self.close()
+            results = [
+                self.query(db_name=db_name, sql=sql, close_conn=False) for sql in sqls
+            ]
+        return results
+
+    def query_stream(
+        self, db_name=None, sql="", limit_num=0, chunk_size=1000, **kwargs
+    ):
+        """
+        使用服务端游标流式查询，返回ResultSet，rows为按chunk_size分批产出行数据的生成器
+        结果集不在客户端缓存，生成器读取完毕或关闭时释放游标和连接，期间连接不能执行其他语句
+        kwargs中的before_release在释放连接前调用，返回False时连接不放回连接池，如查询终止任务已触发
+        """
+        result_set = ResultSet(full_sql=sql)
+        max_execution_time = kwargs.get("max_execution_time", 0)
+        before_release = kwargs.get("before_release")
+        try:
+            conn = self.get_connection(db_name=db_name)
+            conn.autocommit(True)
+            cursor = conn.cursor()
+            self._set_max_execution_time(cursor, max_execution_time)
+            cursor.close()
+            self._track_session_state(sql)
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql)
+            fields = cursor.description
+            result_set.column_list = [i[0] for i in fields] if fields else []
+            result_set.column_type = (
+                [column_types_map.get(i[1], "") for i in fields] if fields else []
+            )
+        except Exception as e:
+            logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set.error = str(e)
+            if isinstance(e, (MySQLdb.OperationalError, MySQLdb.InterfaceError)):
+                self._conn_broken = True
+            self._release_stream(before_release)
+            return result_set
+        result_set.rows = self._fetch_chunks(
+            cursor, int(limit_num), chunk_size, before_release
+        )
+        return result_set
+
+    def _release_stream(self, before_release=None):
+        """流式查询结束后释放连接"""
+        if before_release and not before_release():
+            self._conn_broken = True
+        self.close()
+
+    def _fetch_chunks(self, cursor, limit_num, chunk_size, before_release=None):
+        """从服务端游标分批读取，最多读取limit_num行"""
+        fetched, exhausted = 0, False
+        try:
+            while not limit_num or fetched < limit_num:
+                size = min(chunk_size, limit_num - fetched) if limit_num else chunk_size
+                rows = cursor.fetchmany(size)
+                fetched += len(rows)
+                if len(rows) < size:
+                    exhausted = True
+                if rows:
+                    yield rows
+                if exhausted:
+                    break
+        except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+            self._conn_broken = True
+            raise
+        finally:
+            if exhausted:
+                cursor.close()
+            else:
+                # 未读取完的结果集关闭游标时需要读完剩余数据，直接丢弃连接
+                self._conn_broken = True
+            self._release_stream(before_release)
+
     def query_check(self, db_name=None, sql=""):
         # 查询语句的检查、注释去除、切分
         result = {"msg": "", "bad_query": False, "filtered_sql": sql, "has_star": False}
@@ -506,8 +730,11 @@ class MysqlEngine(EngineBase):
             result["has_star"] = True
             result["msg"] = "SQL语句中含有 * "
         # select语句先使用Explain判断语法是否正确
+        # 保留会话，供后续查询复用
         if re.match(r"^select", sql, re.I):
-            explain_result = self.query(db_name=db_name, sql=f"explain {sql}")
+            explain_result = self.query(
+                db_name=db_name, sql=f"explain {sql}", close_conn=False
+            )
             if explain_result.error:
                 result["bad_query"] = True
                 result["msg"] = explain_result.error
@@ -524,6 +751,8 @@ class MysqlEngine(EngineBase):
             result["bad_query"] = True
             result["msg"] = "您无权查看该表"
 
+        if result["bad_query"]:
+            self.close()
         return result
 
     def filter_sql(self, sql="", limit_num=0):
@@ -556,6 +785,17 @@ class MysqlEngine(EngineBase):
             sql = f"{sql};"
         return sql
 
+    def prefetch_query_masking(self, db_name=None, sql=""):
+        """提前通过goInception获取select list，与查询并行执行"""
+        if re.match(r"^select", sql, re.I):
+            prefetch_masking(self.instance, db_name, sql)
+
+    def query_masking_stream(self, db_name=None, sql="", resultset=None):
+        """流式结果集按批次脱敏，仅对select语句脱敏"""
+        if re.match(r"^select", sql, re.I):
+            return data_masking_stream(self.instance, db_name, sql, resultset)
+        return resultset
+
     def query_masking(self, db_name=None, sql="", resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
@@ -649,6 +889,7 @@ class MysqlEngine(EngineBase):
         """原生执行语句"""
         result = ResultSet(full_sql=sql)
         conn = self.get_connection(db_name=db_name)
+        self._track_session_state(sql)
         try:
             cursor = conn.cursor()
             for statement in sqlparse.split(sql):
@@ -868,7 +1109,20 @@ class MysqlEngine(EngineBase):
 
         return self.query("information_schema", sql)
 
+    def discard_connection(self):
+        self._conn_broken = True
+        self.close()
+
     def close(self):
         if self.conn:
-            self.conn.close()
+            if self._pool:
+                self._pool.release(
+                    self.conn, broken=self._conn_broken or self._session_changed
+                )
+            else:
+                self.conn.close()
             self.conn = None
+            self._conn_broken = False
+            self._session_changed = False
+            self._conn_db = None
+            self._session_max_execution_time = None
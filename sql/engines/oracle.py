@@ -5,16 +5,18 @@ import traceback
 import re
 import sqlparse
 import MySQLdb
-import simplejson as json
 import threading
-import pandas as pd
+from contextlib import contextmanager
+from django.conf import settings
 from common.config import SysConfig
 from common.utils.timer import FuncTimer
+from sql.utils.connection_pool import pooled_connection
 from sql.utils.sql_utils import (
     get_syntax_type,
     get_full_sqlitem_list,
     get_exec_sqlitem_list,
 )
+from sql.utils.execute_progress import execute_by_chunk, execute_chunk_size
 from . import EngineBase
 import cx_Oracle
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -22,6 +24,22 @@ from sql.utils.data_masking import simple_column_mask
 
 logger = logging.getLogger("default")
 
+# 已经创建过ora_backup库表的备份库，进程内每个备份库只初始化一次
+_backup_schema_ready = set()
+_backup_schema_lock = threading.Lock()
+
+_backup_schema_sql = (
+    "create database if not exists ora_backup;",
+    """CREATE TABLE if not exists ora_backup.`sql_rollback` (
+           `id` bigint(20) NOT NULL AUTO_INCREMENT,
+           `redo_sql` mediumtext,
+           `undo_sql` mediumtext,
+           `workflow_id` bigint(20) NOT NULL,
+            PRIMARY KEY (`id`),
+            key `idx_sql_rollback_01` (`workflow_id`)
+         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;""",
+)
+
 
 class OracleEngine(EngineBase):
     test_query = "SELECT 1 FROM DUAL"
@@ -62,13 +80,13 @@ class OracleEngine(EngineBase):
 
     @staticmethod
     def get_backup_connection():
-        """备份库连接"""
+        """备份库连接，首次连接时创建ora_backup库表，返回的连接已切换到ora_backup库"""
         archer_config = SysConfig()
         backup_host = archer_config.get("inception_remote_backup_host")
         backup_port = int(archer_config.get("inception_remote_backup_port", 3306))
         backup_user = archer_config.get("inception_remote_backup_user")
         backup_password = archer_config.get("inception_remote_backup_password")
-        return MySQLdb.connect(
+        conn = MySQLdb.connect(
             host=backup_host,
             port=backup_port,
             user=backup_user,
@@ -76,6 +94,67 @@ class OracleEngine(EngineBase):
             charset="utf8mb4",
             autocommit=True,
         )
+        key = (backup_host, backup_port)
+        if key not in _backup_schema_ready:
+            with _backup_schema_lock:
+                if key not in _backup_schema_ready:
+                    cursor = conn.cursor()
+                    for sql in _backup_schema_sql:
+                        cursor.execute(sql)
+                    cursor.close()
+                    _backup_schema_ready.add(key)
+        conn.select_db("ora_backup")
+        return conn
+
+    @contextmanager
+    def backup_cursor(self):
+        """备份库游标，开启连接池时复用备份库连接"""
+        archer_config = SysConfig()
+        backup_host = archer_config.get("inception_remote_backup_host")
+        backup_port = int(archer_config.get("inception_remote_backup_port", 3306))
+        backup_user = archer_config.get("inception_remote_backup_user")
+        try:
+            with pooled_connection(
+                ("ora_backup", backup_host, backup_port, backup_user),
+                self.get_backup_connection,
+                label=f"ora_backup {backup_host}:{backup_port}",
+                errors=MySQLdb.Error,
+            ) as conn:
+                yield conn.cursor()
+        except MySQLdb.Error:
+            # 备份库表可能被删除，下次连接时重新初始化
+            _backup_schema_ready.clear()
+            raise
+
+    @staticmethod
+    def save_rollback(backup_cursor, cursor, workflow_id, redo_sql=None):
+        """
+        分批读取cursor中的回滚语句，参数化批量写入备份库
+        :param backup_cursor: 备份库游标
+        :param cursor: 已执行查询的游标，每行为(redo_sql, undo_sql)，指定redo_sql时每行为(undo_sql,)
+        :param workflow_id: 工单id
+        :param redo_sql: 所有回滚语句对应的执行语句
+        :return: 写入的行数
+        """
+        batch_size = settings.ROLLBACK_BATCH_SIZE
+        sql = "insert into sql_rollback(redo_sql,undo_sql,workflow_id) values(%s,%s,%s)"
+        count = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if redo_sql is not None:
+                rows = [(redo_sql, row[0]) for row in rows]
+            # LOB只在当前批次内有效，写入前转换为字符串
+            backup_cursor.executemany(
+                sql,
+                [
+                    (f"{redo}", " " if undo is None else f"{undo}", workflow_id)
+                    for redo, undo in rows
+                ],
+            )
+            count += len(rows)
+        return count
 
     @property
     def server_version(self):
@@ -343,44 +422,40 @@ class OracleEngine(EngineBase):
         ).rows
 
         # 给查询结果定义列名，query_engine.query的游标是0 1 2
-        cols_df = pd.DataFrame(
-            cols_req,
-            columns=[
-                "TABLE_NAME",
-                "TABLE_COMMENTS",
-                "COLUMN_NAME",
-                "COLUMN_TYPE",
-                "COLUMN_DEFAULT",
-                "IS_NULLABLE",
-                "COLUMN_KEY",
-                "COLUMN_COMMENT",
-            ],
-        )
-
-        # 获得表名称去重
-        col_list = cols_df.drop_duplicates("TABLE_NAME").to_dict("records")
-        for cl in col_list:
-            _meta = dict()
-            engine_keys = [
-                {"key": "COLUMN_NAME", "value": "字段名"},
-                {"key": "COLUMN_TYPE", "value": "数据类型"},
-                {"key": "COLUMN_DEFAULT", "value": "默认值"},
-                {"key": "IS_NULLABLE", "value": "允许非空"},
-                {"key": "COLUMN_KEY", "value": "是否主键"},
-                {"key": "COLUMN_COMMENT", "value": "备注"},
-            ]
-            _meta["ENGINE_KEYS"] = engine_keys
-            _meta["TABLE_INFO"] = {
-                "TABLE_NAME": cl["TABLE_NAME"],
-                "TABLE_COMMENTS": cl["TABLE_COMMENTS"],
-            }
-            table_name = cl["TABLE_NAME"]
-            # 查询DataFrame中满足表名的记录，并转为list
-            _meta["COLUMNS"] = cols_df.query("TABLE_NAME == @table_name").to_dict(
-                "records"
-            )
-
-            table_metas.append(_meta)
+        column_names = [
+            "TABLE_NAME",
+            "TABLE_COMMENTS",
+            "COLUMN_NAME",
+            "COLUMN_TYPE",
+            "COLUMN_DEFAULT",
+            "IS_NULLABLE",
+            "COLUMN_KEY",
+            "COLUMN_COMMENT",
+        ]
+        engine_keys = [
+            {"key": "COLUMN_NAME", "value": "字段名"},
+            {"key": "COLUMN_TYPE", "value": "数据类型"},
+            {"key": "COLUMN_DEFAULT", "value": "默认值"},
+            {"key": "IS_NULLABLE", "value": "允许非空"},
+            {"key": "COLUMN_KEY", "value": "是否主键"},
+            {"key": "COLUMN_COMMENT", "value": "备注"},
+        ]
+        # 结果已按表名排序，一次遍历按表分组
+        tb_metas = {}
+        for row in cols_req:
+            col = dict(zip(column_names, row))
+            _meta = tb_metas.get(col["TABLE_NAME"])
+            if _meta is None:
+                _meta = tb_metas[col["TABLE_NAME"]] = {
+                    "ENGINE_KEYS": engine_keys,
+                    "TABLE_INFO": {
+                        "TABLE_NAME": col["TABLE_NAME"],
+                        "TABLE_COMMENTS": col["TABLE_COMMENTS"],
+                    },
+                    "COLUMNS": [],
+                }
+            _meta["COLUMNS"].append(col)
+        table_metas.extend(tb_metas.values())
         return table_metas
 
     def get_all_objects(self, db_name, **kwargs):
@@ -1077,6 +1152,13 @@ class OracleEngine(EngineBase):
                 check_result.error_count += 1
         return check_result
 
+    @staticmethod
+    def is_session_statement(sqlitem):
+        """alter session修改会话状态，分批执行继续时需要在新会话中重放"""
+        return sqlitem.stmt_type == "SQL" and bool(
+            re.match(r"^\s*alter\s+session\s+", sqlitem.statement, re.I)
+        )
+
     def execute_workflow(self, workflow, close_conn=True):
         """执行上线单，返回Review set
         原来的逻辑是根据 sql_content简单来分割SQL，进而再执行这些SQL
@@ -1084,7 +1166,7 @@ class OracleEngine(EngineBase):
         如果是PLSQL存储过程等对象定义操作，还需检查确认新建对象是否编译通过!
         """
         review_content = workflow.sqlworkflowcontent.review_content
-        review_result = json.loads(review_content)
+        review_result = ReviewSet.load_rows(review_content)
         sqlitemList = get_exec_sqlitem_list(review_result, workflow.db_name)
 
         sql = workflow.sqlworkflowcontent.sql_content
@@ -1101,8 +1183,9 @@ class OracleEngine(EngineBase):
             cursor.execute(f"select sysdate from dual")
             rows = cursor.fetchone()
             begin_time = rows[0]
-            # 逐条执行切分语句，追加到执行结果中
-            for sqlitem in sqlitemList:
+
+            def execute_statement(sqlitem, autocommit=False):
+                """执行单条语句，PLSQL对象定义需检查编译结果"""
                 statement = sqlitem.statement
                 if sqlitem.stmt_type == "SQL":
                     statement = statement.rstrip(";")
@@ -1120,9 +1203,9 @@ class OracleEngine(EngineBase):
                 with FuncTimer() as t:
                     if statement != "":
                         cursor.execute(statement)
-                        conn.commit()
+                        if autocommit:
+                            conn.commit()
 
-                rowcount = cursor.rowcount
                 stagestatus = "Execute Successfully"
                 if (
                     sqlitem.stmt_type == "PLSQL"
@@ -1158,17 +1241,48 @@ class OracleEngine(EngineBase):
                     if stagestatus != "Execute Successfully":
                         raise Exception(stagestatus)
 
-                execute_result.rows.append(
-                    ReviewResult(
-                        id=line,
-                        errlevel=0,
-                        stagestatus=stagestatus,
-                        errormessage="None",
-                        sql=statement,
-                        affected_rows=cursor.rowcount,
-                        execute_time=t.cost,
-                    )
+                return ReviewResult(
+                    errlevel=0,
+                    stagestatus=stagestatus,
+                    errormessage="None",
+                    sql=statement,
+                    affected_rows=cursor.rowcount,
+                    execute_time=t.cost,
                 )
+
+            chunk_size = execute_chunk_size()
+            if chunk_size > 0:
+                # DDL会隐式提交，DDL工单逐条提交并记录进度
+                if workflow.syntax_type == 1:
+                    chunk_size = 1
+                # 日志挖掘只能获取当前会话的变更，继续执行时之前会话已提交的语句无法生成回滚语句
+                resume_blocked = ""
+                if workflow.is_backup:
+                    resume_blocked = "开启备份的工单继续执行无法生成已提交语句的回滚语句，请确认后人工处理"
+                execute_by_chunk(
+                    workflow,
+                    sqlitemList,
+                    execute_statement,
+                    commit=conn.commit,
+                    rollback=conn.rollback,
+                    execute_result=execute_result,
+                    chunk_size=chunk_size,
+                    statement_sql=lambda sqlitem: sqlitem.statement,
+                    session_statement=self.is_session_statement,
+                    replay_statement=lambda sqlitem: cursor.execute(
+                        sqlitem.statement.rstrip(";")
+                    ),
+                    resume_blocked=resume_blocked,
+                )
+                return execute_result
+            # 逐条执行切分语句，追加到执行结果中
+            for sqlitem in sqlitemList:
+                statement = sqlitem.statement
+                if sqlitem.stmt_type == "SQL":
+                    statement = statement.rstrip(";")
+                result = execute_statement(sqlitem, autocommit=True)
+                result.id = line
+                execute_result.rows.append(result)
                 line += 1
         except Exception as e:
             logger.warning(
@@ -1238,62 +1352,36 @@ class OracleEngine(EngineBase):
         # 需为归档模式;开启附件日志会增加redo日志量,一般不会有多大影响，需评估归档磁盘空间，redo磁盘IO性能
         try:
             # 备份存放数据库和MySQL备份库统一，需新建备份用database和table，table存放备份SQL，记录使用workflow.id关联上线工单
-            workflow_id = workflow.id
-            conn = self.get_backup_connection()
-            backup_cursor = conn.cursor()
-            backup_cursor.execute(f"""create database if not exists ora_backup;""")
-            backup_cursor.execute(f"use ora_backup;")
-            backup_cursor.execute(
-                f"""CREATE TABLE if not exists `sql_rollback` (
-                                       `id` bigint(20) NOT NULL AUTO_INCREMENT,
-                                       `redo_sql` mediumtext,
-                                       `undo_sql` mediumtext,
-                                       `workflow_id` bigint(20) NOT NULL,
-                                        PRIMARY KEY (`id`),
-                                        key `idx_sql_rollback_01` (`workflow_id`)
-                                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
-            )
-            # 使用logminer抓取回滚SQL
-            logmnr_start_sql = f"""begin
-                                        dbms_logmnr.start_logmnr(
-                                        starttime=>to_date('{begin_time}','yyyy-mm-dd hh24:mi:ss'),
-                                        endtime=>to_date('{end_time}','yyyy/mm/dd hh24:mi:ss'),
-                                        options=>dbms_logmnr.dict_from_online_catalog + dbms_logmnr.continuous_mine);
-                                    end;"""
-            undo_sql = f"""select 
-                           xmlagg(xmlparse(content sql_redo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() ,
-                           xmlagg(xmlparse(content sql_undo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() 
-                           from v$logmnr_contents
-                           where  SEG_OWNER not in ('SYS')
-                           and session# = (select sid from v$mystat where rownum = 1)
-                           and serial# = (select serial# from v$session s where s.sid = (select sid from v$mystat where rownum = 1 ))  
-                           group by  scn,rs_id,ssn  order by scn desc"""
-            logmnr_end_sql = f"""begin
-                                    dbms_logmnr.end_logmnr;
-                                 end;"""
-            cursor.execute(logmnr_start_sql)
-            cursor.execute(undo_sql)
-            rows = cursor.fetchall()
-            cursor.execute(logmnr_end_sql)
-            if len(rows) > 0:
-                for row in rows:
-                    redo_sql = f"{row[0]}"
-                    redo_sql = redo_sql.replace("'", "\\'")
-                    if row[1] is None:
-                        undo_sql = f" "
-                    else:
-                        undo_sql = f"{row[1]}"
-                    undo_sql = undo_sql.replace("'", "\\'")
-                    # 回滚SQL入库
-                    sql = f"""insert into sql_rollback(redo_sql,undo_sql,workflow_id) values('{redo_sql}','{undo_sql}',{workflow_id});"""
-                    backup_cursor.execute(sql)
+            with self.backup_cursor() as backup_cursor:
+                # 使用logminer抓取回滚SQL
+                logmnr_start_sql = f"""begin
+                                            dbms_logmnr.start_logmnr(
+                                            starttime=>to_date('{begin_time}','yyyy-mm-dd hh24:mi:ss'),
+                                            endtime=>to_date('{end_time}','yyyy/mm/dd hh24:mi:ss'),
+                                            options=>dbms_logmnr.dict_from_online_catalog + dbms_logmnr.continuous_mine);
+                                        end;"""
+                undo_sql = f"""select 
+                               xmlagg(xmlparse(content sql_redo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() ,
+                               xmlagg(xmlparse(content sql_undo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() 
+                               from v$logmnr_contents
+                               where  SEG_OWNER not in ('SYS')
+                               and session# = (select sid from v$mystat where rownum = 1)
+                               and serial# = (select serial# from v$session s where s.sid = (select sid from v$mystat where rownum = 1 ))  
+                               group by  scn,rs_id,ssn  order by scn desc"""
+                logmnr_end_sql = f"""begin
+                                        dbms_logmnr.end_logmnr;
+                                     end;"""
+                cursor.execute(logmnr_start_sql)
+                try:
+                    cursor.arraysize = settings.ROLLBACK_BATCH_SIZE
+                    cursor.execute(undo_sql)
+                    # 回滚SQL分批入库
+                    self.save_rollback(backup_cursor, cursor, workflow.id)
+                finally:
+                    cursor.execute(logmnr_end_sql)
         except Exception as e:
             logger.warning(f"备份失败，错误信息{traceback.format_exc()}")
             return False
-        finally:
-            # 关闭连接
-            if conn:
-                conn.close()
         return True
 
     def metdata_backup(self, workflow, cursor, redo_sql):
@@ -1305,39 +1393,12 @@ class OracleEngine(EngineBase):
         """
         try:
             # 备份存放数据库和MySQL备份库统一，需新建备份用database和table，table存放备份SQL，记录使用workflow.id关联上线工单
-            workflow_id = workflow.id
-            conn = self.get_backup_connection()
-            backup_cursor = conn.cursor()
-            backup_cursor.execute(f"""create database if not exists ora_backup;""")
-            backup_cursor.execute(f"use ora_backup;")
-            backup_cursor.execute(
-                f"""CREATE TABLE if not exists `sql_rollback` (
-                                       `id` bigint(20) NOT NULL AUTO_INCREMENT,
-                                       `redo_sql` mediumtext,
-                                       `undo_sql` mediumtext,
-                                       `workflow_id` bigint(20) NOT NULL,
-                                        PRIMARY KEY (`id`),
-                                        key `idx_sql_rollback_01` (`workflow_id`)
-                                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
-            )
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                for row in rows:
-                    if row[0] is None:
-                        undo_sql = f" "
-                    else:
-                        undo_sql = f"{row[0]}"
-                    undo_sql = undo_sql.replace("'", "\\'")
-                    # 回滚SQL入库
-                    sql = f"""insert into sql_rollback(redo_sql,undo_sql,workflow_id) values('{redo_sql}','{undo_sql}',{workflow_id});"""
-                    backup_cursor.execute(sql)
+            with self.backup_cursor() as backup_cursor:
+                # 回滚SQL入库
+                self.save_rollback(backup_cursor, cursor, workflow.id, redo_sql)
         except Exception as e:
             logger.warning(f"备份失败，错误信息{traceback.format_exc()}")
             return False
-        finally:
-            # 关闭连接
-            if conn:
-                conn.close()
         return True
 
     def get_rollback(self, workflow):
@@ -1345,29 +1406,19 @@ class OracleEngine(EngineBase):
          add by Jan.song 20200402
         获取回滚语句，并且按照执行顺序倒序展示，return ['源语句'，'回滚语句']
         """
-        list_execute_result = json.loads(workflow.sqlworkflowcontent.execute_result)
-        # 回滚语句倒序展示
-        list_execute_result.reverse()
         list_backup_sql = []
         try:
-            # 创建连接
-            conn = self.get_backup_connection()
-            cur = conn.cursor()
-            sql = f"""select redo_sql,undo_sql from sql_rollback where workflow_id = {workflow.id} order by id;"""
-            cur.execute(f"use ora_backup;")
-            cur.execute(sql)
-            list_tables = cur.fetchall()
-            for row in list_tables:
-                redo_sql = row[0]
-                undo_sql = row[1]
-                # 拼接成回滚语句列表,['源语句'，'回滚语句']
-                list_backup_sql.append([redo_sql, undo_sql])
+            with self.backup_cursor() as cur:
+                cur.execute(
+                    "select redo_sql,undo_sql from sql_rollback where workflow_id = %s order by id;",
+                    (workflow.id,),
+                )
+                for redo_sql, undo_sql in cur.fetchall():
+                    # 拼接成回滚语句列表,['源语句'，'回滚语句']
+                    list_backup_sql.append([redo_sql, undo_sql])
         except Exception as e:
             logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
             raise Exception(e)
-        # 关闭连接
-        if conn:
-            conn.close()
         return list_backup_sql
 
     def sqltuningadvisor(self, db_name=None, sql="", close_conn=True, **kwargs):
@@ -13,6 +13,7 @@ import sqlparse
 
 from common.config import SysConfig
 from common.utils.timer import FuncTimer
+from sql.utils.execute_progress import execute_by_chunk, execute_chunk_size
 from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -293,6 +294,11 @@ class PgSQLEngine(EngineBase):
         # 删除注释语句，切分语句，将切换CURRENT_SCHEMA语句增加到切分结果中
         sql = sqlparse.format(sql, strip_comments=True)
         split_sql = sqlparse.split(sql)
+        chunk_size = execute_chunk_size()
+        if chunk_size > 0:
+            return self._execute_workflow_by_chunk(
+                workflow, split_sql, execute_result, chunk_size, close_conn
+            )
         line = 1
         statement = None
         db_name = workflow.db_name
@@ -354,6 +360,71 @@ class PgSQLEngine(EngineBase):
                 self.close()
         return execute_result
 
+    @staticmethod
+    def is_session_statement(statement):
+        """
+        修改会话状态的语句，如set search_path、set role，分批执行继续时需要在新会话中重放
+        set local、set transaction只在当前事务内生效，不需要重放
+        """
+        return bool(
+            re.match(r"^\s*(set|reset)\s+", statement, re.I)
+            and not re.match(r"^\s*set\s+(local|transaction)\s+", statement, re.I)
+        )
+
+    def _execute_workflow_by_chunk(
+        self, workflow, split_sql, execute_result, chunk_size, close_conn=True
+    ):
+        """分批执行上线单，每chunk_size条语句在一个事务中提交，并记录执行进度"""
+        try:
+            conn = self.get_connection(db_name=workflow.db_name)
+            cursor = conn.cursor()
+
+            def execute_statement(statement):
+                statement = statement.rstrip(";")
+                with FuncTimer() as t:
+                    cursor.execute(statement)
+                return ReviewResult(
+                    errlevel=0,
+                    stagestatus="Execute Successfully",
+                    errormessage="None",
+                    sql=statement,
+                    affected_rows=cursor.rowcount,
+                    execute_time=t.cost,
+                )
+
+            execute_by_chunk(
+                workflow,
+                split_sql,
+                execute_statement,
+                commit=conn.commit,
+                rollback=conn.rollback,
+                execute_result=execute_result,
+                chunk_size=chunk_size,
+                statement_sql=lambda statement: statement.rstrip(";"),
+                session_statement=self.is_session_statement,
+                replay_statement=lambda statement: cursor.execute(
+                    statement.rstrip(";")
+                ),
+            )
+        except Exception as e:
+            logger.warning(f"PGSQL工单分批执行报错，错误信息：{traceback.format_exc()}")
+            execute_result.error = str(e)
+            execute_result.rows.append(
+                ReviewResult(
+                    id=len(execute_result.rows) + 1,
+                    errlevel=2,
+                    stagestatus="Execute Failed",
+                    errormessage=f"异常信息：{e}",
+                    sql=execute_result.full_sql,
+                    affected_rows=0,
+                    execute_time=0,
+                )
+            )
+        finally:
+            if close_conn:
+                self.close()
+        return execute_result
+
     def close(self):
         if self.conn:
             self.conn.close()
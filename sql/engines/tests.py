@@ -4,8 +4,10 @@ from datetime import timedelta, datetime
 from unittest.mock import patch, Mock, ANY
 
 import sqlparse
+from bson.int64 import Int64
+from bson.objectid import ObjectId
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from common.config import SysConfig
 from sql.engines import EngineBase
@@ -15,11 +17,17 @@ from sql.engines.mssql import MssqlEngine
 from sql.engines.mysql import MysqlEngine
 from sql.engines.redis import RedisEngine
 from sql.engines.pgsql import PgSQLEngine
-from sql.engines.oracle import OracleEngine
-from sql.engines.mongo import MongoEngine
+from sql.engines.oracle import OracleEngine, _backup_schema_ready
+from sql.engines.mongo import MongoEngine, compile_query
 from sql.engines.clickhouse import ClickHouseEngine
 from sql.engines.odps import ODPSEngine
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent
+from sql.utils.connection_pool import clear_pools
+from sql.utils.execute_progress import (
+    clear_progress,
+    committed_rows,
+    execute_percentage,
+)
 
 User = get_user_model()
 
@@ -30,6 +38,29 @@ class TestReviewSet(TestCase):
         new_review_set.rows = [{"id": "1679123"}]
         self.assertIn("1679123", new_review_set.json())
 
+    def test_review_set_json_load(self):
+        """列式格式保存，兼容旧的[{}]和[[]]格式"""
+        review_set = ReviewSet(
+            rows=[
+                ReviewResult(id=1, sql="select 1", errormessage="中文"),
+                ReviewResult(id=2, sql="select 2", stmt_type="SQL"),
+            ]
+        )
+        content = review_set.json()
+        self.assertIn("中文", content)
+        self.assertEqual(1, content.count('"errormessage"'))
+        rows = ReviewSet.load_rows(content)
+        self.assertEqual(rows[0], {**review_set.rows[0].__dict__, "stmt_type": None})
+        self.assertEqual(rows[1]["stmt_type"], "SQL")
+        # 旧格式
+        legacy = json.dumps([r.__dict__ for r in review_set.rows])
+        self.assertEqual(ReviewSet.load_rows(legacy)[1], review_set.rows[1].__dict__)
+        inception_row = [1, "CHECKED", 0, "Audit completed", "None", "use db", 0]
+        inception_row += ["'0_0_0'", "None", "0", ""]
+        rows = ReviewSet.load_rows(json.dumps([inception_row]))
+        self.assertEqual(rows[0]["sql"], "use db")
+        self.assertEqual(ReviewSet.load_rows("[]"), [])
+
 
 class TestEngineBase(TestCase):
     @classmethod
@@ -285,6 +316,34 @@ class TestMysql(TestCase):
         new_engine.get_connection()
         connect.assert_called_once()
 
+    @override_settings(CONN_POOL={"ENABLED": True})
+    @patch("MySQLdb.connect")
+    def test_get_connection_pooled(self, connect):
+        new_engine = MysqlEngine(instance=self.ins1)
+        conn = new_engine.get_connection(db_name="some_db")
+        new_engine.close()
+        conn.close.assert_not_called()
+        new_engine = MysqlEngine(instance=self.ins1)
+        self.assertEqual(new_engine.get_connection(db_name="some_db"), conn)
+        new_engine.close()
+        connect.assert_called_once()
+        clear_pools()
+
+    @override_settings(CONN_POOL={"ENABLED": True})
+    @patch("MySQLdb.connect")
+    def test_pooled_session_changed(self, connect):
+        """执行过修改会话状态语句的连接不放回连接池"""
+        connect.side_effect = [Mock(), Mock()]
+        new_engine = MysqlEngine(instance=self.ins1)
+        conn = new_engine.get_connection(db_name="some_db")
+        new_engine.query(db_name="some_db", sql="set profiling=1", close_conn=False)
+        new_engine.close()
+        conn.close.assert_called_once()
+        new_engine = MysqlEngine(instance=self.ins1)
+        self.assertIsNot(new_engine.get_connection(db_name="some_db"), conn)
+        new_engine.close()
+        clear_pools()
+
     @patch("MySQLdb.connect")
     def testQuery(self, connect):
         cur = Mock()
@@ -330,6 +389,78 @@ class TestMysql(TestCase):
         dbs = new_engine.get_all_columns_by_tb("some_db", "some_tb")
         self.assertEqual(dbs.rows, ["col_1", "col_2"])
 
+    @patch("MySQLdb.connect")
+    def test_query_batch(self, _connect):
+        cursor = _connect.return_value.cursor.return_value
+        cursor.description = (("col", 253),)
+        cursor.fetchall.side_effect = [(), (("a",),), (("b",),)]
+        new_engine = MysqlEngine(instance=self.ins1)
+        results = new_engine.query_batch(
+            db_name="some_db", sqls=["select 'a';", "select 'b'"]
+        )
+        cursor.execute.assert_called_once_with("select 'a';select 'b'")
+        self.assertEqual(_connect.call_args.kwargs["db"], "some_db")
+        self.assertEqual([r.rows for r in results], [(("a",),), (("b",),)])
+        self.assertEqual(results[0].column_list, ["col"])
+
+    @override_settings(CONN_POOL={"ENABLED": True})
+    @patch("MySQLdb.connect")
+    def test_query_batch_switch_db(self, _connect):
+        """已持有的连接不在目标库时归还连接池，获取目标库的连接，不执行use"""
+        conn1, conn2 = Mock(), Mock()
+        conn1.cursor.return_value.description = None
+        conn2.cursor.return_value.description = None
+        _connect.side_effect = [conn1, conn2]
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.query_batch(sqls=["select 1"])
+        new_engine.query_batch(db_name="some_db", sqls=["select 2"])
+        conn1.cursor.return_value.execute.assert_called_once_with("select 1")
+        conn2.cursor.return_value.execute.assert_called_once_with("select 2")
+        self.assertNotIn("db", _connect.call_args_list[0].kwargs)
+        self.assertEqual(_connect.call_args_list[1].kwargs["db"], "some_db")
+        # 第一个连接未切换库，可以放回连接池
+        conn1.close.assert_not_called()
+        new_engine.close()
+        clear_pools()
+
+    @patch.object(MysqlEngine, "query")
+    @patch("MySQLdb.connect")
+    def test_query_batch_fallback(self, _connect, _query):
+        """合并执行报错时逐条执行"""
+        cursor = _connect.return_value.cursor.return_value
+        cursor.execute.side_effect = MySQLdb.ProgrammingError("syntax error")
+        _query.return_value = ResultSet(rows=[("a",)])
+        new_engine = MysqlEngine(instance=self.ins1)
+        results = new_engine.query_batch(sqls=["select 'a'", "select 'b'"])
+        self.assertEqual(_query.call_count, 2)
+        self.assertEqual(len(results), 2)
+
+    @patch.object(MysqlEngine, "query")
+    def test_get_tables_metas_data(self, mock_query):
+        tbs = ResultSet(
+            rows=(
+                {"TABLE_NAME": "tb_1", "TABLE_COMMENT": ""},
+                {"TABLE_NAME": "tb_2", "TABLE_COMMENT": ""},
+                {"TABLE_NAME": "tb_3", "TABLE_COMMENT": ""},
+            )
+        )
+        cols = ResultSet(
+            rows=(
+                {"TABLE_NAME": "tb_1", "COLUMN_NAME": "id"},
+                {"TABLE_NAME": "tb_1", "COLUMN_NAME": "name"},
+                {"TABLE_NAME": "tb_2", "COLUMN_NAME": "id"},
+            )
+        )
+        mock_query.side_effect = [tbs, cols]
+        new_engine = MysqlEngine(instance=self.ins1)
+        metas = new_engine.get_tables_metas_data(db_name="some_db")
+        # 表和字段各查询一次
+        self.assertEqual(mock_query.call_count, 2)
+        self.assertEqual(
+            [[c["COLUMN_NAME"] for c in tb["COLUMNS"]] for tb in metas],
+            [["id", "name"], ["id"], []],
+        )
+
     @patch.object(MysqlEngine, "query")
     def testDescribe(self, mock_query):
         new_engine = MysqlEngine(instance=self.ins1)
@@ -603,6 +734,86 @@ class TestMysql(TestCase):
             cursorclass=MySQLdb.cursors.DictCursor,
         )
 
+    @patch("MySQLdb.connect")
+    def test_prepare_query_session(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.fetchall.return_value = ({"Seconds_Behind_Master": 3},)
+        new_engine = MysqlEngine(instance=self.ins1)
+        seconds_behind_master = new_engine.prepare_query_session(
+            db_name="some_db", max_execution_time=1000
+        )
+        self.assertEqual(seconds_behind_master, 3)
+        cur.execute.assert_called_once_with(
+            "set session max_execution_time=1000;show slave status;"
+        )
+        # 同一会话内查询不再重复设置max_execution_time
+        cur.execute.reset_mock()
+        new_engine.query(db_name="some_db", sql="select 1", max_execution_time=1000)
+        cur.execute.assert_called_once_with("select 1", None)
+        connect.assert_called_once()
+
+    @patch.object(MysqlEngine, "seconds_behind_master", new=None)
+    @patch("MySQLdb.connect")
+    def test_prepare_query_session_not_support(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.execute.side_effect = MySQLdb.OperationalError
+        new_engine = MysqlEngine(instance=self.ins1)
+        seconds_behind_master = new_engine.prepare_query_session(
+            db_name="some_db", max_execution_time=1000
+        )
+        self.assertIsNone(seconds_behind_master)
+
+    @patch("MySQLdb.connect")
+    def test_prepare_query_session_slave_status_error(self, connect):
+        """show slave status报错时关闭游标并单独获取主从延迟，不影响查询"""
+        cur = connect.return_value.cursor.return_value
+        cur.nextset.side_effect = MySQLdb.ProgrammingError(1064, "syntax error")
+        new_engine = MysqlEngine(instance=self.ins1)
+        with patch.object(MysqlEngine, "seconds_behind_master", new=None):
+            seconds_behind_master = new_engine.prepare_query_session(
+                db_name="some_db", max_execution_time=1000
+            )
+        self.assertIsNone(seconds_behind_master)
+        cur.close.assert_called()
+
+    @patch("MySQLdb.connect")
+    def test_query_stream(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.description = (("some", 253),)
+        cur.fetchmany.side_effect = [[(1,), (2,)], [(3,)]]
+        new_engine = MysqlEngine(instance=self.ins1)
+        query_result = new_engine.query_stream(
+            db_name="some_db", sql="select some from some_table", chunk_size=2
+        )
+        self.assertListEqual(query_result.column_list, ["some"])
+        self.assertListEqual(list(query_result.rows), [[(1,), (2,)], [(3,)]])
+        connect.return_value.close.assert_called_once()
+        self.assertIsNone(new_engine.conn)
+
+    @patch("MySQLdb.connect")
+    def test_query_stream_limit(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.description = (("some", 253),)
+        cur.fetchmany.side_effect = [[(1,), (2,)], [(3,)]]
+        new_engine = MysqlEngine(instance=self.ins1)
+        query_result = new_engine.query_stream(
+            db_name="some_db",
+            sql="select some from some_table",
+            limit_num=3,
+            chunk_size=2,
+        )
+        self.assertListEqual(list(query_result.rows), [[(1,), (2,)], [(3,)]])
+        cur.fetchmany.assert_called_with(1)
+
+    @patch("MySQLdb.connect")
+    def test_query_stream_error(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.execute.side_effect = MySQLdb.ProgrammingError("语法错误")
+        new_engine = MysqlEngine(instance=self.ins1)
+        query_result = new_engine.query_stream(db_name="some_db", sql="select 1")
+        self.assertEqual(query_result.error, "语法错误")
+        self.assertIsNone(new_engine.conn)
+
     @patch.object(MysqlEngine, "query")
     def test_processlist(self, _query):
         new_engine = MysqlEngine(instance=self.ins1)
@@ -661,15 +872,24 @@ class TestMysql(TestCase):
         r = new_engine.get_long_transaction()
         self.assertIsInstance(r, ResultSet)
 
-    @patch.object(MysqlEngine, "get_bind_users")
     @patch.object(MysqlEngine, "query")
-    def test_get_all_databases_summary(self, _query, _get_bind_users):
+    def test_get_all_databases_summary(self, _query):
         db_result1 = ResultSet()
-        db_result1.rows = [("some_db", "utf8mb4", "utf8mb4_general_ci")]
-        _query.return_value = db_result1
-        _get_bind_users.return_value = [("'some_user'@'%'", "cooperate_sign")]
+        db_result1.rows = [
+            ("some_db", "utf8mb4", "utf8mb4_general_ci"),
+            ("other_db", "utf8mb4", "utf8mb4_general_ci"),
+        ]
+        bind_users = ResultSet(
+            rows=(
+                ("some_db", "'some_user'@'%'"),
+                ("some_db", "'other_user'@'%'"),
+            )
+        )
+        _query.side_effect = [db_result1, bind_users]
         new_engine = MysqlEngine(instance=self.ins1)
         dbs = new_engine.get_all_databases_summary()
+        # 所有库的关联用户一次查询
+        self.assertEqual(_query.call_count, 2)
         self.assertEqual(
             dbs.rows,
             [
@@ -677,12 +897,43 @@ class TestMysql(TestCase):
                     "db_name": "some_db",
                     "charset": "utf8mb4",
                     "collation": "utf8mb4_general_ci",
-                    "grantees": ["'some_user'@'%'"],
+                    "grantees": ["'some_user'@'%'", "'other_user'@'%'"],
                     "saved": False,
-                }
+                },
+                {
+                    "db_name": "other_db",
+                    "charset": "utf8mb4",
+                    "collation": "utf8mb4_general_ci",
+                    "grantees": [],
+                    "saved": False,
+                },
             ],
         )
 
+    @patch("sql.engines.mysql.SHOW_GRANTS_BATCH_SIZE", 2)
+    @patch("MySQLdb.connect")
+    @patch.object(MysqlEngine, "query")
+    def test_get_instance_users_summary_pipelined(self, _query, _connect):
+        _connect.return_value.get_server_info.return_value = "8.0.30"
+        users = [(f"`user{i}`@`%`", f"user{i}", "%", "N") for i in range(3)]
+        _query.return_value = ResultSet(rows=users)
+        cursor = _connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            ((f"GRANT USAGE ON *.* TO `user{i}`@`%`",),) for i in range(3)
+        ]
+        new_engine = MysqlEngine(instance=self.ins1)
+        user_summary = new_engine.get_instance_users_summary()
+        # 3个账号分2批合并发送SHOW GRANTS
+        self.assertEqual(cursor.execute.call_count, 2)
+        cursor.execute.assert_any_call(
+            "show grants for `user0`@`%`;show grants for `user1`@`%`;"
+        )
+        self.assertEqual(
+            [row["privileges"] for row in user_summary.rows],
+            [((f"GRANT USAGE ON *.* TO `user{i}`@`%`",),) for i in range(3)],
+        )
+        self.assertEqual(user_summary.rows[0]["is_locked"], "N")
+
     @patch("MySQLdb.connect")
     @patch.object(MysqlEngine, "query")
     def test_get_instance_users_summary(self, _query, _connect):
@@ -1152,6 +1403,107 @@ class TestPgSQL(TestCase):
                 execute_result.rows[0].__dict__.keys(), row.__dict__.keys()
             )
 
+    def _chunk_workflow(self, sql):
+        wf = SqlWorkflow.objects.create(
+            workflow_name="some_name",
+            group_id=1,
+            group_name="g1",
+            engineer_display="",
+            audit_auth_groups="some_group",
+            create_time=datetime.now() - timedelta(days=1),
+            status="workflow_executing",
+            is_backup=False,
+            instance=self.ins,
+            db_name="some_db",
+            syntax_type=2,
+        )
+        SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
+        return wf
+
+    @override_settings(EXECUTE_CHUNK_SIZE=2)
+    @patch("psycopg2.connect")
+    def test_execute_workflow_by_chunk(self, _conn):
+        """分批执行，每批提交后记录进度，中断后从已提交批次之后继续执行"""
+        sql = "insert into t values (1);insert into t values (2);insert into t values (3);"
+        wf = self._chunk_workflow(sql)
+        cursor = _conn.return_value.cursor.return_value
+        cursor.rowcount = 1
+        # 第3条语句报错，前两条已提交
+        cursor.execute.side_effect = [None, None, RuntimeError("boom")]
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertEqual(execute_result.error, "boom")
+        self.assertEqual(
+            [r.stagestatus for r in execute_result.rows],
+            ["Execute Successfully", "Execute Successfully", "Execute Failed"],
+        )
+        self.assertEqual(_conn.return_value.commit.call_count, 1)
+        _conn.return_value.rollback.assert_called_once()
+        self.assertEqual(execute_percentage(wf.id), 66.67)
+        self.assertEqual(len(committed_rows(wf.id)), 2)
+        # 继续执行只执行第3条语句
+        cursor.execute.reset_mock(side_effect=True)
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertIsNone(execute_result.error)
+        cursor.execute.assert_called_once_with("insert into t values (3)")
+        self.assertEqual([r.id for r in execute_result.rows], [1, 2, 3])
+        self.assertEqual(execute_percentage(wf.id), 100)
+        clear_progress(wf.id)
+        self.assertIsNone(execute_percentage(wf.id))
+
+    @override_settings(EXECUTE_CHUNK_SIZE=2)
+    @patch("psycopg2.connect")
+    def test_execute_workflow_by_chunk_rollback(self, _conn):
+        """同批次语句失败时，本批已执行的语句标记为已回滚"""
+        sql = "insert into t values (1);insert into t values (2);insert into t values (3);"
+        wf = self._chunk_workflow(sql)
+        cursor = _conn.return_value.cursor.return_value
+        cursor.execute.side_effect = [None, RuntimeError("boom")]
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertEqual(
+            [r.stagestatus for r in execute_result.rows],
+            ["Execute Rollback", "Execute Failed", "Audit completed"],
+        )
+        _conn.return_value.commit.assert_not_called()
+        self.assertEqual(execute_percentage(wf.id), 0)
+
+    @override_settings(EXECUTE_CHUNK_SIZE=2)
+    @patch("sql.utils.execute_progress.time.sleep")
+    @patch("sql.utils.execute_progress.close_old_connections")
+    @patch("sql.utils.execute_progress.save_chunk")
+    @patch("psycopg2.connect")
+    def test_execute_workflow_by_chunk_save_failed(self, _conn, _save, _close, _sleep):
+        """已提交批次记录进度失败时重试，仍失败则按已提交返回错误，不回滚"""
+        sql = "insert into t values (1);insert into t values (2);insert into t values (3);"
+        wf = self._chunk_workflow(sql)
+        _save.side_effect = RuntimeError("db gone")
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertEqual(_save.call_count, 3)
+        _conn.return_value.rollback.assert_not_called()
+        self.assertIn("已提交", execute_result.error)
+        self.assertEqual(
+            [r.stagestatus for r in execute_result.rows],
+            ["Execute Successfully", "Execute Successfully", "Audit completed"],
+        )
+
+    @override_settings(EXECUTE_CHUNK_SIZE=2)
+    @patch("psycopg2.connect")
+    def test_execute_workflow_by_chunk_replay_session(self, _conn):
+        """继续执行时先重放已提交语句中的会话设置"""
+        sql = "set search_path to s1;insert into t values (1);insert into t values (2);"
+        wf = self._chunk_workflow(sql)
+        cursor = _conn.return_value.cursor.return_value
+        cursor.execute.side_effect = [None, None, RuntimeError("boom")]
+        PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        cursor.execute.reset_mock(side_effect=True)
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertIsNone(execute_result.error)
+        self.assertEqual(
+            [c.args[0] for c in cursor.execute.call_args_list],
+            ["set search_path to s1", "insert into t values (2)"],
+        )
+        self.assertTrue(PgSQLEngine.is_session_statement("SET role admin"))
+        self.assertFalse(PgSQLEngine.is_session_statement("set local work_mem=1"))
+
 
 class TestModel(TestCase):
     def setUp(self):
@@ -1221,6 +1573,43 @@ class TestGoInception(TestCase):
         new_engine.get_connection()
         _connect.assert_called_once()
 
+    @override_settings(ROLLBACK_BATCH_SIZE=2)
+    @patch("MySQLdb.connect")
+    def test_get_rollback(self, _connect):
+        execute_result = [
+            {"sql": "use some_db", "sequence": "'0_0_0'", "backup_dbname": "None"},
+            {"sql": "update t1 set c=1", "sequence": "'1_1_1'", "backup_dbname": "bak"},
+            {"sql": "update t1 set c=2", "sequence": "'1_1_2'", "backup_dbname": "bak"},
+            {"sql": "update t2 set c=3", "sequence": "'1_1_3'", "backup_dbname": "bak"},
+        ]
+        self.wf.sqlworkflowcontent.execute_result = json.dumps(execute_result)
+        self.wf.sqlworkflowcontent.save()
+        cursor = _connect.return_value.cursor.return_value
+        cursor.fetchmany.side_effect = [
+            # 备份表名，按两条一批查询
+            [("1_1_3", "t2"), ("1_1_2", "t1")],
+            [],
+            [("1_1_1", "t1")],
+            [],
+            # 回滚语句
+            [("1_1_3", "update t2 set c=0")],
+            [],
+            [("1_1_1", "update t1 set c=0"), ("1_1_1", "update t1 set c=1")],
+            [],
+        ]
+        new_engine = GoInceptionEngine()
+        rollback = new_engine.get_rollback(self.wf)
+        self.assertEqual(
+            rollback,
+            [
+                ["update t2 set c=3", "update t2 set c=0"],
+                ["update t1 set c=2", ""],
+                ["update t1 set c=1", "update t1 set c=0\nupdate t1 set c=1"],
+            ],
+        )
+        # 备份表名2次查询，t1、t2各1次查询回滚语句
+        self.assertEqual(cursor.execute.call_count, 4)
+
     @patch("sql.engines.goinception.GoInceptionEngine.query")
     def test_execute_check_normal_sql(self, _query):
         sql = "update user set id=100"
@@ -1886,6 +2275,47 @@ end;"""
                 execute_result.rows[0].__dict__.keys(), row.__dict__.keys()
             )
 
+    @patch("MySQLdb.connect")
+    def test_get_backup_connection(self, _connect):
+        _backup_schema_ready.clear()
+        OracleEngine.get_backup_connection()
+        OracleEngine.get_backup_connection()
+        # 备份库表只初始化一次
+        self.assertEqual(
+            _connect.return_value.cursor.return_value.execute.call_count, 2
+        )
+        _connect.return_value.select_db.assert_called_with("ora_backup")
+        self.assertEqual(_connect.return_value.select_db.call_count, 2)
+        _backup_schema_ready.clear()
+
+    @override_settings(ROLLBACK_BATCH_SIZE=2)
+    def test_save_rollback(self):
+        cursor = Mock()
+        cursor.fetchmany.side_effect = [
+            [("redo1", "undo1"), ("redo2", None)],
+            [("redo3", "undo3")],
+            [],
+        ]
+        backup_cursor = Mock()
+        count = OracleEngine.save_rollback(backup_cursor, cursor, self.wf.id)
+        self.assertEqual(count, 3)
+        cursor.fetchmany.assert_called_with(2)
+        self.assertEqual(backup_cursor.executemany.call_count, 2)
+        self.assertEqual(
+            backup_cursor.executemany.call_args_list[0][0][1],
+            [("redo1", "undo1", self.wf.id), ("redo2", " ", self.wf.id)],
+        )
+        # DDL工单回滚语句为对象原定义
+        cursor.fetchmany.side_effect = [[("create table t1(id int)",)], []]
+        backup_cursor.reset_mock()
+        count = OracleEngine.save_rollback(
+            backup_cursor, cursor, self.wf.id, "drop table t1"
+        )
+        self.assertEqual(count, 1)
+        backup_cursor.executemany.assert_called_once_with(
+            ANY, [("drop table t1", "create table t1(id int)", self.wf.id)]
+        )
+
     @patch("cx_Oracle.connect.cursor.execute")
     @patch("cx_Oracle.connect.cursor")
     @patch("cx_Oracle.connect")
@@ -2038,6 +2468,93 @@ class MongoTest(TestCase):
         self.assertEqual(columns, ["mongodballdata", "_id", "title", "tags", "likes"])
         self.assertEqual(rows[0], rerows)
 
+    @patch("sql.engines.mongo.MongoEngine.get_all_columns_by_tb")
+    def test_parse_tuple_bson(self, mock_get_all_columns_by_tb):
+        mock_get_all_columns_by_tb.return_value.rows = ["_id", "title"]
+        cursor = iter(
+            [
+                {
+                    "_id": ObjectId("5f10162029684728e70045ab"),
+                    "title": "MongoDB",
+                    "likes": Int64(100),
+                    "tags": ["a", "b"],
+                    "author": {"_id": ObjectId("5f10162029684728e70045ac")},
+                },
+                {"_id": ObjectId("5f10162029684728e70045ad")},
+            ]
+        )
+        rows, columns = self.engine.parse_tuple(cursor, "some_db", "job")
+        self.assertEqual(
+            columns, ["mongodballdata", "_id", "title", "likes", "tags", "author"]
+        )
+        self.assertEqual(
+            rows[0][1:],
+            (
+                "ObjectId('5f10162029684728e70045ab')",
+                "MongoDB",
+                "100",
+                "(array) 2 Elements",
+                "{'_id': ObjectId('5f10162029684728e70045ac')}",
+            ),
+        )
+        self.assertEqual(
+            json.loads(rows[1][0]), {"_id": {"$oid": "5f10162029684728e70045ad"}}
+        )
+        self.assertEqual(rows[1][2:], ("(N/A)",) * 4)
+
+    @patch("sql.engines.mongo.MongoEngine.get_all_columns_by_tb")
+    def test_sampled_columns_cache(self, mock_get_all_columns_by_tb):
+        mock_get_all_columns_by_tb.return_value.rows = ["_id", "title"]
+        columns = self.engine.sampled_columns("some_db", "cache_job")
+        columns.append("likes")
+        self.assertEqual(
+            self.engine.sampled_columns("some_db", "cache_job"), ["_id", "title"]
+        )
+        mock_get_all_columns_by_tb.assert_called_once()
+        with self.settings(MONGO_SCHEMA_CACHE_TTL=0):
+            self.engine.sampled_columns("some_db", "cache_job")
+        self.assertEqual(mock_get_all_columns_by_tb.call_count, 2)
+
+    def test_compile_query(self):
+        sql = """db.job.find({"status": 1}, {"title": 1}).sort({"likes": -1}).limit(5).skip(2)"""
+        plan = compile_query(sql)
+        self.assertEqual(plan.collection, "job")
+        self.assertEqual(plan.method, "find")
+        self.assertEqual(plan.filter, {"status": 1})
+        self.assertEqual(plan.projection, {"title": 1})
+        self.assertEqual(plan.sort, (("likes", -1),))
+        self.assertEqual((plan.limit, plan.skip), (5, 2))
+        # 相同语句复用执行计划，包含当前时间的语句每次重新解析
+        self.assertIs(compile_query(sql), plan)
+        sql = """db.job.find({"created": {"$lt": new Date()}})"""
+        self.assertIsNot(compile_query(sql), compile_query(sql))
+        with self.assertRaises(ValueError):
+            compile_query("db.job.drop()")
+
+    @override_settings(MONGO_QUERY_BATCH_SIZE=100)
+    def test_query_plan_execute(self):
+        collection = Mock()
+        cursor = collection.find.return_value
+        plan = compile_query("""db.job.find({"status": 1}).sort({"likes": -1})""")
+        plan.execute(collection, 1000)
+        collection.find.assert_called_once_with({"status": 1})
+        cursor.sort.assert_called_once_with([("likes", -1)])
+        cursor.sort.return_value.limit.assert_called_once_with(1000)
+        cursor.sort.return_value.limit.return_value.batch_size.assert_called_once_with(
+            100
+        )
+        plan = compile_query("""db.job.aggregate([{"$match": {"status": 1}}])""")
+        plan.execute(collection, 10)
+        collection.aggregate.assert_called_once_with(
+            [{"$match": {"status": 1}}, {"$limit": 10}], batchSize=10
+        )
+        plan.execute(collection, 10)
+        self.assertEqual(len(plan.pipeline), 1)
+        compile_query("""db.job.find({}).count()""").execute(collection, 10)
+        collection.estimated_document_count.assert_called_once()
+        compile_query("""db.job.find({"status": 1}).count()""").execute(collection, 10)
+        collection.count_documents.assert_called_once_with({"status": 1})
+
     @patch("sql.engines.mongo.MongoEngine.get_table_conut")
     @patch("sql.engines.mongo.MongoEngine.get_all_tables")
     def test_execute_check(self, mock_get_all_tables, mock_get_table_conut):
@@ -2123,20 +2640,6 @@ class MongoTest(TestCase):
         mock_get_master.assert_called_once()
         self.assertEqual(check_result.rows[0].__dict__["stagestatus"], "异常终止")
 
-    def test_fill_query_columns(self):
-        columns = ["_id", "title", "tags", "likes"]
-        cursor = [
-            {
-                "_id": {"$oid": "5f10162029684728e70045ab"},
-                "title": "MongoDB",
-                "text": "archery",
-                "likes": 100,
-            },
-            {"_id": {"$oid": "7f10162029684728e70045ab"}, "author": "archery"},
-        ]
-        cols = self.engine.fill_query_columns(cursor, columns=columns)
-        self.assertEqual(cols, ["_id", "title", "tags", "likes", "text", "author"])
-
     @patch("sql.engines.mongo.MongoEngine.get_connection")
     def test_current_op(self, mock_get_connection):
         class Aggregate:
@@ -8,12 +8,12 @@ import simplejson as json
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse
-from django.views.decorators.cache import cache_page
 
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.convert import Convert
 from sql.engines import get_engine
 from sql.plugins.schemasync import SchemaSync
+from sql.utils.metadata_catalog import metadata_catalog
 from .models import Instance, ParamTemplate, ParamHistory
 
 
@@ -297,7 +297,6 @@ def schemasync(request):
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
-@cache_page(60 * 5, key_prefix="insRes")
 def instance_resource(request):
     """
     获取实例内的资源信息，database、schema、table、column
@@ -327,16 +326,25 @@ def instance_resource(request):
         schema_name = query_engine.escape_string(schema_name)
         tb_name = query_engine.escape_string(tb_name)
         if resource_type == "database":
-            resource = query_engine.get_all_databases()
+            resource = metadata_catalog.get(query_engine, "get_all_databases")
         elif resource_type == "schema" and db_name:
-            resource = query_engine.get_all_schemas(db_name=db_name)
+            resource = metadata_catalog.get(
+                query_engine, "get_all_schemas", db_name=db_name
+            )
         elif resource_type == "table" and db_name:
-            resource = query_engine.get_all_tables(
-                db_name=db_name, schema_name=schema_name
+            resource = metadata_catalog.get(
+                query_engine,
+                "get_all_tables",
+                db_name=db_name,
+                schema_name=schema_name,
             )
         elif resource_type == "column" and db_name and tb_name:
-            resource = query_engine.get_all_columns_by_tb(
-                db_name=db_name, tb_name=tb_name, schema_name=schema_name
+            resource = metadata_catalog.get(
+                query_engine,
+                "get_all_columns_by_tb",
+                db_name=db_name,
+                tb_name=tb_name,
+                schema_name=schema_name,
             )
         else:
             raise TypeError("不支持的资源类型或者参数不完整！")
@@ -371,8 +379,12 @@ def describe(request):
         db_name = query_engine.escape_string(db_name)
         schema_name = query_engine.escape_string(schema_name)
         tb_name = query_engine.escape_string(tb_name)
-        query_result = query_engine.describe_table(
-            db_name, tb_name, schema_name=schema_name
+        query_result = metadata_catalog.get(
+            query_engine,
+            "describe_table",
+            db_name=db_name,
+            tb_name=tb_name,
+            schema_name=schema_name,
         )
         result["data"] = query_result.__dict__
     except Exception as msg:
@@ -10,6 +10,8 @@ from sql.utils.instance_management import (
     SUPPORTED_MANAGEMENT_DB_TYPE,
     get_instanceaccount_unique_value,
     get_instanceaccount_unique_key,
+    get_instance_summary,
+    clear_instance_summary,
 )
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine, ResultSet
@@ -22,6 +24,7 @@ def users(request):
     """获取实例用户列表"""
     instance_id = request.POST.get("instance_id")
     saved = True if request.POST.get("saved") == "true" else False  # 平台是否保存
+    refresh = request.POST.get("refresh") == "true"  # 忽略缓存从实例重新获取
 
     if not instance_id:
         return JsonResponse({"status": 0, "msg": "", "data": []})
@@ -41,7 +44,7 @@ def users(request):
         cnf_users[get_instanceaccount_unique_value(instance.db_type, user)] = user
     # 获取所有用户
     query_engine = get_engine(instance=instance)
-    query_result = query_engine.get_instance_users_summary()
+    query_result = get_instance_summary(query_engine, "users", refresh=refresh)
     if not query_result.error:
         rows = []
         key = get_instanceaccount_unique_key(db_type=instance.db_type)
@@ -113,6 +116,7 @@ def create(request):
     else:
         accounts = [InstanceAccount(**row) for row in exec_result.rows]
         InstanceAccount.objects.bulk_create(accounts)
+        clear_instance_summary(instance, "users")
 
     return JsonResponse({"status": 0, "msg": "", "data": []})
 
@@ -254,6 +258,7 @@ def grant(request):
     engine.close()
     if exec_result.error:
         return JsonResponse({"status": 1, "msg": exec_result.error})
+    clear_instance_summary(instance, "users", "databases")
     return JsonResponse({"status": 0, "msg": "", "data": grant_sql})
 
 
@@ -342,6 +347,7 @@ def lock(request):
     exec_result = engine.execute(db_name="mysql", sql=lock_sql)
     if exec_result.error:
         return JsonResponse({"status": 1, "msg": exec_result.error})
+    clear_instance_summary(instance, "users")
     return JsonResponse({"status": 0, "msg": "", "data": []})
 
 
@@ -380,5 +386,6 @@ def delete(request):
         InstanceAccount.objects.filter(
             instance=instance, user=user, host=host, db_name=db_name
         ).delete()
+        clear_instance_summary(instance, "users", "databases")
 
     return JsonResponse({"status": 0, "msg": "", "data": []})
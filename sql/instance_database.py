@@ -10,11 +10,12 @@ import MySQLdb
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.http import JsonResponse, HttpResponse
-from django_redis import get_redis_connection
 
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine, ResultSet
 from sql.models import Instance, InstanceDatabase, Users
+from sql.utils.instance_management import get_instance_summary, clear_instance_summary
+from sql.utils.metadata_catalog import metadata_catalog
 from sql.utils.resource_group import user_instances
 
 __author__ = "hhyo"
@@ -25,6 +26,7 @@ def databases(request):
     """获取实例数据库列表"""
     instance_id = request.POST.get("instance_id")
     saved = True if request.POST.get("saved") == "true" else False  # 平台是否保存
+    refresh = request.POST.get("refresh") == "true"  # 忽略缓存从实例重新获取
 
     if not instance_id:
         return JsonResponse({"status": 0, "msg": "", "data": []})
@@ -45,7 +47,7 @@ def databases(request):
         cnf_dbs[f"{db['db_name']}"] = db
 
     query_engine = get_engine(instance=instance)
-    query_result = query_engine.get_all_databases_summary()
+    query_result = get_instance_summary(query_engine, "databases", refresh=refresh)
     if not query_result.error:
         # 获取数据库关联用户信息
         rows = []
@@ -121,10 +123,9 @@ def create(request):
             owner_display=owner_display,
             remark=remark,
         )
-        # 清空实例资源缓存
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match="*insRes*", count=2000):
-            r.delete(key)
+        clear_instance_summary(instance, "databases")
+        # 实例库列表的元数据缓存失效
+        metadata_catalog.invalidate(instance.id, "")
 
     return JsonResponse({"status": 0, "msg": "", "data": []})
 
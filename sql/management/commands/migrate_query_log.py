@@ -0,0 +1,42 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from sql.utils.query_log import (
+    archive_query_log,
+    create_fulltext_index,
+    fulltext_enabled,
+)
+from sql.utils.tasks import add_query_log_archive_schedule
+
+
+class Command(BaseCommand):
+    help = "为已有的查询历史建立ngram全文索引，并可将超过保留天数的非收藏记录迁移到归档表"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--skip-index", action="store_true", help="不建立全文索引")
+        parser.add_argument(
+            "--archive-days",
+            type=int,
+            default=0,
+            help="归档该天数之前的非收藏记录，0表示不归档",
+        )
+        parser.add_argument("--batch-size", type=int, default=10000, help="归档时每批迁移的行数")
+        parser.add_argument(
+            "--schedule", action="store_true", help="添加每天按--archive-days归档的定时任务"
+        )
+
+    def handle(self, *args, **options):
+        if not options["skip_index"]:
+            if fulltext_enabled():
+                self.stdout.write("查询历史全文索引已存在")
+            else:
+                self.stdout.write("建立查询历史全文索引，数据量大时需要较长时间")
+                create_fulltext_index()
+                self.stdout.write("查询历史全文索引建立完成")
+        days = options["archive_days"]
+        if days > 0:
+            archived = archive_query_log(days, batch_size=options["batch_size"])
+            self.stdout.write(f"查询历史归档完成，迁移{archived}行")
+            if options["schedule"]:
+                add_query_log_archive_schedule(days)
+                self.stdout.write("已添加查询历史归档定时任务")
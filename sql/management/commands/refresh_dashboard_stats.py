@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from common.utils.dashboard_stats import (
+    REFRESH_BATCH_SIZE,
+    rebuild_dashboard_stats,
+    refresh_dashboard_stats,
+)
+from sql.utils.tasks import add_dashboard_stats_schedule
+
+
+class Command(BaseCommand):
+    help = "按天汇总工单和查询日志用于dashboard展示，首次执行会回填全部历史数据，并添加增量汇总的定时任务"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="清空统计数据后重新汇总全部数据")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=REFRESH_BATCH_SIZE,
+            help="每批处理的ID范围",
+        )
+        parser.add_argument("--no-schedule", action="store_true", help="不添加增量汇总的定时任务")
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            last_ids = rebuild_dashboard_stats(batch_size=options["batch_size"])
+        else:
+            last_ids = refresh_dashboard_stats(batch_size=options["batch_size"])
+        self.stdout.write(f"dashboard统计汇总完成，已汇总的ID：{last_ids}")
+        if not options["no_schedule"]:
+            add_dashboard_stats_schedule()
+            self.stdout.write("已添加dashboard统计增量汇总定时任务")
@@ -0,0 +1,47 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django_q.tasks import async_task
+
+from sql.models import SqlWorkflow, SqlWorkflowExecuteProgress
+from sql.utils.workflow_audit import Audit
+from common.utils.const import WorkflowType
+
+
+class Command(BaseCommand):
+    help = "分批执行的SQL工单中断后重新加入执行队列，从最后一个已提交批次之后继续执行"
+
+    def add_arguments(self, parser):
+        parser.add_argument("workflow_id", type=int, help="工单ID")
+
+    def handle(self, *args, **options):
+        workflow_id = options["workflow_id"]
+        try:
+            progress = SqlWorkflowExecuteProgress.objects.get(workflow_id=workflow_id)
+        except SqlWorkflowExecuteProgress.DoesNotExist:
+            raise CommandError(f"工单{workflow_id}没有分批执行进度")
+        updated = SqlWorkflow.objects.filter(
+            id=workflow_id, status__in=["workflow_executing", "workflow_exception"]
+        ).update(status="workflow_queuing")
+        if not updated:
+            raise CommandError(f"工单{workflow_id}不是执行中或执行异常状态")
+        async_task(
+            "sql.utils.execute_sql.execute",
+            workflow_id,
+            hook="sql.utils.execute_sql.execute_callback",
+            timeout=-1,
+            task_name=f"sqlreview-execute-{workflow_id}",
+        )
+        audit_id = Audit.detail_by_workflow_id(
+            workflow_id=workflow_id, workflow_type=WorkflowType.SQL_REVIEW
+        ).audit_id
+        Audit.add_log(
+            audit_id=audit_id,
+            operation_type=5,
+            operation_type_desc="执行工单",
+            operation_info=f"工单从第{progress.last_line + 1}条语句继续执行",
+            operator="",
+            operator_display="系统",
+        )
+        self.stdout.write(
+            f"工单{workflow_id}已加入执行队列，已提交{progress.last_line}/{progress.total}条语句"
+        )
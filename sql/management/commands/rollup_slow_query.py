@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from sql.utils.slow_query_rollup import (
+    ROLLUP_BATCH_SIZE,
+    rebuild_slow_query_rollup,
+    rollup_slow_query,
+)
+from sql.utils.tasks import add_slow_query_rollup_schedule
+
+
+class Command(BaseCommand):
+    help = "汇总慢日志明细到小时表和天表，首次执行会回填全部历史明细，并添加增量汇总的定时任务"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="清空汇总数据后重新汇总全部明细")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=ROLLUP_BATCH_SIZE,
+            help="每批处理的明细ID范围",
+        )
+        parser.add_argument("--no-schedule", action="store_true", help="不添加增量汇总的定时任务")
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            last_id = rebuild_slow_query_rollup(batch_size=options["batch_size"])
+        else:
+            last_id = rollup_slow_query(batch_size=options["batch_size"])
+        self.stdout.write(f"慢日志汇总完成，已汇总的明细ID：{last_id}")
+        if not options["no_schedule"]:
+            add_slow_query_rollup_schedule()
+            self.stdout.write("已添加慢日志增量汇总定时任务")
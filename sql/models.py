@@ -303,6 +303,44 @@ class SqlWorkflowContent(models.Model):
         verbose_name_plural = "SQL工单内容"
 
 
+class SqlWorkflowExecuteProgress(models.Model):
+    """
+    SQL工单分批执行进度，每批语句在目标库提交后更新，执行中断后从last_line之后继续执行
+    """
+
+    workflow = models.OneToOneField(
+        SqlWorkflow, on_delete=models.CASCADE, primary_key=True
+    )
+    total = models.IntegerField("语句总数", default=0)
+    last_line = models.IntegerField("已提交的最后一条语句序号", default=0)
+    update_time = models.DateTimeField("更新时间", auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = "sql_workflow_execute_progress"
+        verbose_name = "SQL工单执行进度"
+        verbose_name_plural = "SQL工单执行进度"
+
+
+class SqlWorkflowExecuteChunk(models.Model):
+    """
+    SQL工单分批执行时每批已提交语句的执行结果
+    """
+
+    workflow = models.ForeignKey(SqlWorkflow, on_delete=models.CASCADE)
+    start_line = models.IntegerField("起始语句序号")
+    end_line = models.IntegerField("结束语句序号")
+    execute_result = models.TextField("执行结果的JSON格式")
+    create_time = models.DateTimeField("提交时间", auto_now_add=True)
+
+    class Meta:
+        managed = True
+        db_table = "sql_workflow_execute_chunk"
+        unique_together = ("workflow", "start_line")
+        verbose_name = "SQL工单分批执行结果"
+        verbose_name_plural = "SQL工单分批执行结果"
+
+
 class WorkflowAudit(models.Model):
     """
     工作流审核状态表
@@ -507,7 +545,7 @@ class QueryLog(models.Model):
     effect_row = models.BigIntegerField("返回行数")
     cost_time = models.CharField("执行耗时", max_length=10, default="")
     # TODO 改为user 外键
-    username = models.CharField("操作人", max_length=30)
+    username = models.CharField("操作人", max_length=30, db_index=True)
     user_display = models.CharField("操作人中文名", max_length=50, default="")
     priv_check = models.BooleanField(
         "查询权限是否正常校验",
@@ -537,7 +575,7 @@ class QueryLog(models.Model):
         default=False,
     )
     alias = models.CharField("语句标识", max_length=64, default="", blank=True)
-    create_time = models.DateTimeField("操作时间", auto_now_add=True)
+    create_time = models.DateTimeField("操作时间", auto_now_add=True, db_index=True)
     sys_time = models.DateTimeField(auto_now=True)
 
     class Meta:
@@ -1177,6 +1215,105 @@ class SlowQueryHistory(models.Model):
         verbose_name_plural = "慢日志明细"
 
 
+class SlowQueryRollup(models.Model):
+    """
+    慢日志明细按 主机/库/checksum/时间段 的汇总，由sql.utils.slow_query_rollup增量维护
+    """
+
+    hostname = models.CharField("主机", max_length=64)
+    db_name = models.CharField("库名", max_length=64, default="")
+    checksum = models.ForeignKey(
+        SlowQuery,
+        db_constraint=False,
+        to_field="checksum",
+        db_column="checksum",
+        on_delete=models.CASCADE,
+    )
+    bucket = models.DateTimeField("统计时间段")
+    ts_cnt = models.FloatField("执行次数", default=0)
+    query_time_sum = models.FloatField("执行总时长", default=0)
+    lock_time_sum = models.FloatField("锁定总时长", default=0)
+    rows_sent_sum = models.FloatField("返回总行数", default=0)
+    rows_examined_sum = models.FloatField("扫描总行数", default=0)
+    query_time_pct_95_max = models.FloatField("95%执行时长最大值", default=0)
+    ts_max = models.DateTimeField("最后出现时间")
+
+    class Meta:
+        abstract = True
+        unique_together = ("hostname", "bucket", "checksum", "db_name")
+
+
+class SlowQueryRollupHourly(SlowQueryRollup):
+    class Meta(SlowQueryRollup.Meta):
+        managed = True
+        db_table = "mysql_slow_query_rollup_hourly"
+        verbose_name = "慢日志小时汇总"
+        verbose_name_plural = "慢日志小时汇总"
+
+
+class SlowQueryRollupDaily(SlowQueryRollup):
+    class Meta(SlowQueryRollup.Meta):
+        managed = True
+        db_table = "mysql_slow_query_rollup_daily"
+        verbose_name = "慢日志天汇总"
+        verbose_name_plural = "慢日志天汇总"
+
+
+class SlowQueryRollupState(models.Model):
+    """
+    慢日志汇总进度，记录已经汇总的明细最大ID
+    明细表没有写入时间，观察到的最大ID超过安全延迟后才允许汇总到该ID
+    """
+
+    last_id = models.BigIntegerField("已汇总的明细ID", default=0)
+    safe_id = models.BigIntegerField("允许汇总到的明细ID", default=0)
+    pending_id = models.BigIntegerField("最近观察到的明细最大ID", default=0)
+    pending_time = models.DateTimeField("观察时间", null=True, blank=True)
+    update_time = models.DateTimeField("更新时间", auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = "mysql_slow_query_rollup_state"
+        verbose_name = "慢日志汇总进度"
+        verbose_name_plural = "慢日志汇总进度"
+
+
+class DailyStatistics(models.Model):
+    """
+    工单、查询日志按天汇总的统计数据，由common.utils.dashboard_stats增量维护
+    """
+
+    source = models.CharField("数据来源", max_length=32)
+    dim_type = models.CharField("统计维度", max_length=32)
+    dim_value = models.CharField("维度值", max_length=128, default="")
+    stat_date = models.DateField("统计日期")
+    cnt = models.BigIntegerField("数量", default=0)
+    effect_row = models.BigIntegerField("返回行数", default=0)
+
+    class Meta:
+        managed = True
+        db_table = "statistics_daily"
+        unique_together = ("source", "dim_type", "stat_date", "dim_value")
+        verbose_name = "按天统计"
+        verbose_name_plural = "按天统计"
+
+
+class DailyStatisticsState(models.Model):
+    """
+    按天统计的汇总进度，记录各数据来源已经汇总的最大ID
+    """
+
+    source = models.CharField("数据来源", max_length=32, primary_key=True)
+    last_id = models.BigIntegerField("已汇总的ID", default=0)
+    update_time = models.DateTimeField("更新时间", auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = "statistics_daily_state"
+        verbose_name = "按天统计进度"
+        verbose_name_plural = "按天统计进度"
+
+
 class AuditEntry(models.Model):
     """
     登录审计日志
@@ -5,16 +5,17 @@ import logging
 import re
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 from itertools import chain
 from typing import Union, List
 
-import requests
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.db import transaction
 
 from common.config import SysConfig
 from common.utils.const import WorkflowStatus, WorkflowType
-from common.utils.sendmsg import MsgSender
+from common.utils.sendmsg import MsgSender, http_post
 from sql.models import (
     QueryPrivilegesApply,
     Users,
@@ -25,6 +26,7 @@ from sql.models import (
     WorkflowAuditDetail,
     SqlWorkflowContent,
 )
+from sql.utils.notify_dispatcher import notify_dispatcher
 from sql.utils.resource_group import auth_group_users
 from sql.utils.workflow_audit import Audit
 from sql_api.serializers import (
@@ -62,6 +64,8 @@ class Notifier:
     event_type: EventType = EventType.AUDIT
     audit: WorkflowAudit = None
     audit_detail: WorkflowAuditDetail = None
+    # 已在提交线程中渲染，发送线程直接 send
+    rendered: bool = field(init=False, default=False)
 
     def __post_init__(self):
         if not self.workflow:
@@ -88,7 +92,8 @@ class Notifier:
     def run(self):
         if not self.should_run():
             return
-        self.render()
+        if not self.rendered:
+            self.render()
         self.send()
 
 
@@ -121,7 +126,7 @@ class GenericWebhookNotifier(Notifier):
 
     def send(self):
         url = self.sys_config.get(self.sys_config_key)
-        requests.post(url, json=self.request_data)
+        http_post(url, json=self.request_data)
 
 
 @dataclass
@@ -255,10 +260,11 @@ class LegacyRender(Notifier):
         elif status == WorkflowStatus.ABORTED:  # 审核取消，通知所有审核人
             msg_title = "[{}]提交人主动终止工单#{}".format(workflow_type_display, audit_id)
             # 接收人，发送给该资源组内对应权限组所有的用户
-            auth_group_names = [
-                Group.objects.get(id=auth_group_id).name
-                for auth_group_id in self.audit.audit_auth_groups.split(",")
-            ]
+            auth_group_names = list(
+                Group.objects.filter(
+                    id__in=self.audit.audit_auth_groups.split(",")
+                ).values_list("name", flat=True)
+            )
             msg_to = auth_group_users(auth_group_names, self.audit.group_id)
             # 消息内容
             msg_content = """发起时间：{}\n发起人：{}\n组：{}\n目标实例：{}\n数据库：{}\n工单名称：{}\n工单地址：{}\n终止原因：{}""".format(
@@ -273,7 +279,7 @@ class LegacyRender(Notifier):
             )
         else:
             raise Exception("工单状态不正确")
-        logger.info(f"通知Debug{msg_to}")
+        logger.debug("通知Debug%s", msg_to)
         self.messages.append(LegacyMessage(msg_title, msg_content, msg_to))
 
     def render_execute(self):
@@ -358,16 +364,41 @@ class LegacyRender(Notifier):
             self.render_audit()
         if self.event_type == EventType.M2SQL:
             self.render_m2sql()
+        # 接收人在渲染时查询完成，发送线程不再查询数据库
+        for m in self.messages:
+            m.msg_to = list(m.msg_to)
+            m.msg_cc = list(m.msg_cc)
+        self.render_target()
+
+    def render_target(self):
+        """查询消息以外的发送目标，与渲染一样在提交线程中调用"""
+        pass
+
+
+class GroupWebhookNotifier(LegacyRender):
+    """资源组机器人通知，webhook地址在渲染时查询"""
+
+    webhook_field = ""
+    webhook_url = ""
+
+    def _group_id(self):
+        if self.audit:
+            return self.audit.group_id
+        return getattr(self.workflow, "group_id", None)
+
+    def render_target(self):
+        self.webhook_url = getattr(
+            ResourceGroup.objects.get(group_id=self._group_id()), self.webhook_field
+        )
 
 
-class DingdingWebhookNotifier(LegacyRender):
+class DingdingWebhookNotifier(GroupWebhookNotifier):
     name = "dingding_webhook"
     sys_config_key: str = "ding"
+    webhook_field = "ding_webhook"
 
     def send(self):
-        dingding_webhook = ResourceGroup.objects.get(
-            group_id=self.audit.group_id
-        ).ding_webhook
+        dingding_webhook = self.webhook_url
         if not dingding_webhook:
             return
         msg_sender = MsgSender()
@@ -392,14 +423,13 @@ class DingdingPersonNotifier(LegacyRender):
             )
 
 
-class FeishuWebhookNotifier(LegacyRender):
+class FeishuWebhookNotifier(GroupWebhookNotifier):
     name = "feishu_webhook"
     sys_config_key: str = "feishu_webhook"
+    webhook_field = "feishu_webhook"
 
     def send(self):
-        feishu_webhook = ResourceGroup.objects.get(
-            group_id=self.audit.group_id
-        ).feishu_webhook
+        feishu_webhook = self.webhook_url
         if not feishu_webhook:
             return
         msg_sender = MsgSender()
@@ -427,14 +457,13 @@ class FeishuPersonNotifier(LegacyRender):
             msg_sender.send_feishu_user(m.msg_title, m.msg_content, open_id, user_mail)
 
 
-class QywxWebhookNotifier(LegacyRender):
+class QywxWebhookNotifier(GroupWebhookNotifier):
     name = "qywx_webhook"
     sys_config_key: str = "qywx_webhook"
+    webhook_field = "qywx_webhook"
 
     def send(self):
-        qywx_webhook = ResourceGroup.objects.get(
-            group_id=self.audit.group_id
-        ).qywx_webhook
+        qywx_webhook = self.webhook_url
         if not qywx_webhook:
             return
         msg_sender = MsgSender()
@@ -458,6 +487,24 @@ class MailNotifier(LegacyRender):
             )
 
 
+@lru_cache()
+def _load_notifiers(notifier_paths):
+    notifiers = []
+    for notifier in notifier_paths:
+        file, _class = notifier.split(":")
+        try:
+            notify_module = importlib.import_module(file)
+            notifiers.append(getattr(notify_module, _class))
+        except (ImportError, AttributeError) as e:
+            logger.error(f"failed to import notifier {notifier}, {str(e)}")
+    return notifiers
+
+
+def load_notifiers():
+    """按 ENABLED_NOTIFIERS 加载 notifier 类, 同一配置只导入一次"""
+    return _load_notifiers(tuple(settings.ENABLED_NOTIFIERS))
+
+
 def auto_notify(
     sys_config: SysConfig,
     workflow: Union[
@@ -468,17 +515,11 @@ def auto_notify(
     event_type: EventType = EventType.AUDIT,
 ):
     """
-    加载所有的 notifier, 调用 notifier 的 render 和 send 方法
+    加载所有的 notifier, 在当前线程调用 render, 事务提交后交给各渠道的发送线程调用 send
     内部方法, 有数据库查询, 为了方便测试, 请勿使用 async_task 调用, 防止 patch 后调用失败
     """
-    for notifier in settings.ENABLED_NOTIFIERS:
-        file, _class = notifier.split(":")
-        try:
-            notify_module = importlib.import_module(file)
-            notifier = getattr(notify_module, _class)
-        except (ImportError, AttributeError) as e:
-            logger.error(f"failed to import notifier {notifier}, {str(e)}")
-            continue
+    rendered = None
+    for notifier in load_notifiers():
         try:
             notifier = notifier(
                 workflow=workflow,
@@ -487,15 +528,48 @@ def auto_notify(
                 event_type=event_type,
                 sys_config=sys_config,
             )
-            notifier.run()
+            if not notifier.should_run():
+                continue
+            # 使用默认渲染的 notifier 消息内容相同, 只渲染一次
+            if type(notifier).render is LegacyRender.render and rendered is not None:
+                notifier.messages = [
+                    LegacyMessage(m.msg_title, m.msg_content, m.msg_to, m.msg_cc)
+                    for m in rendered
+                ]
+                notifier.render_target()
+            else:
+                notifier.render()
+                if type(notifier).render is LegacyRender.render:
+                    rendered = notifier.messages
+            notifier.rendered = True
+            transaction.on_commit(
+                lambda notifier=notifier: notify_dispatcher.submit(notifier)
+            )
         except Exception as e:  # NOQA 捕获一些错误, 让其他的 notifier 可以正常运行
             logger.error(f"failed to notify using `{notifier}`: {str(e)}")
 
 
-def notify_for_execute(workflow: SqlWorkflow, sys_config: SysConfig = None):
+def flush_notify():
+    """
+    等待已提交的通知发送完成，供django-q任务在返回前调用
+    渠道线程是守护线程，任务返回后worker可能被回收，未发送的通知会丢失
+    """
+    if not notify_dispatcher.flush(settings.NOTIFY["FLUSH_TIMEOUT"]):
+        logger.warning(f"等待消息通知发送超时，未发送的通知：{notify_dispatcher.stats()['pending']}")
+
+
+def notify_for_execute(
+    workflow: SqlWorkflow, sys_config: SysConfig = None, flush: bool = False
+):
+    """
+    工单执行结束的通知
+    :param flush: 在django-q任务中调用时为True，等待通知发送完成后返回
+    """
     if not sys_config:
         sys_config = SysConfig()
     auto_notify(workflow=workflow, sys_config=sys_config)
+    if flush:
+        flush_notify()
 
 
 def notify_for_audit(
@@ -515,6 +589,7 @@ def notify_for_audit(
         audit_detail=workflow_audit_detail,
         sys_config=sys_config,
     )
+    flush_notify()
 
 
 def notify_for_my2sql(task):
@@ -534,3 +609,4 @@ def notify_for_my2sql(task):
     # 发送
     sys_config = SysConfig()
     auto_notify(workflow=result, sys_config=sys_config, event_type=EventType.M2SQL)
+    flush_notify()
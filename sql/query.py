@@ -8,14 +8,16 @@ import traceback
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.db import connection, close_old_connections
-from django.db.models import Q
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
 from common.utils.timer import FuncTimer
-from sql.query_privileges import query_priv_check
+from sql.query_privileges import query_priv_check, prefetch_table_ref
+from sql.utils.async_query import AsyncQueryStore, submit_async_query
+from sql.utils.query_log import count_query_log, search_query_log
 from sql.utils.resource_group import user_instances
-from sql.utils.tasks import add_kill_conn_schedule, del_schedule
+from sql.utils.query_watchdog import query_watchdog
 from .models import QueryLog, Instance
 from sql.engines import get_engine
 
@@ -35,6 +37,8 @@ def query(request):
     tb_name = request.POST.get("tb_name")
     limit_num = int(request.POST.get("limit_num", 0))
     schema_name = request.POST.get("schema_name", None)
+    stream = request.POST.get("stream") == "true"
+    run_async = request.POST.get("async") == "true"
     user = request.user
 
     result = {"status": 0, "msg": "ok", "data": {}}
@@ -53,6 +57,8 @@ def query(request):
 
     try:
         config = SysConfig()
+        # 权限校验需要的引用表解析只依赖语句，与查询前的检查并行执行
+        prefetch_table_ref(user, instance, db_name, sql_content)
         # 查询前的检查，禁用语句检查，语句切分
         query_engine = get_engine(instance=instance)
         query_check_info = query_engine.query_check(db_name=db_name, sql=sql_content)
@@ -63,6 +69,7 @@ def query(request):
             return HttpResponse(json.dumps(result), content_type="application/json")
         if query_check_info.get("has_star") and config.get("disable_star") is True:
             # 引擎内部判断为有 * 且禁止 * 选项打开
+            query_engine.close()
             result["status"] = 1
             result["msg"] = query_check_info.get("msg")
             return HttpResponse(json.dumps(result), content_type="application/json")
@@ -76,6 +83,7 @@ def query(request):
             limit_num = priv_check_info["data"]["limit_num"]
             priv_check = priv_check_info["data"]["priv_check"]
         else:
+            query_engine.close()
             result["status"] = priv_check_info["status"]
             result["msg"] = priv_check_info["msg"]
             return HttpResponse(json.dumps(result), content_type="application/json")
@@ -84,33 +92,61 @@ def query(request):
 
         # 对查询sql增加limit限制或者改写语句
         sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
+        # 脱敏需要的语句解析与查询并行执行，脱敏时直接使用解析结果，失败时在脱敏阶段重新解析
+        if config.get("data_masking"):
+            query_engine.prefetch_query_masking(db_name=db_name, sql=sql_content)
 
-        # 先获取查询连接，用于后面查询复用连接以及终止会话
-        query_engine.get_connection(db_name=db_name)
-        thread_id = query_engine.thread_id
-        max_execution_time = int(config.get("max_execution_time", 60))
-        # 执行查询语句，并增加一个定时终止语句的schedule，timeout=max_execution_time
-        if thread_id:
-            schedule_name = f"query-{time.time()}"
-            run_date = datetime.datetime.now() + datetime.timedelta(
-                seconds=max_execution_time
-            )
-            add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
-        with FuncTimer() as t:
-            # 获取主从延迟信息
-            seconds_behind_master = query_engine.seconds_behind_master
-            query_result = query_engine.query(
+        # 流式返回或者异步执行，服务端游标分批读取、分批脱敏，查询日志在读取结束后记录
+        if stream or run_async:
+            stream_query = StreamQuery(
+                user,
+                instance,
                 db_name,
                 sql_content,
                 limit_num,
+                priv_check,
+                query_engine,
+                config,
                 schema_name=schema_name,
                 tb_name=tb_name,
-                max_execution_time=max_execution_time * 1000,
             )
-        query_result.query_time = t.cost
-        # 返回查询结果后删除schedule
+            if run_async:
+                return _query_async(stream_query)
+            return _query_stream(stream_query)
+
+        # 先获取查询连接，用于后面查询复用连接以及终止会话，query_check已建立的会话会直接复用
+        query_engine.get_connection(db_name=db_name)
+        thread_id = query_engine.thread_id
+        max_execution_time = int(config.get("max_execution_time", 60))
+        # 执行查询语句，并由看门狗在max_execution_time后终止会话
+        watch = None
         if thread_id:
-            del_schedule(schedule_name)
+            watch = query_watchdog.watch(
+                max_execution_time, kill_query_conn, instance.id, thread_id
+            )
+        try:
+            with FuncTimer() as t:
+                # 会话准备，同时获取主从延迟信息
+                seconds_behind_master = query_engine.prepare_query_session(
+                    db_name=db_name, max_execution_time=max_execution_time * 1000
+                )
+                query_result = query_engine.query(
+                    db_name,
+                    sql_content,
+                    limit_num,
+                    close_conn=False,
+                    schema_name=schema_name,
+                    tb_name=tb_name,
+                    max_execution_time=max_execution_time * 1000,
+                )
+        finally:
+            # 先取消终止任务再归还连接，避免连接被复用后按thread_id终止其他会话
+            if query_watchdog.cancel(watch):
+                query_engine.close()
+            else:
+                # 终止任务已触发，连接随时可能被kill，不能再放回连接池
+                query_engine.discard_connection()
+        query_result.query_time = t.cost
 
         # 查询异常
         if query_result.error:
@@ -204,6 +240,322 @@ def query(request):
         )
 
 
+class StreamQuery:
+    """
+    流式查询和异步查询共用的执行过程：执行查询、分析脱敏列、按批次读取并脱敏、结束后记录查询日志
+    """
+
+    def __init__(
+        self,
+        user,
+        instance,
+        db_name,
+        sql_content,
+        limit_num,
+        priv_check,
+        query_engine,
+        config,
+        schema_name=None,
+        tb_name=None,
+    ):
+        self.user = user
+        self.instance = instance
+        self.db_name = db_name
+        self.sql_content = sql_content
+        self.limit_num = limit_num
+        self.priv_check = priv_check
+        self.query_engine = query_engine
+        self.config = config
+        self.schema_name = schema_name
+        self.tb_name = tb_name
+        self.max_execution_time = int(config.get("max_execution_time", 60))
+        self.query_result = None
+        self.seconds_behind_master = None
+        self.timed_out = False
+        self.start = None
+        self._watch = None
+
+    def execute(self):
+        """
+        执行查询并分析脱敏列，返回错误信息，无错误时返回None，行数据通过rows()分批读取
+        执行阶段抛出异常时丢弃连接、取消终止任务并记录查询日志，作为错误信息返回
+        """
+        try:
+            return self._execute()
+        except Exception as e:
+            logger.error(
+                f"查询异常报错，查询语句：{self.sql_content}\n，错误信息：{traceback.format_exc()}"
+            )
+            error = f"查询异常报错，错误信息：{e}"
+            # 未开始读取的服务端游标可能还有未读取的结果，连接不再放回连接池
+            self.query_engine.discard_connection()
+            self.finish(0, error)
+            return error
+
+    def _execute(self):
+        self.start = time.time()
+        self.query_engine.get_connection(db_name=self.db_name)
+        thread_id = self.query_engine.thread_id
+        # 数据读取完之前查询仍在执行，终止任务在读取结束后取消
+        if thread_id:
+            self._watch = query_watchdog.watch(
+                self.max_execution_time, self._kill, thread_id
+            )
+        self.seconds_behind_master = self.query_engine.prepare_query_session(
+            db_name=self.db_name, max_execution_time=self.max_execution_time * 1000
+        )
+        self.query_result = self.query_engine.query_stream(
+            self.db_name,
+            self.sql_content,
+            self.limit_num,
+            chunk_size=settings.QUERY_STREAM_CHUNK_SIZE,
+            schema_name=self.schema_name,
+            tb_name=self.tb_name,
+            max_execution_time=self.max_execution_time * 1000,
+            # 先取消终止任务再归还连接，避免连接被复用后按thread_id终止其他会话
+            before_release=lambda: query_watchdog.cancel(self._watch),
+        )
+        if self.query_result.error:
+            self.finish(0, self.query_result.error)
+            return self.query_result.error
+
+        # 数据脱敏，命中列在读取数据前分析，数据按批次脱敏，按照query_check配置是否返回
+        if self.config.get("data_masking"):
+            with FuncTimer() as t:
+                masking_result = self.query_engine.query_masking_stream(
+                    self.db_name, self.sql_content, self.query_result
+                )
+            if masking_result.error:
+                if self.config.get("query_check"):
+                    self.query_result.rows.close()
+                    error = f"数据脱敏异常：{masking_result.error}"
+                    self.finish(0, error)
+                    return error
+                logger.warning(
+                    f"数据脱敏异常，按照配置放行，查询语句：{self.sql_content}，错误信息：{masking_result.error}"
+                )
+                self.query_result.error = None
+            else:
+                self.query_result = masking_result
+                self.query_result.mask_time = t.cost
+        return None
+
+    def meta(self):
+        """结果集中除数据外的信息"""
+        meta = {
+            k: v
+            for k, v in self.query_result.__dict__.items()
+            if k not in ("rows", "error")
+        }
+        meta["seconds_behind_master"] = self.seconds_behind_master
+        return meta
+
+    def rows(self):
+        """分批读取行数据，读取结束、出错或者关闭时释放连接并记录查询日志"""
+        chunks = self.query_result.rows
+        affected_rows, error = 0, None
+        try:
+            for chunk in chunks:
+                affected_rows += len(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error(
+                f"查询异常报错，查询语句：{self.sql_content}\n，错误信息：{traceback.format_exc()}"
+            )
+            error = "查询超时，已终止" if self.timed_out else f"查询异常报错，错误信息：{e}"
+            raise RuntimeError(error) from e
+        finally:
+            chunks.close()
+            self.finish(affected_rows, error)
+
+    @property
+    def cost(self):
+        return round(time.time() - self.start, 4)
+
+    def finish(self, effect_row, error=None):
+        """取消终止任务并记录查询日志"""
+        query_watchdog.cancel(self._watch)
+        # 防止查询超时
+        if connection.connection and not connection.is_usable():
+            close_old_connections()
+        QueryLog(
+            username=self.user.username,
+            user_display=self.user.display,
+            db_name=self.db_name,
+            instance_name=self.instance.instance_name,
+            sqllog=self.sql_content,
+            effect_row=0 if error else effect_row,
+            cost_time=self.cost,
+            priv_check=self.priv_check,
+            hit_rule=self.query_result.mask_rule_hit if self.query_result else False,
+            masking=self.query_result.is_masked if self.query_result else False,
+        ).save()
+
+    def _kill(self, thread_id):
+        self.timed_out = True
+        kill_query_conn(self.instance.id, thread_id)
+
+
+def _dumps(data):
+    try:
+        return json.dumps(
+            data,
+            use_decimal=False,
+            cls=ExtendJSONEncoderFTime,
+            bigint_as_string=True,
+        )
+    # 虽然能正常返回，但是依然会乱码
+    except UnicodeDecodeError:
+        return json.dumps(data, default=str, bigint_as_string=True, encoding="latin1")
+
+
+def _query_stream(stream_query):
+    """
+    流式执行查询，返回NDJSON，每行一个JSON对象：
+    第一行type=meta为列信息、脱敏信息和主从延迟，之后每行type=rows为一批数据，
+    最后一行type=end为状态、返回行数和耗时，输出过程中出错时status为1
+    查询执行、脱敏分析出错时与普通查询一样直接返回JSON
+    """
+    error = stream_query.execute()
+    if error:
+        result = {"status": 1, "msg": error, "data": {}}
+        return HttpResponse(json.dumps(result), content_type="application/json")
+
+    def stream_rows():
+        affected_rows, error = 0, None
+        yield _dumps({"type": "meta", "data": stream_query.meta()}) + "\n"
+        try:
+            for chunk in stream_query.rows():
+                affected_rows += len(chunk)
+                yield _dumps({"type": "rows", "data": chunk}) + "\n"
+        except RuntimeError as e:
+            error = str(e)
+        end = {
+            "type": "end",
+            "status": 1 if error else 0,
+            "msg": error or "ok",
+            "data": {"affected_rows": affected_rows, "query_time": stream_query.cost},
+        }
+        yield _dumps(end) + "\n"
+
+    return StreamingHttpResponse(stream_rows(), content_type="application/x-ndjson")
+
+
+def _query_async(stream_query):
+    """提交异步查询，返回查询ID，结果按批次写入AsyncQueryStore"""
+    store = AsyncQueryStore.create(
+        stream_query.user.username,
+        instance_name=stream_query.instance.instance_name,
+        db_name=stream_query.db_name,
+        sql=stream_query.sql_content,
+    )
+    if not submit_async_query(_run_async_query, stream_query, store):
+        stream_query.query_engine.close()
+        store.update_meta(status="failed", msg="异步查询任务繁忙，请稍后再试")
+        result = {"status": 1, "msg": "异步查询任务繁忙，请稍后再试", "data": {}}
+    else:
+        result = {"status": 0, "msg": "ok", "data": {"query_id": store.query_id}}
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
+
+def _run_async_query(stream_query, store):
+    """在异步查询线程中执行查询，每批数据作为一页写入结果存储"""
+    store.update_meta(status="running")
+    try:
+        error = stream_query.execute()
+        if error:
+            store.update_meta(status="failed", msg=error)
+            return
+        meta = stream_query.meta()
+        # ResultSet的status不是异步查询的状态
+        meta.pop("status", None)
+        store.update_meta(**meta)
+        page, affected_rows = 0, 0
+        for chunk in stream_query.rows():
+            page += 1
+            affected_rows += len(chunk)
+            store.put_page(page, [list(row) for row in chunk])
+            store.update_meta(pages=page, affected_rows=affected_rows)
+        store.update_meta(status="finished", query_time=stream_query.cost)
+    except Exception as e:
+        store.update_meta(status="failed", msg=str(e))
+
+
+def _async_query_store(request):
+    """获取当前用户提交的异步查询，不存在或者不属于当前用户时返回错误信息"""
+    store = AsyncQueryStore(request.GET.get("query_id", ""))
+    meta = store.get_meta()
+    if not meta or meta["username"] != request.user.username:
+        return store, None, "查询不存在或已过期"
+    return store, meta, None
+
+
+@permission_required("sql.query_submit", raise_exception=True)
+def query_async_result(request):
+    """
+    轮询异步查询结果，page从1开始，返回查询状态和该页数据，
+    status为queued/running时稍后重试，finished时pages为总页数
+    """
+    store, meta, error = _async_query_store(request)
+    if error:
+        result = {"status": 1, "msg": error, "data": {}}
+        return HttpResponse(json.dumps(result), content_type="application/json")
+    page = int(request.GET.get("page", 1))
+    data = dict(meta, page=page, rows=None)
+    if 0 < page <= meta["pages"]:
+        data["rows"] = store.get_page(page)
+        if data["rows"] is None:
+            result = {"status": 1, "msg": "查询结果已过期", "data": {}}
+            return HttpResponse(json.dumps(result), content_type="application/json")
+    result = {"status": 0, "msg": "ok", "data": data}
+    return HttpResponse(_dumps(result), content_type="application/json")
+
+
+@permission_required("sql.query_submit", raise_exception=True)
+def query_async_stream(request):
+    """
+    流式获取异步查询结果，返回NDJSON，格式与流式查询一致，从page参数指定的页开始输出已写入的分页，
+    查询仍在执行时最后一行type=pending，data.page为下次请求的起始页，由客户端稍后重试，不在服务端等待
+    """
+    store, meta, error = _async_query_store(request)
+    if error:
+        result = {"status": 1, "msg": error, "data": {}}
+        return HttpResponse(json.dumps(result), content_type="application/json")
+    try:
+        start_page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        result = {"status": 1, "msg": "page参数不合法", "data": {}}
+        return HttpResponse(json.dumps(result), content_type="application/json")
+
+    def stream_pages():
+        page = start_page
+        # 从第一页开始读取时先输出列信息
+        if page == 1 and "column_list" in meta:
+            yield _dumps({"type": "meta", "data": meta}) + "\n"
+        while page <= meta["pages"]:
+            rows = store.get_page(page)
+            if rows is None:
+                yield _dumps({"type": "end", "status": 1, "msg": "查询结果已过期"}) + "\n"
+                return
+            yield _dumps({"type": "rows", "data": rows}) + "\n"
+            page += 1
+        if meta["status"] in ("finished", "failed"):
+            end = {
+                "type": "end",
+                "status": 0 if meta["status"] == "finished" else 1,
+                "msg": meta["msg"] or "ok",
+                "data": {
+                    "affected_rows": meta["affected_rows"],
+                    "query_time": meta.get("query_time"),
+                },
+            }
+        else:
+            end = {"type": "pending", "data": {"status": meta["status"], "page": page}}
+        yield _dumps(end) + "\n"
+
+    return StreamingHttpResponse(stream_pages(), content_type="application/x-ndjson")
+
+
 @permission_required("sql.menu_sqlquery", raise_exception=True)
 def querylog(request):
     return _querylog(request)
@@ -216,7 +568,8 @@ def querylog_audit(request):
 
 def _querylog(request):
     """
-    获取sql查询记录
+    获取sql查询记录，传入before_id时按ID游标分页，返回该ID之前的limit条记录
+    总数默认最多统计到QUERY_LOG_COUNT_LIMIT，count=exact时精确统计
     :param request:
     :return:
     """
@@ -229,6 +582,8 @@ def _querylog(request):
     limit = limit if limit else None
     star = True if request.GET.get("star") == "true" else False
     query_log_id = request.GET.get("query_log_id")
+    before_id = request.GET.get("before_id")
+    exact_count = request.GET.get("count") == "exact"
     search = request.GET.get("search", "")
     start_date = request.GET.get("start_date", "")
     end_date = request.GET.get("end_date", "")
@@ -256,13 +611,12 @@ def _querylog(request):
     sql_log = QueryLog.objects.filter(**filter_dict)
 
     # 过滤搜索信息
-    sql_log = sql_log.filter(
-        Q(sqllog__icontains=search)
-        | Q(user_display__icontains=search)
-        | Q(alias__icontains=search)
-    )
+    sql_log = search_query_log(sql_log, search)
 
-    sql_log_count = sql_log.count()
+    sql_log_count = count_query_log(sql_log, exact=exact_count)
+    if before_id:
+        sql_log = sql_log.filter(id__lt=before_id)
+        offset, limit = 0, limit - offset if limit else None
     sql_log_list = sql_log.order_by("-id")[offset:limit].values(
         "id",
         "instance_name",
@@ -305,7 +659,7 @@ def favorite(request):
 
 
 def kill_query_conn(instance_id, thread_id):
-    """终止查询会话，用于schedule调用"""
+    """终止查询会话，用于查询超时看门狗调用，历史的schedule任务也会调用"""
     instance = Instance.objects.get(pk=instance_id)
     query_engine = get_engine(instance)
     query_engine.kill_connection(thread_id)
@@ -8,12 +8,17 @@
 import logging
 import datetime
 import re
+import threading
+import time
 import traceback
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
@@ -25,6 +30,7 @@ from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines.goinception import GoInceptionEngine
 from sql.models import QueryPrivilegesApply, QueryPrivileges, Instance, ResourceGroup
 from sql.notify import notify_for_audit
+from sql.utils.query_tree_cache import query_tree_cache
 from sql.utils.resource_group import user_groups, user_instances
 from sql.utils.workflow_audit import Audit, AuditException, get_auditor
 from sql.utils.sql_utils import extract_tables
@@ -33,6 +39,12 @@ logger = logging.getLogger("default")
 
 __author__ = "hhyo"
 
+# 权限索引进程内缓存时间(秒)，权限变更通过版本号立即失效，超时用于兜底直接修改数据库等场景
+PRIV_INDEX_TIMEOUT = 60
+PRIV_INDEX_MAX_SIZE = 5000
+_priv_index_cache = {}
+_priv_index_lock = threading.Lock()
+
 
 # TODO 权限校验内的语法解析和判断独立到每个engine内
 def query_priv_check(user, instance, db_name, sql_content, limit_num):
@@ -71,11 +83,14 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
                 return result
             # 其他权限校验
             table_ref = _table_ref(sql_content, instance, db_name)
-            # 循环验证权限，可能存在性能问题，但一次查询涉及的库表数量有限
+            # 用户在该实例的全部权限只加载一次，循环中直接从索引中获取
+            resolver = QueryPrivResolver(user, instance)
             for table in table_ref:
                 # 既无库权限也无表权限则鉴权失败
-                if not _db_priv(user, instance, table["schema"]) and not _tb_priv(
-                    user, instance, table["schema"], table["name"]
+                if not _db_priv(
+                    user, instance, table["schema"], resolver=resolver
+                ) and not _tb_priv(
+                    user, instance, table["schema"], table["name"], resolver=resolver
                 ):
                     # 没有库表查询权限时的staus为2
                     result["status"] = 2
@@ -86,7 +101,11 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
             # 获取查询涉及库/表权限的最小limit限制，和前端传参作对比，取最小值
             for table in table_ref:
                 priv_limit = _priv_limit(
-                    user, instance, db_name=table["schema"], tb_name=table["name"]
+                    user,
+                    instance,
+                    db_name=table["schema"],
+                    tb_name=table["name"],
+                    resolver=resolver,
                 )
                 limit_num = min(priv_limit, limit_num) if limit_num else priv_limit
             result["data"]["limit_num"] = limit_num
@@ -113,15 +132,16 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
         # 排序
         dbs.sort()
         # 校验库权限，无库权限直接返回
+        resolver = QueryPrivResolver(user, instance)
         for db_name in dbs:
-            if not _db_priv(user, instance, db_name):
+            if not _db_priv(user, instance, db_name, resolver=resolver):
                 # 没有库表查询权限时的staus为2
                 result["status"] = 2
                 result["msg"] = f"你无{db_name}数据库的查询权限！请先到查询权限管理进行申请"
                 return result
         # 有所有库权限则获取最小limit值
         for db_name in dbs:
-            priv_limit = _priv_limit(user, instance, db_name=db_name)
+            priv_limit = _priv_limit(user, instance, db_name=db_name, resolver=resolver)
             limit_num = min(priv_limit, limit_num) if limit_num else priv_limit
         result["data"]["limit_num"] = limit_num
     return result
@@ -455,6 +475,31 @@ def query_priv_audit(request):
     return HttpResponseRedirect(reverse("sql:queryapplydetail", args=(apply_id,)))
 
 
+def prefetch_table_ref(user, instance, db_name, sql_content):
+    """
+    在查询检查的同时提前解析语句涉及的表，query_priv_check中的_table_ref直接复用解析结果
+    仅对需要做表权限校验的MySQL查询生效
+    :param user:
+    :param instance:
+    :param db_name:
+    :param sql_content:
+    :return:
+    """
+    if instance.db_type != "mysql" or user.has_perm("sql.query_all_instances"):
+        return False
+    sql_content = sql_content.strip()
+    if re.match(r"^explain|^show\s+create", sql_content, re.I):
+        return False
+    engine = GoInceptionEngine()
+    return query_tree_cache.prefetch(
+        instance,
+        db_name,
+        "print",
+        sql_content,
+        lambda: engine.query_print(instance=instance, db_name=db_name, sql=sql_content),
+    )
+
+
 def _table_ref(sql_content, instance, db_name):
     """
     解析语法树，获取语句涉及的表，用于查询权限限制
@@ -464,75 +509,150 @@ def _table_ref(sql_content, instance, db_name):
     :return:
     """
     engine = GoInceptionEngine()
-    query_tree = engine.query_print(
-        instance=instance, db_name=db_name, sql=sql_content
+    # 引用表只和语句结构有关，缓存的语法树中的字面量可能来自其他语句，不可使用
+    query_tree = query_tree_cache.get_or_set(
+        instance,
+        db_name,
+        "print",
+        sql_content,
+        lambda: engine.query_print(instance=instance, db_name=db_name, sql=sql_content),
     ).get("query_tree")
     return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
 
 
-def _db_priv(user, instance, db_name):
+def _priv_version_key(user_name):
+    return f"query_privileges_version:{user_name}"
+
+
+def invalidate_query_privileges(user_name):
+    """递增用户的权限版本号，所有进程中缓存的该用户权限索引失效"""
+    key = _priv_version_key(user_name)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+    except Exception as e:
+        logger.warning(f"查询权限缓存失效失败，用户：{user_name}，错误信息：{e}")
+
+
+def _load_priv_index(user_name, instance):
+    """
+    一次查询加载用户在实例上全部有效的查询权限，按照(库, 表)建立索引，库权限的表为None
+    同一库表存在多条权限时与逐条查询一致，取最早授予的一条
+    库表名统一转为小写，与Archery库_ci排序规则下的不区分大小写匹配一致
+    """
+    today = datetime.date.today()
+    key = (user_name, instance.id, today)
+    try:
+        version = cache.get(_priv_version_key(user_name), 0)
+    except Exception as e:
+        logger.warning(f"获取查询权限缓存版本失败，跳过缓存，错误信息：{e}")
+        version = None
+    now = time.monotonic()
+    if version is not None:
+        entry = _priv_index_cache.get(key)
+        if entry and entry[0] == version and now - entry[1] < PRIV_INDEX_TIMEOUT:
+            return entry[2]
+    privileges = (
+        QueryPrivileges.objects.filter(
+            user_name=user_name,
+            instance=instance,
+            valid_date__gte=today,
+            is_deleted=0,
+            priv_type__in=[1, 2],
+        )
+        .order_by("privilege_id")
+        .values_list("db_name", "table_name", "priv_type", "limit_num")
+    )
+    index = {}
+    for db_name, table_name, priv_type, limit_num in privileges:
+        index.setdefault(
+            (db_name.lower(), table_name.lower() if priv_type == 2 else None),
+            limit_num,
+        )
+    if version is not None:
+        with _priv_index_lock:
+            if len(_priv_index_cache) >= PRIV_INDEX_MAX_SIZE:
+                _priv_index_cache.clear()
+            _priv_index_cache[key] = (version, now, index)
+    return index
+
+
+class QueryPrivResolver:
+    """用户在实例上的查询权限，首次使用时加载全部有效权限，权限校验和limit计算都从索引中获取"""
+
+    def __init__(self, user, instance):
+        self.user = user
+        self.instance = instance
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = _load_priv_index(self.user.username, self.instance)
+        return self._index
+
+    def db_limit(self, db_name):
+        return self.index.get((str(db_name).lower(), None), False)
+
+    def tb_limit(self, db_name, tb_name):
+        return self.index.get((str(db_name).lower(), str(tb_name).lower()), False)
+
+
+@receiver(post_save, sender=QueryPrivileges)
+@receiver(post_delete, sender=QueryPrivileges)
+def invalidate_privileges_on_change(sender, instance, **kwargs):
+    """权限授予、变更、删除后使该用户缓存的权限索引失效"""
+    invalidate_query_privileges(instance.user_name)
+
+
+def _db_priv(user, instance, db_name, resolver=None):
     """
     检测用户是否拥有指定库权限
     :param user: 用户对象
     :param instance: 实例对象
     :param db_name: 库名
+    :param resolver: 同一次校验共用的QueryPrivResolver，为空时单独加载
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     TODO 返回统一为 int 类型, 不存在返回0 (虽然其实在python中 0==False)
     """
     if user.is_superuser:
         return int(SysConfig().get("admin_query_limit", 5000))
     # 获取用户库权限
-    user_privileges = QueryPrivileges.objects.filter(
-        user_name=user.username,
-        instance=instance,
-        db_name=str(db_name),
-        valid_date__gte=datetime.datetime.now(),
-        is_deleted=0,
-        priv_type=1,
-    )
-    if user_privileges.exists():
-        return user_privileges.first().limit_num
-    return False
+    resolver = resolver or QueryPrivResolver(user, instance)
+    return resolver.db_limit(db_name)
 
 
-def _tb_priv(user, instance, db_name, tb_name):
+def _tb_priv(user, instance, db_name, tb_name, resolver=None):
     """
     检测用户是否拥有指定表权限
     :param user: 用户对象
     :param instance: 实例对象
     :param db_name: 库名
     :param tb_name: 表名
+    :param resolver: 同一次校验共用的QueryPrivResolver，为空时单独加载
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     """
-    # 获取用户表权限
-    user_privileges = QueryPrivileges.objects.filter(
-        user_name=user.username,
-        instance=instance,
-        db_name=str(db_name),
-        table_name=str(tb_name),
-        valid_date__gte=datetime.datetime.now(),
-        is_deleted=0,
-        priv_type=2,
-    )
     if user.is_superuser:
         return int(SysConfig().get("admin_query_limit", 5000))
-    else:
-        if user_privileges.exists():
-            return user_privileges.first().limit_num
-    return False
+    # 获取用户表权限
+    resolver = resolver or QueryPrivResolver(user, instance)
+    return resolver.tb_limit(db_name, tb_name)
 
 
-def _priv_limit(user, instance, db_name, tb_name=None):
+def _priv_limit(user, instance, db_name, tb_name=None, resolver=None):
     """
     获取用户拥有的查询权限的最小limit限制，用于返回结果集限制
     :param db_name:
     :param tb_name: 可为空，为空时返回库权限
+    :param resolver: 同一次校验共用的QueryPrivResolver
     :return:
     """
     # 获取库表权限limit值
-    db_limit_num = _db_priv(user, instance, db_name)
+    db_limit_num = _db_priv(user, instance, db_name, resolver=resolver)
     if tb_name:
-        tb_limit_num = _tb_priv(user, instance, db_name, tb_name)
+        tb_limit_num = _tb_priv(user, instance, db_name, tb_name, resolver=resolver)
     else:
         tb_limit_num = None
     # 返回最小值
@@ -592,3 +712,5 @@ def _query_apply_audit_call_back(apply_id, workflow_status):
                 for table_name in apply_queryset.table_list.split(",")
             ]
         QueryPrivileges.objects.bulk_create(insert_list)
+        # bulk_create不会触发post_save，需要主动使权限缓存失效
+        invalidate_query_privileges(apply_queryset.user_name)
@@ -13,7 +13,7 @@ from common.utils.chart_dao import ChartDao
 
 from sql.utils.resource_group import user_instances
 from common.utils.extend_json_encoder import ExtendJSONEncoder
-from .models import Instance, SlowQuery, SlowQueryHistory, AliyunRdsConfig
+from .models import Instance, SlowQueryHistory, SlowQueryRollupDaily, AliyunRdsConfig
 
 
 import logging
@@ -55,34 +55,29 @@ def slowquery_review(request):
         end_time = datetime.datetime.strptime(
             end_time, "%Y-%m-%d"
         ) + datetime.timedelta(days=1)
-        filter_kwargs = {"slowqueryhistory__db_max": db_name} if db_name else {}
-        # 获取慢查数据
+        filter_kwargs = {"db_name": db_name} if db_name else {}
+        if search:
+            filter_kwargs["checksum__fingerprint__icontains"] = search
+        # 获取慢查数据，从按天汇总的数据中统计
         slowsql_obj = (
-            SlowQuery.objects.filter(
-                slowqueryhistory__hostname_max=(
-                    instance_info.host + ":" + str(instance_info.port)
-                ),
-                slowqueryhistory__ts_min__range=(start_time, end_time),
-                fingerprint__icontains=search,
+            SlowQueryRollupDaily.objects.filter(
+                hostname=(instance_info.host + ":" + str(instance_info.port)),
+                bucket__gte=start_time,
+                bucket__lt=end_time,
                 **filter_kwargs
             )
-            .annotate(SQLText=F("fingerprint"), SQLId=F("checksum"))
+            .annotate(SQLText=F("checksum__fingerprint"), SQLId=F("checksum"))
             .values("SQLText", "SQLId")
             .annotate(
-                CreateTime=Max("slowqueryhistory__ts_max"),
-                DBName=Max("slowqueryhistory__db_max"),  # 数据库
-                QueryTimeAvg=Sum("slowqueryhistory__query_time_sum")
-                / Sum("slowqueryhistory__ts_cnt"),  # 平均执行时长
-                MySQLTotalExecutionCounts=Sum("slowqueryhistory__ts_cnt"),  # 执行总次数
-                MySQLTotalExecutionTimes=Sum(
-                    "slowqueryhistory__query_time_sum"
-                ),  # 执行总时长
-                ParseTotalRowCounts=Sum("slowqueryhistory__rows_examined_sum"),  # 扫描总行数
-                ReturnTotalRowCounts=Sum("slowqueryhistory__rows_sent_sum"),  # 返回总行数
-                ParseRowAvg=Sum("slowqueryhistory__rows_examined_sum")
-                / Sum("slowqueryhistory__ts_cnt"),  # 平均扫描行数
-                ReturnRowAvg=Sum("slowqueryhistory__rows_sent_sum")
-                / Sum("slowqueryhistory__ts_cnt"),  # 平均返回行数
+                CreateTime=Max("ts_max"),
+                DBName=Max("db_name"),  # 数据库
+                QueryTimeAvg=Sum("query_time_sum") / Sum("ts_cnt"),  # 平均执行时长
+                MySQLTotalExecutionCounts=Sum("ts_cnt"),  # 执行总次数
+                MySQLTotalExecutionTimes=Sum("query_time_sum"),  # 执行总时长
+                ParseTotalRowCounts=Sum("rows_examined_sum"),  # 扫描总行数
+                ReturnTotalRowCounts=Sum("rows_sent_sum"),  # 返回总行数
+                ParseRowAvg=Sum("rows_examined_sum") / Sum("ts_cnt"),  # 平均扫描行数
+                ReturnRowAvg=Sum("rows_sent_sum") / Sum("ts_cnt"),  # 平均返回行数
             )
         )
         slow_sql_count = slowsql_obj.count()
@@ -100,6 +95,7 @@ def slowquery_review(request):
             )
             SlowLog["ParseRowAvg"] = int(SlowLog["ParseRowAvg"])
             SlowLog["ReturnRowAvg"] = int(SlowLog["ReturnRowAvg"])
+            SlowLog["DBName"] = SlowLog["DBName"] or None
             sql_slow_log.append(SlowLog)
         result = {"total": slow_sql_count, "rows": sql_slow_log}
 
@@ -167,26 +167,12 @@ def optimize_sqltuning(request):
     sql_tunning = SqlTuning(
         instance_name=instance_name, db_name=db_name, sqltext=sqltext
     )
-    result = {"status": 0, "msg": "ok", "data": {}}
-    if "sys_parm" in option:
-        basic_information = sql_tunning.basic_information()
-        sys_parameter = sql_tunning.sys_parameter()
-        optimizer_switch = sql_tunning.optimizer_switch()
-        result["data"]["basic_information"] = basic_information
-        result["data"]["sys_parameter"] = sys_parameter
-        result["data"]["optimizer_switch"] = optimizer_switch
-    if "sql_plan" in option:
-        plan, optimizer_rewrite_sql = sql_tunning.sqlplan()
-        result["data"]["optimizer_rewrite_sql"] = optimizer_rewrite_sql
-        result["data"]["plan"] = plan
-    if "obj_stat" in option:
-        result["data"]["object_statistics"] = sql_tunning.object_statistics()
-    if "sql_profile" in option:
-        session_status = sql_tunning.exec_sql()
-        result["data"]["session_status"] = session_status
+    data, timings = sql_tunning.diagnose(option)
+    result = {"status": 0, "msg": "ok", "data": data}
     # 关闭连接
     sql_tunning.engine.close()
     result["data"]["sqltext"] = sqltext
+    result["data"]["timings"] = timings
     return HttpResponse(
         json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
         content_type="application/json",
@@ -1,17 +1,25 @@
 # -*- coding: UTF-8 -*-
 
+import threading
 import time
 
+from django.conf import settings
+
 from common.utils.const import SQLTuning
 from sql.engines import get_engine
 from sql.models import Instance
 from sql.utils.sql_utils import extract_tables
 
+# 按实例缓存版本号和系统参数，{instance_id: (过期时间, {键: 值})}
+_instance_info_cache = {}
+_instance_info_lock = threading.Lock()
+
 
 class SqlTuning(object):
     def __init__(self, instance_name, db_name, sqltext):
         instance = Instance.objects.get(instance_name=instance_name)
         query_engine = get_engine(instance=instance)
+        self.instance = instance
         self.engine = query_engine
         self.db_name = self.engine.escape_string(db_name)
         self.sqltext = sqltext
@@ -62,60 +70,115 @@ class SqlTuning(object):
         """获取sql语句中的表名"""
         return [i["name"].strip("`") for i in extract_tables(self.sqltext)]
 
+    def _cached(self, name, func):
+        """版本号、系统参数等实例信息按SQL_TUNING_CACHE_TTL在进程内缓存，0表示不缓存"""
+        ttl = settings.SQL_TUNING_CACHE_TTL
+        now = time.monotonic()
+        with _instance_info_lock:
+            expires_at, info = _instance_info_cache.get(self.instance.id, (0, {}))
+            if expires_at > now and name in info:
+                return info[name]
+        value = func()
+        if ttl:
+            with _instance_info_lock:
+                expires_at, info = _instance_info_cache.get(self.instance.id, (0, {}))
+                if expires_at <= now:
+                    info = {}
+                    expires_at = now + ttl
+                info[name] = value
+                _instance_info_cache[self.instance.id] = (expires_at, info)
+        return value
+
+    @property
+    def server_version(self):
+        return self._cached("server_version", lambda: self.engine.server_version)
+
+    def _schema(self, sql):
+        """MySQL 5.7之前的全局变量、会话状态在information_schema中"""
+        if self.server_version < (5, 7, 0):
+            return sql.replace("performance_schema", "information_schema")
+        return sql
+
+    def _system_information(self):
+        """版本、系统参数、优化器开关合并为一次请求获取"""
+        basic_information, sys_parameter, optimizer_switch = self.engine.query_batch(
+            sqls=[
+                "select @@version",
+                self._schema(self.sql_variable),
+                self._schema(self.sql_optimizer_switch),
+            ]
+        )
+        return {
+            "basic_information": basic_information.to_sep_dict(),
+            "sys_parameter": sys_parameter.to_sep_dict(),
+            "optimizer_switch": optimizer_switch.to_sep_dict(),
+        }
+
+    def system_information(self):
+        return self._cached("system_information", self._system_information)
+
     def basic_information(self):
-        return self.engine.query(sql="select @@version", close_conn=False).to_sep_dict()
+        return self.system_information()["basic_information"]
 
     def sys_parameter(self):
-        # 获取mysql版本信息
-        server_version = self.engine.server_version
-        if server_version < (5, 7, 0):
-            sql = self.sql_variable.replace("performance_schema", "information_schema")
-        else:
-            sql = self.sql_variable
-        return self.engine.query(sql=sql, close_conn=False).to_sep_dict()
+        return self.system_information()["sys_parameter"]
 
     def optimizer_switch(self):
-        # 获取mysql版本信息
-        server_version = self.engine.server_version
-        if server_version < (5, 7, 0):
-            sql = self.sql_optimizer_switch.replace(
-                "performance_schema", "information_schema"
-            )
-        else:
-            sql = self.sql_optimizer_switch
-        return self.engine.query(sql=sql, close_conn=False).to_sep_dict()
+        return self.system_information()["optimizer_switch"]
 
     def sqlplan(self):
-        plan = self.engine.query(
-            self.db_name, "explain " + self.sqltext, close_conn=False
-        ).to_sep_dict()
-        optimizer_rewrite_sql = self.engine.query(
-            sql="show warnings", close_conn=False
-        ).to_sep_dict()
-        return plan, optimizer_rewrite_sql
+        # show warnings需要紧跟在explain之后，在同一次请求中执行
+        plan, optimizer_rewrite_sql = self.engine.query_batch(
+            db_name=self.db_name, sqls=["explain " + self.sqltext, "show warnings"]
+        )
+        return plan.to_sep_dict(), optimizer_rewrite_sql.to_sep_dict()
 
-    # 获取关联表信息存在缺陷，只能获取到一张表
     def object_statistics(self):
-        object_statistics = []
-        for index, table_name in enumerate(self.__extract_tables()):
-            object_statistics.append(
-                {
-                    "structure": self.engine.query(
-                        db_name=self.db_name,
-                        sql=f"show create table `{table_name}`;",
-                        close_conn=False,
-                    ).to_sep_dict(),
-                    "table_info": self.engine.query(
-                        sql=self.sql_table_info % (self.db_name, table_name),
-                        close_conn=False,
-                    ).to_sep_dict(),
-                    "index_info": self.engine.query(
-                        sql=self.sql_table_index % (self.db_name, table_name),
-                        close_conn=False,
-                    ).to_sep_dict(),
-                }
-            )
-        return object_statistics
+        """所有关联表的表结构、表信息、索引信息合并为一次请求获取"""
+        table_names = self.__extract_tables()
+        sqls = []
+        for table_name in table_names:
+            sqls += [
+                f"show create table `{table_name}`",
+                self.sql_table_info % (self.db_name, table_name),
+                self.sql_table_index % (self.db_name, table_name),
+            ]
+        results = self.engine.query_batch(db_name=self.db_name, sqls=sqls)
+        return [
+            {
+                "structure": results[index * 3].to_sep_dict(),
+                "table_info": results[index * 3 + 1].to_sep_dict(),
+                "index_info": results[index * 3 + 2].to_sep_dict(),
+            }
+            for index in range(len(table_names))
+        ]
+
+    def diagnose(self, options):
+        """
+        按选项收集诊断信息，返回诊断数据和每一步的耗时(毫秒)
+        :param options: sys_parm、sql_plan、obj_stat、sql_profile
+        """
+        data = {}
+        timings = {}
+        if "sys_parm" in options:
+            start = time.perf_counter()
+            data.update(self.system_information())
+            timings["sys_parm"] = round((time.perf_counter() - start) * 1000, 2)
+        if "sql_plan" in options:
+            start = time.perf_counter()
+            plan, optimizer_rewrite_sql = self.sqlplan()
+            data["optimizer_rewrite_sql"] = optimizer_rewrite_sql
+            data["plan"] = plan
+            timings["sql_plan"] = round((time.perf_counter() - start) * 1000, 2)
+        if "obj_stat" in options:
+            start = time.perf_counter()
+            data["object_statistics"] = self.object_statistics()
+            timings["obj_stat"] = round((time.perf_counter() - start) * 1000, 2)
+        if "sql_profile" in options:
+            start = time.perf_counter()
+            data["session_status"] = self.exec_sql()
+            timings["sql_profile"] = round((time.perf_counter() - start) * 1000, 2)
+        return data, timings
 
     def exec_sql(self):
         result = {
@@ -136,12 +199,8 @@ class SqlTuning(object):
                             variable_value var_value 
                         from performance_schema.session_status order by 1"""
 
-        # 获取mysql版本信息
-        server_version = self.engine.server_version
-        if server_version < (5, 7, 0):
-            sql = sql_profiling.replace("performance_schema", "information_schema")
-        else:
-            sql = sql_profiling
+        sql = self._schema(sql_profiling)
+        # 开启profiling修改了会话状态，引擎关闭时该连接不再放回连接池
         self.engine.query(sql="set profiling=1", close_conn=False).to_sep_dict()
         records = self.engine.query(
             sql="select ifnull(max(query_id),0) from INFORMATION_SCHEMA.PROFILING",
@@ -19,6 +19,7 @@ from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.notify import notify_for_audit, EventType, notify_for_execute
+from sql.utils.execute_progress import committed_rows, execute_percentage
 from sql.utils.resource_group import user_groups
 from sql.utils.sql_review import (
     can_timingtask,
@@ -27,6 +28,7 @@ from sql.utils.sql_review import (
     on_correct_time_period,
     can_view,
     can_rollback,
+    get_rollback_sql,
 )
 from sql.utils.tasks import add_sql_schedule, del_schedule
 from sql.utils.workflow_audit import Audit, get_auditor, AuditException
@@ -134,44 +136,40 @@ def detail_content(request):
     workflow_detail = get_object_or_404(SqlWorkflow, pk=workflow_id)
     if not can_view(request.user, workflow_id):
         raise PermissionDenied
+    # 分批执行中的工单展示已提交批次的执行结果
+    executed_rows = (
+        committed_rows(workflow_id)
+        if workflow_detail.status == "workflow_executing"
+        else []
+    )
     if workflow_detail.status in ["workflow_finish", "workflow_exception"]:
         rows = workflow_detail.sqlworkflowcontent.execute_result
+    elif executed_rows:
+        rows = json.dumps(executed_rows)
     else:
         rows = workflow_detail.sqlworkflowcontent.review_content
 
-    review_result = ReviewSet()
     if rows:
         try:
-            # 检验rows能不能正常解析
-            loaded_rows = json.loads(rows)
-            #  兼容旧数据'[[]]'格式，转换为新格式[{}]
-            if isinstance(loaded_rows[-1], list):
-                for r in loaded_rows:
-                    review_result.rows += [ReviewResult(inception_result=r)]
-                rows = review_result.json()
-        except IndexError:
-            review_result.rows += [
-                ReviewResult(
-                    id=1,
-                    sql=workflow_detail.sqlworkflowcontent.sql_content,
-                    errormessage="Json decode failed." "执行结果Json解析失败, 请联系管理员",
-                )
-            ]
-            rows = review_result.json()
-        except json.decoder.JSONDecodeError:
-            review_result.rows += [
+            # 检验rows能不能正常解析，兼容列式格式和旧数据的[{}]、[[]]格式，统一转换为[{}]
+            loaded_rows = ReviewSet.load_rows(rows)
+        except (ValueError, KeyError, TypeError):
+            loaded_rows = []
+        if not loaded_rows:
+            loaded_rows = [
                 ReviewResult(
                     id=1,
                     sql=workflow_detail.sqlworkflowcontent.sql_content,
                     # 迫于无法单元测试这里加上英文报错信息
                     errormessage="Json decode failed." "执行结果Json解析失败, 请联系管理员",
-                )
+                ).__dict__
             ]
-            rows = review_result.json()
     else:
-        rows = workflow_detail.sqlworkflowcontent.review_content
+        loaded_rows = ReviewSet.load_rows(
+            workflow_detail.sqlworkflowcontent.review_content
+        )
 
-    result = {"rows": json.loads(rows)}
+    result = {"rows": loaded_rows}
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
@@ -181,15 +179,30 @@ def backup_sql(request):
     if not can_rollback(request.user, workflow_id):
         raise PermissionDenied
     workflow = get_object_or_404(SqlWorkflow, pk=workflow_id)
+    # 传入limit时分页返回，不传时返回全部回滚语句
+    limit = request.GET.get("limit")
+    try:
+        offset = max(int(request.GET.get("offset") or 0), 0)
+        limit = max(int(limit), 0) if limit else None
+    except ValueError:
+        return JsonResponse({"status": 1, "msg": "分页参数不合法", "rows": []})
 
     try:
-        query_engine = get_engine(instance=workflow.instance)
-        list_backup_sql = query_engine.get_rollback(workflow=workflow)
+        list_backup_sql = get_rollback_sql(workflow)
     except Exception as msg:
         logger.error(traceback.format_exc())
         return JsonResponse({"status": 1, "msg": f"{msg}", "rows": []})
 
-    result = {"status": 0, "msg": "", "rows": list_backup_sql}
+    search = request.GET.get("search")
+    if search:
+        list_backup_sql = [
+            row for row in list_backup_sql if search in row[0] or search in row[1]
+        ]
+    if limit is not None:
+        rows = list_backup_sql[offset : offset + limit]
+    else:
+        rows = list_backup_sql
+    result = {"status": 0, "msg": "", "total": len(list_backup_sql), "rows": rows}
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
@@ -495,6 +508,11 @@ def get_workflow_status(request):
     workflow_id = int(workflow_id)
     workflow_detail = get_object_or_404(SqlWorkflow, pk=workflow_id)
     result = {"status": workflow_detail.status, "msg": "", "data": ""}
+    # 分批执行的工单返回已提交语句的百分比
+    if workflow_detail.status == "workflow_executing":
+        percentage = execute_percentage(workflow_id)
+        if percentage is not None:
+            result["data"] = {"execute_percentage": percentage}
     return JsonResponse(result)
 
 
@@ -35,6 +35,7 @@ from sql.notify import (
     notify_for_my2sql,
     MailNotifier,
 )
+from sql.utils.notify_dispatcher import notify_dispatcher
 
 User = get_user_model()
 
@@ -196,12 +197,46 @@ class TestNotify(TestCase):
         n.sys_config_key = "not-foo"
         self.assertFalse(n.should_run())
 
+    @patch("sql.notify.FeishuWebhookNotifier.render")
     @patch("sql.notify.FeishuWebhookNotifier.run")
-    def test_auto_notify(self, mock_run):
-        with self.settings(ENABLED_NOTIFIERS=("sql.notify:FeishuWebhookNotifier",)):
-            auto_notify(self.sys_config, event_type=EventType.EXECUTE, workflow=self.wf)
+    def test_auto_notify(self, mock_run, mock_render):
+        self.sys_config.set("feishu_webhook", "true")
+        with self.settings(
+            ENABLED_NOTIFIERS=("sql.notify:FeishuWebhookNotifier",),
+            NOTIFY={"RETRIES": 0},
+        ):
+            # 事务提交后才交给发送线程
+            with self.captureOnCommitCallbacks(execute=True):
+                auto_notify(
+                    self.sys_config, event_type=EventType.EXECUTE, workflow=self.wf
+                )
+                mock_render.assert_called_once()
+                mock_run.assert_not_called()
+            self.assertTrue(notify_dispatcher.flush(5))
             mock_run.assert_called_once()
 
+    def test_dispatcher_flush(self):
+        """django-q任务返回前flush等待通知发送完成"""
+        sent = []
+
+        class FakeWebhookNotifier(FeishuWebhookNotifier):
+            name = "fake_webhook_flush"
+
+            def send(self):
+                sent.append(self.messages)
+
+        n = FakeWebhookNotifier(
+            workflow=self.wf, audit=self.audit_wf, sys_config=self.sys_config
+        )
+        n.messages = [LegacyMessage("title", "content", [self.user])]
+        n.rendered = True
+        with self.settings(NOTIFY={"RETRIES": 0}):
+            notify_dispatcher.submit(n)
+            self.assertTrue(notify_dispatcher.flush(5))
+        self.assertEqual(len(sent), 1)
+        stats = notify_dispatcher.stats()["channels"]["fake_webhook_flush"]
+        self.assertEqual(stats["sent"], 1)
+
     @patch("sql.notify.auto_notify")
     def test_notify_for_execute(self, mock_auto_notify: Mock):
         """测试适配器"""
@@ -523,6 +558,7 @@ class TestNotifySend(TestCase):
         notifier.messages = [
             LegacyMessage(msg_to=[self.user], msg_title="test", msg_content="test")
         ]
+        notifier.render_target()
         notifier.send()
         mocker.assert_called_once()
 
@@ -543,6 +579,7 @@ class TestNotifySend(TestCase):
         notifier.messages = [
             LegacyMessage(msg_to=[self.user], msg_title="test", msg_content="test")
         ]
+        notifier.render_target()
         notifier.send()
         mocker.assert_called_once()
 
@@ -563,6 +600,7 @@ class TestNotifySend(TestCase):
         notifier.messages = [
             LegacyMessage(msg_to=[self.user], msg_title="test", msg_content="test")
         ]
+        notifier.render_target()
         notifier.send()
         mocker.assert_called_once()
 
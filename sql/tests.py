@@ -2,10 +2,11 @@ import json
 from datetime import timedelta, datetime, date
 from unittest.mock import MagicMock, patch, ANY, Mock
 from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import Permission
-from django.test import Client, TestCase, TransactionTestCase
+from django.test import Client, TestCase, TransactionTestCase, override_settings
 
 import sql.query_privileges
 from common.config import SysConfig
@@ -13,6 +14,7 @@ from common.utils.const import WorkflowStatus, WorkflowType
 from sql.archiver import add_archive_task, archive
 from sql.binlog import my2sql_file
 from sql.engines.models import ResultSet
+from sql.utils.async_query import AsyncQueryStore
 from sql.utils.execute_sql import execute_callback
 from sql.query import kill_query_conn
 from sql.models import (
@@ -30,8 +32,15 @@ from sql.models import (
     WorkflowAuditSetting,
     ArchiveConfig,
     WorkflowAuditDetail,
+    SlowQuery,
+    SlowQueryHistory,
+    SlowQueryRollupDaily,
+    SlowQueryRollupHourly,
 )
+from sql.utils.query_log import ARCHIVE_TABLE, archive_query_log, use_fulltext
+from sql.utils.slow_query_rollup import rebuild_slow_query_rollup, rollup_slow_query
 from sql.utils.workflow_audit import AuditException
+from sql.sql_tuning import SqlTuning, _instance_info_cache
 
 User = Users
 
@@ -194,6 +203,67 @@ class TestView(TransactionTestCase):
         r = self.client.get(f"/slowquery/", data=data)
         self.assertEqual(r.status_code, 200)
 
+    def test_slowquery_review(self):
+        """测试慢日志统计，从汇总数据中查询"""
+        SlowQuery.objects.create(
+            checksum="some_checksum",
+            fingerprint="select * from some_tb where id = ?",
+            sample="select * from some_tb where id = 1",
+        )
+
+        def add_history(ts_min, ts_cnt, query_time_sum):
+            SlowQueryHistory.objects.create(
+                hostname_max=f"{self.ins.host}:{self.ins.port}",
+                user_max="some_user",
+                db_max="some_db",
+                checksum_id="some_checksum",
+                sample="select * from some_tb where id = 1",
+                ts_min=ts_min,
+                ts_max=ts_min + timedelta(minutes=5),
+                ts_cnt=ts_cnt,
+                query_time_sum=query_time_sum,
+                rows_examined_sum=ts_cnt * 10,
+                rows_sent_sum=ts_cnt,
+            )
+
+        add_history(datetime(2023, 1, 1, 1), 2, 1.0)
+        add_history(datetime(2023, 1, 1, 2), 3, 2.0)
+        rollup_slow_query()
+        add_history(datetime(2023, 1, 2, 1), 5, 2.0)
+        # 安全延迟内观察到的明细留到下次汇总
+        rollup_slow_query()
+        self.assertEqual(SlowQueryRollupHourly.objects.count(), 2)
+        rollup_slow_query(safety_lag=0)
+        # 没有新增明细时不会重复汇总
+        rollup_slow_query(safety_lag=0)
+        self.assertEqual(SlowQueryRollupHourly.objects.count(), 3)
+        self.assertEqual(
+            SlowQueryRollupDaily.objects.get(bucket=datetime(2023, 1, 1)).ts_cnt, 5
+        )
+        rebuild_slow_query_rollup(batch_size=1)
+        self.assertEqual(SlowQueryRollupDaily.objects.count(), 2)
+        self.assertEqual(
+            SlowQueryRollupDaily.objects.get(bucket=datetime(2023, 1, 1)).ts_cnt, 5
+        )
+        data = {
+            "instance_name": self.ins.instance_name,
+            "StartTime": "2023-01-01",
+            "EndTime": "2023-01-02",
+            "db_name": "some_db",
+            "limit": 14,
+            "offset": 0,
+            "search": "some_tb",
+            "sortName": "MySQLTotalExecutionCounts",
+            "sortOrder": "desc",
+        }
+        r = self.client.post("/slowquery/review/", data=data)
+        result = json.loads(r.content)
+        self.assertEqual(result["total"], 1)
+        self.assertEqual(result["rows"][0]["SQLId"], "some_checksum")
+        self.assertEqual(result["rows"][0]["MySQLTotalExecutionCounts"], 10)
+        self.assertEqual(result["rows"][0]["QueryTimeAvg"], 0.5)
+        self.assertEqual(result["rows"][0]["ParseRowAvg"], 10)
+
     def test_instance(self):
         """测试instance页面"""
         data = {}
@@ -587,6 +657,51 @@ class TestQueryPrivilegesCheck(TestCase):
         )
         self.assertTrue(r)
 
+    def test_query_priv_resolver(self):
+        """
+        测试一次加载用户的全部查询权限，权限变更后缓存失效
+        :return:
+        """
+        db_priv = QueryPrivileges.objects.create(
+            user_name=self.user.username,
+            instance=self.slave,
+            db_name=self.db_name,
+            valid_date=date.today() + timedelta(days=1),
+            limit_num=10,
+            priv_type=1,
+        )
+        QueryPrivileges.objects.create(
+            user_name=self.user.username,
+            instance=self.slave,
+            db_name=self.db_name,
+            table_name="table_name",
+            valid_date=date.today() + timedelta(days=1),
+            limit_num=5,
+            priv_type=2,
+        )
+        resolver = sql.query_privileges.QueryPrivResolver(self.user, self.slave)
+        with self.assertNumQueries(1):
+            self.assertEqual(resolver.db_limit(self.db_name), 10)
+            self.assertEqual(resolver.tb_limit(self.db_name, "table_name"), 5)
+            self.assertFalse(resolver.tb_limit(self.db_name, "other_table"))
+            # 与库中不区分大小写的匹配一致
+            self.assertEqual(resolver.db_limit(self.db_name.upper()), 10)
+            self.assertEqual(resolver.tb_limit(self.db_name, "TABLE_NAME"), 5)
+        with self.assertNumQueries(0):
+            r = sql.query_privileges._priv_limit(
+                user=self.user,
+                instance=self.slave,
+                db_name=self.db_name,
+                tb_name="table_name",
+            )
+        self.assertEqual(r, 5)
+        db_priv.is_deleted = 1
+        db_priv.save(update_fields=["is_deleted"])
+        r = sql.query_privileges._db_priv(
+            user=self.user, instance=self.slave, db_name=self.db_name
+        )
+        self.assertFalse(r)
+
     @patch("sql.query_privileges._db_priv")
     def test_priv_limit_from_db(self, __db_priv):
         """
@@ -1202,7 +1317,7 @@ class TestQuery(TransactionTestCase):
         }
         _get_engine.return_value.filter_sql.return_value = some_sql
         _get_engine.return_value.query.return_value = q_result
-        _get_engine.return_value.seconds_behind_master = 100
+        _get_engine.return_value.prepare_query_session.return_value = 100
         _priv_check.return_value = {
             "status": 0,
             "data": {"limit_num": 100, "priv_check": True},
@@ -1221,10 +1336,12 @@ class TestQuery(TransactionTestCase):
             some_db,
             some_sql,
             some_limit,
+            close_conn=False,
             schema_name=None,
             tb_name=None,
             max_execution_time=60000,
         )
+        _get_engine.return_value.close.assert_called()
         r_json = r.json()
         self.assertEqual(r_json["data"]["rows"], ["value"])
         self.assertEqual(r_json["data"]["column_list"], ["some"])
@@ -1268,6 +1385,7 @@ class TestQuery(TransactionTestCase):
             some_db,
             sql_with_limit,
             some_limit,
+            close_conn=False,
             schema_name=None,
             tb_name=None,
             max_execution_time=60000,
@@ -1276,6 +1394,178 @@ class TestQuery(TransactionTestCase):
         self.assertEqual(r_json["data"]["rows"], ["value"])
         self.assertEqual(r_json["data"]["column_list"], ["some"])
 
+    @patch("sql.query.user_instances")
+    @patch("sql.query.get_engine")
+    @patch("sql.query.query_priv_check")
+    def testStreamQuery(self, _priv_check, _get_engine, _user_instances):
+        c = Client()
+        some_sql = "select some from some_table limit 100;"
+        some_db = "some_db"
+        c.force_login(self.u2)
+        q_result = ResultSet(full_sql=some_sql)
+        q_result.column_list = ["some"]
+        q_result.rows = (chunk for chunk in [[("value1",)], [("value2",)]])
+        _get_engine.return_value.query_check.return_value = {
+            "msg": "",
+            "bad_query": False,
+            "filtered_sql": some_sql,
+            "has_star": False,
+        }
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.return_value = q_result
+        _get_engine.return_value.prepare_query_session.return_value = 100
+        _priv_check.return_value = {
+            "status": 0,
+            "data": {"limit_num": 100, "priv_check": True},
+        }
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post(
+            "/query/",
+            data={
+                "instance_name": self.slave1.instance_name,
+                "sql_content": some_sql,
+                "db_name": some_db,
+                "limit_num": 100,
+                "stream": "true",
+            },
+        )
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+        lines = [
+            json.loads(line)
+            for line in b"".join(r.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(lines[0]["type"], "meta")
+        self.assertEqual(lines[0]["data"]["column_list"], ["some"])
+        self.assertEqual(lines[0]["data"]["seconds_behind_master"], 100)
+        self.assertEqual(lines[1], {"type": "rows", "data": [["value1"]]})
+        self.assertEqual(lines[2], {"type": "rows", "data": [["value2"]]})
+        self.assertEqual(lines[3]["type"], "end")
+        self.assertEqual(lines[3]["status"], 0)
+        self.assertEqual(lines[3]["data"]["affected_rows"], 2)
+        self.assertEqual(
+            QueryLog.objects.filter(sqllog=some_sql).values_list(
+                "effect_row", flat=True
+            )[0],
+            2,
+        )
+
+    @patch("sql.query.submit_async_query")
+    @patch("sql.query.user_instances")
+    @patch("sql.query.get_engine")
+    @patch("sql.query.query_priv_check")
+    def testAsyncQuery(self, _priv_check, _get_engine, _user_instances, _submit):
+        c = Client()
+        some_sql = "select some from some_table limit 100;"
+        c.force_login(self.u2)
+        q_result = ResultSet(full_sql=some_sql)
+        q_result.column_list = ["some"]
+        q_result.rows = (chunk for chunk in [[("value1",)], [("value2",)]])
+        _get_engine.return_value.query_check.return_value = {
+            "msg": "",
+            "bad_query": False,
+            "filtered_sql": some_sql,
+            "has_star": False,
+        }
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.return_value = q_result
+        _get_engine.return_value.thread_id = None
+        _priv_check.return_value = {
+            "status": 0,
+            "data": {"limit_num": 100, "priv_check": True},
+        }
+        _user_instances.return_value.get.return_value = self.slave1
+        # 同步执行异步查询任务
+        _submit.side_effect = lambda func, *args: func(*args) or True
+        r = c.post(
+            "/query/",
+            data={
+                "instance_name": self.slave1.instance_name,
+                "sql_content": some_sql,
+                "db_name": "some_db",
+                "limit_num": 100,
+                "async": "true",
+            },
+        )
+        query_id = r.json()["data"]["query_id"]
+        r = c.get("/query/async/result/", {"query_id": query_id, "page": 2})
+        data = r.json()["data"]
+        self.assertEqual(data["status"], "finished")
+        self.assertEqual(data["pages"], 2)
+        self.assertEqual(data["affected_rows"], 2)
+        self.assertEqual(data["column_list"], ["some"])
+        self.assertEqual(data["rows"], [["value2"]])
+        r = c.get("/query/async/stream/", {"query_id": query_id})
+        lines = [
+            json.loads(line)
+            for line in b"".join(r.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(
+            [line["type"] for line in lines], ["meta", "rows", "rows", "end"]
+        )
+        # 其他用户不能获取查询结果
+        c.force_login(self.superuser1)
+        r = c.get("/query/async/result/", {"query_id": query_id})
+        self.assertEqual(r.json()["status"], 1)
+
+    def testAsyncQueryStreamPending(self):
+        """查询仍在执行时输出已写入的分页后返回pending，由客户端从下一页继续轮询"""
+        c = Client()
+        c.force_login(self.u2)
+        store = AsyncQueryStore.create(self.u2.username, sql="select 1")
+        store.update_meta(status="running", column_list=["some"])
+        store.put_page(1, [["value1"]])
+        store.update_meta(pages=1, affected_rows=1)
+        r = c.get("/query/async/stream/", {"query_id": store.query_id})
+        lines = [
+            json.loads(line)
+            for line in b"".join(r.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([line["type"] for line in lines], ["meta", "rows", "pending"])
+        self.assertEqual(lines[-1]["data"]["page"], 2)
+
+    @patch("sql.query.submit_async_query")
+    @patch("sql.query.user_instances")
+    @patch("sql.query.get_engine")
+    @patch("sql.query.query_priv_check")
+    def testAsyncQueryExecuteRaise(
+        self, _priv_check, _get_engine, _user_instances, _submit
+    ):
+        """异步查询执行阶段抛出异常时丢弃连接并记录查询日志"""
+        c = Client()
+        some_sql = "select some from some_table limit 100;"
+        c.force_login(self.u2)
+        _get_engine.return_value.query_check.return_value = {
+            "msg": "",
+            "bad_query": False,
+            "filtered_sql": some_sql,
+            "has_star": False,
+        }
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.side_effect = RuntimeError("boom")
+        _get_engine.return_value.thread_id = None
+        _priv_check.return_value = {
+            "status": 0,
+            "data": {"limit_num": 100, "priv_check": True},
+        }
+        _user_instances.return_value.get.return_value = self.slave1
+        _submit.side_effect = lambda func, *args: func(*args) or True
+        r = c.post(
+            "/query/",
+            data={
+                "instance_name": self.slave1.instance_name,
+                "sql_content": some_sql,
+                "db_name": "some_db",
+                "limit_num": 100,
+                "async": "true",
+            },
+        )
+        query_id = r.json()["data"]["query_id"]
+        r = c.get("/query/async/result/", {"query_id": query_id})
+        self.assertEqual(r.json()["data"]["status"], "failed")
+        self.assertIn("boom", r.json()["data"]["msg"])
+        _get_engine.return_value.discard_connection.assert_called_once()
+        self.assertTrue(QueryLog.objects.filter(sqllog=some_sql).exists())
+
     @patch("sql.query.query_priv_check")
     def testStarOptionOn(self, _priv_check):
         c = Client()
@@ -1323,6 +1613,67 @@ class TestQuery(TransactionTestCase):
         r = c.get("/query/querylog/", data=data)
         self.assertEqual(r.json()["total"], 1)
 
+    @override_settings(QUERY_LOG_COUNT_LIMIT=3)
+    def test_query_log_page(self):
+        """测试查询历史按ID游标分页和总数上限"""
+        c = Client()
+        c.force_login(self.superuser1)
+        for i in range(4):
+            QueryLog.objects.create(
+                instance_name=self.slave1.instance_name,
+                db_name="some_db",
+                sqllog=f"select {i};",
+                effect_row=10,
+                cost_time=1,
+                username=self.superuser1.username,
+            )
+        ids = list(QueryLog.objects.order_by("-id").values_list("id", flat=True))
+        r = c.get("/query/querylog/", data={"limit": 2, "offset": 0})
+        self.assertEqual(r.json()["total"], 3)
+        self.assertEqual([row["id"] for row in r.json()["rows"]], ids[:2])
+        r = c.get(
+            "/query/querylog/",
+            data={"limit": 2, "offset": 2, "before_id": ids[1], "count": "exact"},
+        )
+        self.assertEqual(r.json()["total"], 5)
+        self.assertEqual([row["id"] for row in r.json()["rows"]], ids[2:4])
+        r = c.get("/query/querylog/", data={"limit": 14, "search": "select 2"})
+        self.assertEqual(r.json()["total"], 1)
+
+    @patch("sql.utils.query_log.ngram_token_size", return_value=2)
+    @patch("sql.utils.query_log.fulltext_enabled", return_value=True)
+    def test_query_log_use_fulltext(self, _fulltext_enabled, _ngram_token_size):
+        """测试查询历史关键字中存在短于ngram_token_size的分词时不使用全文索引"""
+        self.assertTrue(use_fulltext("select id"))
+        self.assertFalse(use_fulltext("id = 1"))
+        self.assertFalse(use_fulltext('"id"'))
+        _ngram_token_size.return_value = 3
+        self.assertFalse(use_fulltext("select id"))
+        _fulltext_enabled.return_value = False
+        self.assertFalse(use_fulltext("select"))
+
+    def test_archive_query_log(self):
+        """测试查询历史归档，收藏的记录不归档"""
+        favorite_log = QueryLog.objects.create(
+            instance_name=self.slave1.instance_name,
+            db_name="some_db",
+            sqllog="select 2;",
+            effect_row=10,
+            cost_time=1,
+            username=self.superuser1.username,
+            favorite=True,
+        )
+        QueryLog.objects.update(create_time=datetime.now() - timedelta(days=60))
+        try:
+            self.assertEqual(archive_query_log(30), 1)
+            self.assertEqual(list(QueryLog.objects.all()), [favorite_log])
+            with connection.cursor() as cursor:
+                cursor.execute(f"select id from {ARCHIVE_TABLE}")
+                self.assertEqual(cursor.fetchall(), ((self.query_log.id,),))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {ARCHIVE_TABLE}")
+
     def test_star(self):
         """测试查询语句收藏"""
         c = Client()
@@ -1676,6 +2027,39 @@ class TestWorkflowView(TransactionTestCase):
         self.wf2.refresh_from_db()
         self.assertEqual("workflow_abort", self.wf2.status)
 
+    @override_settings(ROLLBACK_CACHE_TTL=60)
+    @patch("sql.utils.sql_review.get_engine")
+    def test_backup_sql(self, _get_engine):
+        """测试获取回滚语句，分页返回并缓存执行结束工单的回滚语句"""
+        c = Client()
+        c.force_login(self.superuser1)
+        _get_engine.return_value.get_rollback.return_value = [
+            [f"update t set c={i}", f"update t set c=0 where id={i}"] for i in range(5)
+        ]
+        r = c.get(
+            "/sqlworkflow/backup_sql/",
+            data={"workflow_id": self.wf1.id, "limit": 2, "offset": 2},
+        )
+        data = json.loads(r.content)
+        self.assertEqual(data["total"], 5)
+        self.assertEqual(data["rows"][0][0], "update t set c=2")
+        self.assertEqual(len(data["rows"]), 2)
+        r = c.get(
+            "/sqlworkflow/backup_sql/",
+            data={"workflow_id": self.wf1.id, "search": "c=3"},
+        )
+        data = json.loads(r.content)
+        self.assertEqual(data["total"], 1)
+        _get_engine.return_value.get_rollback.assert_called_once()
+        r = c.get(
+            "/sqlworkflow/backup_sql/",
+            data={"workflow_id": self.wf1.id, "limit": "abc", "offset": 0},
+        )
+        data = json.loads(r.content)
+        self.assertEqual(data["status"], 1)
+        self.assertEqual(data["rows"], [])
+        cache.delete(f"rollback_sql:{self.wf1.id}")
+
     @patch("sql.sql_workflow.get_engine")
     def test_osc_control(self, _get_engine):
         """测试MySQL工单osc控制"""
@@ -1847,7 +2231,13 @@ class TestOptimize(TestCase):
         r = self.client.post(path="/slowquery/optimize_sqltuning/", data=data)
         self.assertListEqual(
             list(json.loads(r.content)["data"].keys()),
-            ["basic_information", "sys_parameter", "optimizer_switch", "sqltext"],
+            [
+                "basic_information",
+                "sys_parameter",
+                "optimizer_switch",
+                "sqltext",
+                "timings",
+            ],
         )
 
         # 获取sql_plan
@@ -1855,22 +2245,45 @@ class TestOptimize(TestCase):
         r = self.client.post(path="/slowquery/optimize_sqltuning/", data=data)
         self.assertListEqual(
             list(json.loads(r.content)["data"].keys()),
-            ["optimizer_rewrite_sql", "plan", "sqltext"],
+            ["optimizer_rewrite_sql", "plan", "sqltext", "timings"],
         )
 
         # 获取obj_stat
         data["option[]"] = "obj_stat"
         r = self.client.post(path="/slowquery/optimize_sqltuning/", data=data)
         self.assertListEqual(
-            list(json.loads(r.content)["data"].keys()), ["object_statistics", "sqltext"]
+            list(json.loads(r.content)["data"].keys()),
+            ["object_statistics", "sqltext", "timings"],
         )
 
         # 获取sql_profile
         data["option[]"] = "sql_profile"
         r = self.client.post(path="/slowquery/optimize_sqltuning/", data=data)
         self.assertListEqual(
-            list(json.loads(r.content)["data"].keys()), ["session_status", "sqltext"]
-        )
+            list(json.loads(r.content)["data"].keys()),
+            ["session_status", "sqltext", "timings"],
+        )
+
+    @patch("sql.sql_tuning.get_engine")
+    def test_tuning_diagnose(self, _get_engine):
+        """系统参数按实例缓存，关联表的查询合并为一次请求"""
+        _instance_info_cache.clear()
+        engine = _get_engine.return_value
+        engine.escape_string.side_effect = lambda s: s
+        engine.server_version = (8, 0, 30)
+        engine.query_batch.side_effect = lambda db_name=None, sqls=(): [
+            ResultSet(rows=[]) for _ in sqls
+        ]
+        sqltext = "select * from t1 join t2 on t1.id=t2.id"
+        SqlTuning("test_instance", "some_db", sqltext).diagnose(["sys_parm"])
+        data, timings = SqlTuning("test_instance", "some_db", sqltext).diagnose(
+            ["sys_parm", "obj_stat"]
+        )
+        self.assertEqual(engine.query_batch.call_count, 2)
+        self.assertEqual(len(engine.query_batch.call_args.kwargs["sqls"]), 6)
+        self.assertEqual(len(data["object_statistics"]), 2)
+        self.assertListEqual(list(timings.keys()), ["sys_parm", "obj_stat"])
+        _instance_info_cache.clear()
 
 
 class TestSchemaSync(TestCase):
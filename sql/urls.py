@@ -6,7 +6,7 @@ from django.views.i18n import JavaScriptCatalog
 import sql.instance_database
 import sql.query_privileges
 import sql.sql_optimize
-from common import auth, config, workflow, dashboard, check
+from common import auth, config, workflow, dashboard, check, stats
 from common.twofa import totp
 from sql import (
     views,
@@ -123,6 +123,8 @@ urlpatterns = [
     path("param/history/", instance.param_history),
     path("param/edit/", instance.param_edit),
     path("query/", query.query),
+    path("query/async/result/", query.query_async_result),
+    path("query/async/stream/", query.query_async_stream),
     path("query/querylog/", query.querylog),
     path("query/querylog_audit/", query.querylog_audit),
     path("query/favorite/", query.favorite),
@@ -158,6 +160,7 @@ urlpatterns = [
     path("archive/once/", archiver.archive_once),
     path("archive/log/", archiver.archive_log),
     path("4admin/sync_ding_user/", ding_api.sync_ding_user),
+    path("4admin/stats/", stats.runtime_stats),
     path("audit/log/", audit_log.audit_log),
     path("audit/input/", audit_log.audit_input),
     path("user/list/", user.lists),
@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+"""
+异步查询，查询提交后在进程内的有界线程池中执行，web worker立即返回查询ID
+执行过程中按批次把结果写入共享缓存，worker内存只保留一批数据，结果按ASYNC_QUERY["RESULT_TTL"]过期，
+客户端通过查询ID轮询分页获取或者流式获取
+"""
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger("default")
+
+_executor = None
+_slots = None
+_executor_lock = threading.Lock()
+
+
+class AsyncQueryStore:
+    """异步查询的状态和分页结果，保存在共享缓存中，多个web进程都可以读取"""
+
+    def __init__(self, query_id):
+        self.query_id = query_id
+        self.timeout = settings.ASYNC_QUERY["RESULT_TTL"]
+
+    @classmethod
+    def create(cls, username, **meta):
+        store = cls(uuid.uuid4().hex)
+        store.set_meta(
+            {
+                "query_id": store.query_id,
+                "username": username,
+                "status": "queued",
+                "msg": "",
+                "pages": 0,
+                "affected_rows": 0,
+                **meta,
+            }
+        )
+        return store
+
+    def _key(self, suffix=""):
+        return f"async_query:{self.query_id}{suffix}"
+
+    def get_meta(self):
+        return cache.get(self._key())
+
+    def set_meta(self, meta):
+        cache.set(self._key(), meta, timeout=self.timeout)
+
+    def update_meta(self, **kwargs):
+        meta = self.get_meta() or {}
+        meta.update(kwargs)
+        self.set_meta(meta)
+        return meta
+
+    def put_page(self, page, rows):
+        cache.set(self._key(f":page:{page}"), rows, timeout=self.timeout)
+
+    def get_page(self, page):
+        return cache.get(self._key(f":page:{page}"))
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error(f"异步查询执行异常，错误信息：{e}")
+    finally:
+        # 线程池中的数据库连接不会随请求结束关闭，需要主动关闭
+        connections.close_all()
+        _slots.release()
+
+
+def submit_async_query(func, *args):
+    """
+    提交到异步查询线程池，排队中的查询数量有上限，超出时返回False
+    """
+    global _executor, _slots
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = settings.ASYNC_QUERY["WORKERS"]
+                _slots = threading.BoundedSemaphore(
+                    workers + settings.ASYNC_QUERY["MAX_PENDING"]
+                )
+                _executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="async_query"
+                )
+    if not _slots.acquire(blocking=False):
+        return False
+    _executor.submit(_run, func, args)
+    return True
@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+"""
+目标库连接池，按进程维护，按照 实例/库 维度区分连接池
+连接归还时放回空闲队列，再次获取时优先复用，避免每次查询都重新建立TCP连接和认证
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger("default")
+
+# 执行后在会话中留下状态的语句：切换库、会话变量、显式事务、临时表、表锁、预处理语句、用户变量
+SESSION_STATE_RE = re.compile(
+    r"(^|;)\s*(/\*.*?\*/\s*)*"
+    r"(use|set|begin|start\s+transaction|xa|create\s+temporary|lock\s+tables?|prepare|handler)\b"
+    r"|@\w+\s*:=|\binto\s+@",
+    re.I | re.S,
+)
+
+
+def changes_session_state(sql):
+    """语句是否会修改会话状态，执行过这类语句的连接不能再放回连接池"""
+    return bool(sql) and SESSION_STATE_RE.search(sql) is not None
+
+
+class ConnectionPool:
+    """单个连接池，仅负责连接的复用、健康检查、空闲淘汰和容量限制"""
+
+    def __init__(
+        self,
+        creator,
+        label="",
+        max_size=10,
+        max_idle_time=300,
+        check_interval=30,
+        rollback_on_release=True,
+    ):
+        """
+        :param creator: 创建新连接的函数
+        :param label: 连接池描述，用于展示统计信息
+        :param max_size: 连接池最多保留的空闲连接数，超出后归还的连接直接关闭
+        :param max_idle_time: 空闲超过该时间(秒)的连接直接关闭
+        :param check_interval: 空闲超过该时间(秒)的连接在复用前先ping检查
+        :param rollback_on_release: 归还时是否回滚未提交的事务，goInception等不支持事务的服务设置为False
+        """
+        self.creator = creator
+        self.rollback_on_release = rollback_on_release
+        self.label = label
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.check_interval = check_interval
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.discards = 0
+
+    def acquire(self):
+        """获取一个可用连接，优先复用空闲连接"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    break
+                conn, released_at = self._idle.pop()
+            idle_time = time.monotonic() - released_at
+            if idle_time > self.max_idle_time:
+                self._close(conn)
+                with self._lock:
+                    self.evictions += 1
+                continue
+            if idle_time > self.check_interval and not self._is_alive(conn):
+                self._close(conn)
+                with self._lock:
+                    self.discards += 1
+                continue
+            with self._lock:
+                self.hits += 1
+            return conn
+        return self.creator()
+
+    def release(self, conn, broken=False):
+        """
+        归还连接，异常连接或者超出容量的连接直接关闭
+        连接池只回滚未提交的事务，不重置会话，会话状态已修改的连接需由调用方按broken归还
+        """
+        if conn is None:
+            return
+        if broken:
+            self._close(conn)
+            with self._lock:
+                self.discards += 1
+            return
+        # 未提交的事务不能带入下一次使用
+        try:
+            if self.rollback_on_release and not conn.get_autocommit():
+                conn.rollback()
+        except Exception:
+            self._close(conn)
+            with self._lock:
+                self.discards += 1
+            return
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+            self.evictions += 1
+        self._close(conn)
+
+    def clear(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def reap(self):
+        """淘汰空闲超时的连接"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [c for c, t in self._idle if now - t > self.max_idle_time]
+            self._idle = deque(
+                (c, t) for c, t in self._idle if now - t <= self.max_idle_time
+            )
+            self.evictions += len(expired)
+        for conn in expired:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "label": self.label,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "discards": self.discards,
+            }
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool_enabled():
+    return settings.CONN_POOL.get("ENABLED", False)
+
+
+def get_pool(key, creator, label="", **kwargs):
+    """按照key获取连接池，不存在则创建"""
+    pool = _pools.get(key)
+    if pool:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(key)
+        if not pool:
+            pool = ConnectionPool(
+                creator,
+                label=label,
+                max_size=settings.CONN_POOL.get("MAX_SIZE", 10),
+                max_idle_time=settings.CONN_POOL.get("MAX_IDLE_TIME", 300),
+                check_interval=settings.CONN_POOL.get("CHECK_INTERVAL", 30),
+                **kwargs,
+            )
+            _pools[key] = pool
+    return pool
+
+
+@contextmanager
+def pooled_connection(key, creator, label="", errors=Exception):
+    """
+    开启连接池时从连接池获取连接，使用完成后归还，否则新建连接，使用完成后关闭
+    :param errors: 视为连接异常的异常类型，发生时连接不再放回连接池
+    """
+    pool = get_pool(key, creator, label=label) if pool_enabled() else None
+    conn = pool.acquire() if pool else creator()
+    broken = False
+    try:
+        yield conn
+    except errors:
+        broken = True
+        raise
+    finally:
+        if pool:
+            pool.release(conn, broken=broken)
+        else:
+            ConnectionPool._close(conn)
+
+
+def clear_pools():
+    """关闭并清空所有连接池"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
+
+
+def pool_stats():
+    """所有连接池的命中统计"""
+    for pool in list(_pools.values()):
+        pool.reap()
+    return [pool.stats() for pool in list(_pools.values())]
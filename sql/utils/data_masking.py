@@ -1,55 +1,36 @@
 # -*- coding:utf-8 -*-
 import logging
+from functools import lru_cache
 
 import sqlparse
 from django.forms import model_to_dict
-from sqlparse.tokens import Keyword
+from sqlparse.tokens import Keyword, Wildcard
 import pandas as pd
 
 from sql.engines.goinception import GoInceptionEngine
 from sql.models import DataMaskingRules, DataMaskingColumns
+from sql.utils.query_tree_cache import query_tree_cache
 import re
 import traceback
 
 logger = logging.getLogger("default")
 
+# 按列脱敏时标记未匹配规则的值
+_NOT_MATCHED = object()
+# 脱敏select list的缓存时间(秒)，在实例外执行的DDL、从库上的表结构变更不会使缓存失效
+MASKING_CACHE_TIMEOUT = 300
+
 
 def data_masking(instance, db_name, sql, sql_result):
     """脱敏数据"""
     try:
-        keywords_count = {}
-        # 解析查询语句，判断UNION需要单独处理
-        p = sqlparse.parse(sql)[0]
-        for token in p.tokens:
-            if token.ttype is Keyword and token.value.upper() in ["UNION", "UNION ALL"]:
-                keywords_count["UNION"] = keywords_count.get("UNION", 0) + 1
-        # 通过goInception获取select list
-        inception_engine = GoInceptionEngine()
-        select_list = inception_engine.query_data_masking(
-            instance=instance, db_name=db_name, sql=sql
+        hit_columns, masking_rules = masking_plan(
+            instance, db_name, sql, sql_result.column_list
         )
-        # 如果UNION存在，那么调用去重函数
-        select_list = (
-            del_repeat(select_list, keywords_count) if keywords_count else select_list
-        )
-        # 分析语法树获取命中脱敏规则的列数据
-        hit_columns = analyze_query_tree(select_list, instance)
         sql_result.mask_rule_hit = True if hit_columns else False
         # 对命中规则列hit_columns的数据进行脱敏
-        masking_rules = {
-            i.rule_type: model_to_dict(i) for i in DataMaskingRules.objects.all()
-        }
         if hit_columns and sql_result.rows:
-            rows = list(sql_result.rows)
-            for column in hit_columns:
-                index, rule_type = column["index"], column["rule_type"]
-                masking_rule = masking_rules.get(rule_type)
-                if not masking_rule:
-                    continue
-                for idx, item in enumerate(rows):
-                    rows[idx] = list(item)
-                    rows[idx][index] = regex(masking_rule, rows[idx][index])
-                sql_result.rows = rows
+            sql_result.rows = mask_rows(sql_result.rows, hit_columns, masking_rules)
             # 脱敏结果
             sql_result.is_masked = True
     except Exception as msg:
@@ -59,6 +40,119 @@ def data_masking(instance, db_name, sql, sql_result):
     return sql_result
 
 
+def data_masking_stream(instance, db_name, sql, sql_result):
+    """流式结果集脱敏，命中列只分析一次，sql_result.rows为分批的行数据生成器，读取时按批次脱敏"""
+    try:
+        hit_columns, masking_rules = masking_plan(
+            instance, db_name, sql, sql_result.column_list
+        )
+        sql_result.mask_rule_hit = True if hit_columns else False
+        if hit_columns:
+            sql_result.rows = _mask_chunks(sql_result.rows, hit_columns, masking_rules)
+            sql_result.is_masked = True
+    except Exception as msg:
+        logger.warning(f"数据脱敏异常，错误信息：{traceback.format_exc()}")
+        sql_result.error = str(msg)
+        sql_result.status = 1
+    return sql_result
+
+
+def _mask_chunks(chunks, hit_columns, masking_rules):
+    """逐批脱敏，关闭时同时关闭原始的批次生成器，释放游标和连接"""
+    try:
+        for rows in chunks:
+            yield mask_rows(rows, hit_columns, masking_rules)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def masking_plan(instance, db_name, sql, column_list=None):
+    """
+    分析查询语句命中的脱敏列
+    :param column_list: 结果集的列名，缓存的select list与其不一致时重新解析
+    :return: (hit_columns, masking_rules)，无命中列时masking_rules为空
+    """
+    keywords_count = {}
+    # 解析查询语句，判断UNION需要单独处理
+    p = sqlparse.parse(sql)[0]
+    for token in p.tokens:
+        if token.ttype is Keyword and token.value.upper() in ["UNION", "UNION ALL"]:
+            keywords_count["UNION"] = keywords_count.get("UNION", 0) + 1
+    # 通过goInception获取select list，相同结构的语句复用缓存的解析结果
+    inception_engine = GoInceptionEngine()
+
+    def parse():
+        return inception_engine.query_data_masking(
+            instance=instance, db_name=db_name, sql=sql
+        )
+
+    # 使用*的语句展开后的列随表结构变化，不使用缓存
+    if _uses_star(p):
+        select_list = parse()
+    else:
+        select_list = query_tree_cache.get_or_set(
+            instance, db_name, "masking", sql, parse, timeout=MASKING_CACHE_TIMEOUT
+        )
+        if column_list is not None and not _match_columns(select_list, column_list):
+            query_tree_cache.discard(instance, db_name, "masking", sql)
+            select_list = query_tree_cache.get_or_set(
+                instance, db_name, "masking", sql, parse, timeout=MASKING_CACHE_TIMEOUT
+            )
+    # 如果UNION存在，那么调用去重函数
+    select_list = (
+        del_repeat(select_list, keywords_count) if keywords_count else select_list
+    )
+    # 分析语法树获取命中脱敏规则的列数据
+    hit_columns = analyze_query_tree(select_list, instance)
+    if not hit_columns:
+        return hit_columns, {}
+    masking_rules = {
+        i.rule_type: model_to_dict(i) for i in DataMaskingRules.objects.all()
+    }
+    return hit_columns, masking_rules
+
+
+def _uses_star(statement):
+    """语句中是否存在*或者t.*"""
+    return any(token.ttype is Wildcard for token in statement.flatten())
+
+
+def _match_columns(select_list, column_list):
+    """
+    select list与结果集的列是否一致，UNION语句的select list按分支重复，只比较第一个分支
+    goInception返回的alias为空时使用field比较
+    """
+    if not column_list:
+        return not select_list
+    if len(select_list) % len(column_list):
+        return False
+    names = [
+        str(column.get("alias") or column.get("field") or "").lower()
+        for column in select_list[: len(column_list)]
+    ]
+    return names == [str(name).lower() for name in column_list]
+
+
+def prefetch_masking(instance, db_name, sql):
+    """
+    后台提前通过goInception获取select list，与查询并行执行，data_masking直接复用解析结果
+    使用*的语句不缓存解析结果，不预取
+    """
+    if _uses_star(sqlparse.parse(sql)[0]):
+        return False
+    inception_engine = GoInceptionEngine()
+    return query_tree_cache.prefetch(
+        instance,
+        db_name,
+        "masking",
+        sql,
+        lambda: inception_engine.query_data_masking(
+            instance=instance, db_name=db_name, sql=sql
+        ),
+    )
+
+
 def del_repeat(select_list, keywords_count):
     """输入的 data 是inception_engine.query_data_masking的list结果
     去重前
@@ -121,13 +215,79 @@ def analyze_query_tree(select_list, instance):
     return hit_columns
 
 
+def mask_rows(rows, hit_columns, masking_rules):
+    """
+    按列脱敏结果集，只取出命中列按列一次遍历完成脱敏，未命中的列不做处理，最后一次性回填到行
+    :param rows: 结果集行数据
+    :param hit_columns: analyze_query_tree返回的命中列信息
+    :param masking_rules: {rule_type: 脱敏规则dict}
+    :return: 脱敏后的行数据，list(list)，无可用脱敏规则时原样返回
+    """
+    masking_columns = [
+        (column["index"], masking_rules[column["rule_type"]])
+        for column in hit_columns
+        if masking_rules.get(column["rule_type"])
+    ]
+    if not masking_columns:
+        return rows
+    columns = {}
+    for index, masking_rule in masking_columns:
+        values = columns.get(index) or [row[index] for row in rows]
+        columns[index] = mask_column(values, masking_rule)
+    new_rows = [list(row) for row in rows]
+    for index, values in columns.items():
+        for row, value in zip(new_rows, values):
+            row[index] = value
+    return new_rows
+
+
+def mask_column(values, masking_rule):
+    """对单列数据脱敏，规则只编译一次，未匹配的值原样返回"""
+    pattern = _compile_rule(masking_rule["rule_regex"])
+    search, group_count = pattern.search, pattern.groups
+    hide_index = masking_rule["hide_group"] - 1
+    # 同一列中重复出现的值只脱敏一次
+    memo = {}
+    masked = []
+    append = masked.append
+    for value in values:
+        text = value if type(value) is str else str(value)
+        result = memo.get(text)
+        if result is not None:
+            append(value if result is _NOT_MATCHED else result)
+            continue
+        m = search(text)
+        if m is None:
+            result = _NOT_MATCHED
+        else:
+            lastindex = m.lastindex
+            if lastindex is None:
+                raise TypeError(f"脱敏规则未匹配到分组：{masking_rule['rule_regex']}")
+            groups = list(m.groups())
+            # 只拼接到最后一个匹配的分组，与regex保持一致
+            if lastindex != group_count:
+                groups = groups[:lastindex]
+            if 0 <= hide_index < lastindex:
+                groups[hide_index] = "****"
+            result = "".join(groups)
+        memo[text] = result
+        append(value if result is _NOT_MATCHED else result)
+    return masked
+
+
+@lru_cache(maxsize=256)
+def _compile_rule(rule_regex):
+    """缓存编译后的脱敏规则"""
+    return re.compile(rule_regex, re.I)
+
+
 def regex(masking_rule, value):
     """利用正则表达式脱敏数据"""
     rule_regex = masking_rule["rule_regex"]
     hide_group = masking_rule["hide_group"]
     # 正则匹配必须分组，隐藏的组会使用****代替
     try:
-        p = re.compile(rule_regex, re.I)
+        p = _compile_rule(rule_regex)
         m = p.search(str(value))
         masking_str = ""
         for i in range(m.lastindex):
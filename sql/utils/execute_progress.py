@@ -0,0 +1,233 @@
+# -*- coding: UTF-8 -*-
+"""
+SQL工单分批执行，每EXECUTE_CHUNK_SIZE条语句在一个事务中执行，提交后把本批执行结果和进度写入Archery库
+worker异常退出后重新执行工单，从最后一个已提交批次之后继续执行，已提交批次的执行结果直接复用
+目标库提交与记录进度不在同一个事务中，两者之间异常退出时最后一批语句会重复执行，
+记录进度失败时会重试，仍失败则停止执行并提示人工处理
+继续执行时是新的会话，已提交语句中修改会话状态的语句(如set search_path)会先重放
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from sql.engines.models import ReviewResult, ReviewSet
+from sql.models import SqlWorkflowExecuteChunk, SqlWorkflowExecuteProgress
+
+logger = logging.getLogger("default")
+
+# 目标库已提交后记录执行进度的重试次数和间隔(秒)
+SAVE_CHUNK_RETRIES = 3
+SAVE_CHUNK_RETRY_INTERVAL = 1
+
+
+def execute_chunk_size():
+    """每批执行的语句数，0表示不分批，逐条执行并提交"""
+    return settings.EXECUTE_CHUNK_SIZE
+
+
+def committed_rows(workflow_id):
+    """已提交批次的执行结果，按语句顺序返回字典列表"""
+    rows = []
+    for execute_result in (
+        SqlWorkflowExecuteChunk.objects.filter(workflow_id=workflow_id)
+        .order_by("start_line")
+        .values_list("execute_result", flat=True)
+    ):
+        rows += ReviewSet.load_rows(execute_result)
+    return rows
+
+
+def load_progress(workflow, total):
+    """
+    获取已提交的最后一条语句序号和已提交语句的执行结果，语句总数变化时重新开始执行
+    :return: (last_line, [ReviewResult])
+    """
+    progress, created = SqlWorkflowExecuteProgress.objects.get_or_create(
+        workflow_id=workflow.id, defaults={"total": total}
+    )
+    if created or progress.last_line == 0:
+        return 0, []
+    if progress.total != total:
+        logger.warning(f"工单{workflow.id}语句总数与执行进度不一致，重新开始执行")
+        clear_progress(workflow.id)
+        SqlWorkflowExecuteProgress.objects.create(workflow_id=workflow.id, total=total)
+        return 0, []
+    logger.info(f"工单{workflow.id}从第{progress.last_line + 1}条语句继续执行")
+    rows = [ReviewResult(**row) for row in committed_rows(workflow.id)]
+    return progress.last_line, rows
+
+
+def save_chunk(workflow, rows):
+    """记录一批已提交语句的执行结果和进度"""
+    with transaction.atomic():
+        SqlWorkflowExecuteChunk.objects.create(
+            workflow_id=workflow.id,
+            start_line=rows[0].id,
+            end_line=rows[-1].id,
+            execute_result=ReviewSet(rows=rows).json(),
+        )
+        SqlWorkflowExecuteProgress.objects.filter(workflow_id=workflow.id).update(
+            last_line=rows[-1].id
+        )
+
+
+def clear_progress(workflow_id):
+    """工单执行完成后删除执行进度和分批结果"""
+    with transaction.atomic():
+        SqlWorkflowExecuteChunk.objects.filter(workflow_id=workflow_id).delete()
+        SqlWorkflowExecuteProgress.objects.filter(workflow_id=workflow_id).delete()
+
+
+def execute_percentage(workflow_id):
+    """已提交语句的百分比，没有分批执行进度时返回None"""
+    progress = SqlWorkflowExecuteProgress.objects.filter(
+        workflow_id=workflow_id
+    ).first()
+    if not progress or not progress.total:
+        return None
+    return round(progress.last_line * 100 / progress.total, 2)
+
+
+def _save_committed_chunk(workflow, rows):
+    """
+    记录已提交批次，失败时关闭异常的Archery库连接后重试
+    :return: 重试后仍失败时返回最后一次的异常，成功返回None
+    """
+    error = None
+    for attempt in range(SAVE_CHUNK_RETRIES):
+        try:
+            save_chunk(workflow, rows)
+            return None
+        except Exception as e:
+            error = e
+            logger.warning(
+                f"工单{workflow.id}第{rows[0].id}-{rows[-1].id}条语句已提交，"
+                f"第{attempt + 1}次记录执行进度失败，错误信息：{e}"
+            )
+            close_old_connections()
+            if attempt + 1 < SAVE_CHUNK_RETRIES:
+                time.sleep(SAVE_CHUNK_RETRY_INTERVAL)
+    return error
+
+
+def _not_executed_rows(statements, start, statement_sql):
+    """从第start条开始的语句标记为审核通过、未执行"""
+    return [
+        ReviewResult(
+            id=line,
+            errlevel=0,
+            stagestatus="Audit completed",
+            errormessage="前序语句失败, 未执行",
+            sql=statement_sql(statements[line - 1]),
+            affected_rows=0,
+            execute_time=0,
+        )
+        for line in range(start, len(statements) + 1)
+    ]
+
+
+def execute_by_chunk(
+    workflow,
+    statements,
+    execute_statement,
+    commit,
+    rollback,
+    execute_result,
+    chunk_size,
+    statement_sql=lambda statement: statement,
+    session_statement=None,
+    replay_statement=None,
+    resume_blocked="",
+):
+    """
+    分批执行语句，执行结果追加到execute_result.rows
+    :param statements: 待执行的语句列表，与审核结果一一对应
+    :param execute_statement: 执行单条语句(不提交)，返回ReviewResult，序号由这里设置
+    :param commit: 提交当前批次
+    :param rollback: 回滚当前批次
+    :param chunk_size: 每批执行的语句数
+    :param statement_sql: 语句在执行结果中显示的SQL
+    :param session_statement: 判断语句是否修改会话状态，如set search_path、alter session
+    :param replay_statement: 继续执行时在新会话中重放已提交的会话状态语句
+    :param resume_blocked: 不允许继续执行的原因，存在已提交批次时不再执行并返回错误
+    """
+    total = len(statements)
+    last_line, rows = load_progress(workflow, total)
+    execute_result.rows += rows
+    if last_line and resume_blocked:
+        execute_result.error = f"第1-{last_line}条语句已在之前的执行中提交，{resume_blocked}"
+        logger.error(f"工单{workflow.id}{execute_result.error}")
+        execute_result.rows += _not_executed_rows(
+            statements, last_line + 1, statement_sql
+        )
+        return execute_result
+    # 继续执行时是新的会话，先重放已提交语句中修改会话状态的语句
+    if last_line and session_statement and replay_statement:
+        try:
+            for statement in statements[:last_line]:
+                if session_statement(statement):
+                    replay_statement(statement)
+        except Exception as e:
+            execute_result.error = f"重放会话设置语句失败，未继续执行，错误信息：{e}"
+            logger.error(f"工单{workflow.id}{execute_result.error}")
+            execute_result.rows += _not_executed_rows(
+                statements, last_line + 1, statement_sql
+            )
+            return execute_result
+    chunk = []
+    line = last_line
+    try:
+        for line in range(last_line + 1, total + 1):
+            result = execute_statement(statements[line - 1])
+            result.id = line
+            chunk.append(result)
+            if len(chunk) >= chunk_size or line == total:
+                commit()
+                committed, chunk = chunk, []
+                execute_result.rows += committed
+                # 目标库已提交，记录进度失败时不能按回滚处理，停止执行并提示人工确认
+                save_error = _save_committed_chunk(workflow, committed)
+                if save_error:
+                    execute_result.error = (
+                        f"第{committed[0].id}-{line}条语句已提交，但记录执行进度失败，"
+                        f"请勿直接重新执行，需确认后人工处理，错误信息：{save_error}"
+                    )
+                    logger.error(f"工单{workflow.id}{execute_result.error}")
+                    execute_result.rows += _not_executed_rows(
+                        statements, line + 1, statement_sql
+                    )
+                    return execute_result
+    except Exception as e:
+        logger.warning(
+            f"工单{workflow.id}第{line}条语句执行报错，回滚第{line - len(chunk)}条之后的语句，错误信息：{e}"
+        )
+        execute_result.error = str(e)
+        try:
+            rollback()
+        except Exception as rollback_error:
+            logger.error(f"工单{workflow.id}回滚失败，错误信息：{rollback_error}")
+        # 提交失败时本批最后一条语句即为报错语句
+        if chunk and chunk[-1].id == line:
+            chunk.pop()
+        # 本批报错语句之前的语句已回滚
+        for result in chunk:
+            result.errlevel = 1
+            result.stagestatus = "Execute Rollback"
+            result.errormessage = "同批次语句执行失败, 已回滚"
+        execute_result.rows += chunk
+        execute_result.rows.append(
+            ReviewResult(
+                id=line,
+                errlevel=2,
+                stagestatus="Execute Failed",
+                errormessage=f"异常信息：{e}",
+                sql=statement_sql(statements[line - 1]),
+                affected_rows=0,
+                execute_time=0,
+            )
+        )
+        # 报错语句后面的语句标记为审核通过、未执行
+        execute_result.rows += _not_executed_rows(statements, line + 1, statement_sql)
+    return execute_result
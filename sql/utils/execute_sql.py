@@ -3,12 +3,14 @@ import logging
 import traceback
 
 from django.db import close_old_connections, connection, transaction
-from django_redis import get_redis_connection
 from common.utils.const import WorkflowStatus, WorkflowType
 from common.config import SysConfig
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.models import SqlWorkflow
 from sql.notify import notify_for_execute, EventType
+from sql.utils.execute_progress import clear_progress
+from sql.utils.metadata_catalog import metadata_catalog
+from sql.utils.query_tree_cache import query_tree_cache
 from sql.utils.workflow_audit import Audit
 from sql.engines import get_engine
 
@@ -85,6 +87,9 @@ def execute_callback(task):
         workflow.sqlworkflowcontent.execute_result = execute_result.json()
         workflow.sqlworkflowcontent.save()
         workflow.save()
+        # 执行完成后不再需要分批执行进度，执行异常的保留进度，重新执行时从中断处继续
+        if workflow.status == "workflow_finish":
+            clear_progress(workflow_id)
     except Exception as e:
         logger.error(f"SQL工单回调异常: {workflow_id} {traceback.format_exc()}")
         SqlWorkflow.objects.filter(id=workflow_id).update(
@@ -106,11 +111,11 @@ def execute_callback(task):
         operator_display="系统",
     )
 
-    # DDL工单结束后清空实例资源缓存
+    # DDL工单结束后使工单所在库、实例库列表的元数据缓存和语法树解析缓存失效
     if workflow.syntax_type == 1:
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match="*insRes*", count=2000):
-            r.delete(key)
+        query_tree_cache.invalidate(workflow.instance_id)
+        metadata_catalog.invalidate(workflow.instance_id, workflow.db_name)
+        metadata_catalog.invalidate(workflow.instance_id, "")
 
     # 开启了Execute阶段通知参数才发送消息通知
     sys_config = SysConfig()
@@ -120,4 +125,4 @@ def execute_callback(task):
         else True
     )
     if is_notified:
-        notify_for_execute(workflow)
+        notify_for_execute(workflow, flush=True)
@@ -1,3 +1,7 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from sql.engines import ResultSet
 from sql.models import InstanceAccount
 
 
@@ -17,3 +21,34 @@ def get_instanceaccount_unique_key(db_type: str) -> str:
         return "user_host"
     elif db_type == "mongo":
         return "db_name_user"
+
+
+def _summary_cache_key(instance, summary_type: str) -> str:
+    return f"instance_summary:{summary_type}:{instance.id}"
+
+
+def get_instance_summary(query_engine, summary_type: str, refresh=False) -> ResultSet:
+    """
+    获取实例账号(users)或数据库(databases)列表，查询成功的结果按INSTANCE_SUMMARY_CACHE_TTL缓存，
+    refresh为True时忽略缓存重新查询实例
+    """
+    key = _summary_cache_key(query_engine.instance, summary_type)
+    ttl = settings.INSTANCE_SUMMARY_CACHE_TTL
+    if ttl and not refresh:
+        rows = cache.get(key)
+        if rows is not None:
+            return ResultSet(rows=rows)
+    if summary_type == "users":
+        query_result = query_engine.get_instance_users_summary()
+    else:
+        query_result = query_engine.get_all_databases_summary()
+    if ttl and not query_result.error:
+        cache.set(key, query_result.rows, timeout=ttl)
+    return query_result
+
+
+def clear_instance_summary(instance, *summary_types):
+    """实例账号、权限或数据库变更后清除对应的列表缓存"""
+    cache.delete_many(
+        [_summary_cache_key(instance, summary_type) for summary_type in summary_types]
+    )
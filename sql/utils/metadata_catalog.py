@@ -0,0 +1,140 @@
+# -*- coding: UTF-8 -*-
+"""
+实例元数据目录缓存
+按 实例 -> 库 -> 表 缓存库列表、表列表、字段列表、表结构等元数据，保存在共享缓存中，
+缓存键带有实例和库两级版本号，DDL工单执行结束、创建数据库后只递增对应的版本号，不需要扫描键空间
+超过刷新间隔的缓存仍然直接返回，同时提交到后台线程从实例重新获取
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from sql.engines import ResultSet, get_engine
+
+logger = logging.getLogger("default")
+
+# 后台刷新元数据的线程数
+REFRESH_WORKERS = 2
+
+
+def _version_key(instance_id, db_name=None):
+    if db_name is None:
+        return f"metadata_catalog_version:{instance_id}"
+    return f"metadata_catalog_version:{instance_id}:{db_name}"
+
+
+class MetadataCatalog:
+    """
+    元数据通过引擎方法获取，方法名和参数作为缓存键的一部分，
+    后台刷新时使用新的引擎调用相同的方法，不依赖请求中的引擎
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = None
+
+    def get(self, query_engine, method, db_name="", **kwargs):
+        """
+        获取缓存的元数据，未命中时调用query_engine.method(db_name=db_name, **kwargs)并缓存结果
+        返回报错的ResultSet不缓存，获取版本号或读写缓存失败时直接查询实例
+        :param query_engine: 当前请求的引擎
+        :param method: 引擎方法名，如get_all_tables、get_all_columns_by_tb
+        :param db_name: 库名，为空表示实例级元数据，如库列表
+        """
+        instance = query_engine.instance
+        call_kwargs = dict(kwargs, db_name=db_name) if db_name else kwargs
+        try:
+            key = self._data_key(instance.id, method, db_name, kwargs)
+            entry = cache.get(key)
+        except Exception as e:
+            logger.warning(f"获取元数据缓存失败，跳过缓存，错误信息：{e}")
+            return getattr(query_engine, method)(**call_kwargs)
+        if entry is not None:
+            loaded_at, value = entry
+            if time.time() - loaded_at > settings.METADATA_CATALOG_REFRESH:
+                self._submit_refresh(instance, method, key, call_kwargs)
+            return value
+        value = getattr(query_engine, method)(**call_kwargs)
+        self._set(key, value)
+        return value
+
+    @staticmethod
+    def _data_key(instance_id, method, db_name, kwargs):
+        """缓存键包含实例和库的版本号，任一版本号递增后原有缓存不再被读取"""
+        instance_version_key = _version_key(instance_id)
+        db_version_key = _version_key(instance_id, db_name)
+        versions = cache.get_many([instance_version_key, db_version_key])
+        args = ",".join(f"{k}={v}" for k, v in sorted(kwargs.items()))
+        digest = hashlib.sha1(f"{db_name}\0{args}".encode("utf-8")).hexdigest()
+        return (
+            f"metadata_catalog:{instance_id}:{versions.get(instance_version_key, 0)}:"
+            f"{versions.get(db_version_key, 0)}:{method}:{digest}"
+        )
+
+    @staticmethod
+    def _set(key, value):
+        if isinstance(value, ResultSet) and value.error:
+            return
+        try:
+            cache.set(key, (time.time(), value), timeout=settings.METADATA_CATALOG_TTL)
+        except Exception as e:
+            logger.warning(f"写入元数据缓存失败，错误信息：{e}")
+
+    def _submit_refresh(self, instance, method, key, call_kwargs):
+        """同一个缓存键在进程内只会有一个刷新任务"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=REFRESH_WORKERS,
+                    thread_name_prefix="metadata_catalog_refresh",
+                )
+        try:
+            self._executor.submit(self._refresh, instance, method, key, call_kwargs)
+        except RuntimeError:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh(self, instance, method, key, call_kwargs):
+        query_engine = None
+        try:
+            query_engine = get_engine(instance=instance)
+            self._set(key, getattr(query_engine, method)(**call_kwargs))
+        except Exception as e:
+            logger.warning(
+                f"后台刷新元数据失败，实例：{instance.instance_name}，方法：{method}，错误信息：{e}"
+            )
+        finally:
+            if query_engine is not None:
+                query_engine.close()
+            # 后台线程中的数据库连接不会随请求结束关闭，需要主动关闭
+            connections.close_all()
+            with self._lock:
+                self._refreshing.discard(key)
+
+    @staticmethod
+    def invalidate(instance_id, db_name=None):
+        """
+        递增版本号使缓存失效
+        :param db_name: None表示实例的所有元数据，空字符串表示库列表，其他表示该库内的元数据
+        """
+        key = _version_key(instance_id, db_name)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, timeout=None)
+        except Exception as e:
+            logger.warning(f"元数据缓存失效失败，实例ID：{instance_id}，库：{db_name}，错误信息：{e}")
+
+
+metadata_catalog = MetadataCatalog()
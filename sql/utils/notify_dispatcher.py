@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+"""
+消息通知分发，每个通知渠道一个后台线程按顺序发送，单个渠道响应慢不会阻塞其他渠道，也不会阻塞提交通知的请求或任务
+渠道线程是守护线程，django-q任务中提交的通知需要在任务返回前调用flush等待发送完成，避免worker回收时丢失
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger("default")
+
+
+class NotifyDispatcher:
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._stats = {}
+
+    def submit(self, notifier):
+        """提交已经渲染好的notifier，由渠道线程调用notifier.run()发送"""
+        channel = notifier.name
+        with self._lock:
+            q, thread = self._channels.get(channel, (None, None))
+            if thread is None or not thread.is_alive():
+                q = q or queue.SimpleQueue()
+                thread = threading.Thread(
+                    target=self._run,
+                    args=(channel, q),
+                    name=f"notify_{channel}",
+                    daemon=True,
+                )
+                self._channels[channel] = (q, thread)
+                thread.start()
+            self._pending += 1
+            self._channel_stats(channel)["submitted"] += 1
+        q.put((notifier, time.monotonic()))
+
+    def flush(self, timeout=None):
+        """等待已提交的通知发送完成"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self):
+        with self._lock:
+            channels = {}
+            for channel, stats in self._stats.items():
+                done = stats["sent"] + stats["failed"]
+                channels[channel] = {
+                    "submitted": stats["submitted"],
+                    "sent": stats["sent"],
+                    "failed": stats["failed"],
+                    "latency_avg": round(stats["latency_sum"] / done, 3) if done else 0,
+                    "latency_max": round(stats["latency_max"], 3),
+                    "last_error": stats["last_error"],
+                }
+            return {"pending": self._pending, "channels": channels}
+
+    def _channel_stats(self, channel):
+        return self._stats.setdefault(
+            channel,
+            {
+                "submitted": 0,
+                "sent": 0,
+                "failed": 0,
+                "latency_sum": 0.0,
+                "latency_max": 0.0,
+                "last_error": "",
+            },
+        )
+
+    def _run(self, channel, q):
+        while True:
+            self._deliver(channel, *q.get())
+
+    def _deliver(self, channel, notifier, submit_time):
+        error = ""
+        try:
+            notifier.run()
+        except Exception as e:
+            error = str(e)
+            logger.error(f"failed to notify using `{channel}`: {error}")
+        finally:
+            # 渠道线程中的数据库连接不会随请求结束关闭，需要主动关闭
+            connections.close_all()
+        latency = time.monotonic() - submit_time
+        with self._lock:
+            stats = self._channel_stats(channel)
+            stats["failed" if error else "sent"] += 1
+            if error:
+                stats["last_error"] = error
+            stats["latency_sum"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+
+notify_dispatcher = NotifyDispatcher()
+# 进程退出前尽量发送完排队中的通知
+atexit.register(notify_dispatcher.flush, 10)
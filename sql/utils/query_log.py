@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+"""
+查询历史的检索、计数和归档
+sqllog、user_display、alias建立ngram全文索引后，搜索先通过全文索引筛选候选行，再用LIKE保证与子串匹配的结果一致
+总数最多统计到QUERY_LOG_COUNT_LIMIT，翻页不再每次扫描全部匹配行，分页可以使用before_id游标代替offset
+超过保留天数的非收藏记录迁移到query_log_archive表，在线检索只扫描近期数据
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+
+from sql.models import QueryLog
+
+logger = logging.getLogger("default")
+
+FULLTEXT_INDEX = "ft_query_log_search"
+FULLTEXT_COLUMNS = ("sqllog", "user_display", "alias")
+# ngram_token_size的默认值，无法从服务端获取时使用
+NGRAM_TOKEN_SIZE = 2
+ARCHIVE_TABLE = "query_log_archive"
+_fulltext_cache_key = "query_log_fulltext"
+_ngram_token_size_cache_key = "query_log_ngram_token_size"
+
+
+def fulltext_enabled():
+    """query_log是否已经建立全文索引，结果缓存10分钟"""
+
+    def check():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """select count(*) from information_schema.statistics
+where table_schema = database() and table_name = %s and index_name = %s""",
+                (QueryLog._meta.db_table, FULLTEXT_INDEX),
+            )
+            return cursor.fetchone()[0] > 0
+
+    try:
+        return cache.get_or_set(_fulltext_cache_key, check, 600)
+    except Exception as e:
+        logger.warning(f"检查查询历史全文索引失败，使用LIKE检索，错误信息：{e}")
+        return False
+
+
+def ngram_token_size():
+    """服务端的ngram_token_size配置，结果缓存10分钟，获取失败时使用默认值"""
+
+    def check():
+        with connection.cursor() as cursor:
+            cursor.execute("show variables like 'ngram_token_size'")
+            row = cursor.fetchone()
+            return int(row[1]) if row else NGRAM_TOKEN_SIZE
+
+    try:
+        return cache.get_or_set(_ngram_token_size_cache_key, check, 600)
+    except Exception as e:
+        logger.warning(f"获取ngram_token_size失败，使用默认值，错误信息：{e}")
+        return NGRAM_TOKEN_SIZE
+
+
+def use_fulltext(search):
+    """
+    ngram分词以空白分隔，短于ngram_token_size的词不会进入全文索引，
+    关键字中任一分词过短时全文索引会漏掉匹配行，只使用LIKE检索
+    """
+    tokens = search.split()
+    if not tokens or '"' in search or not fulltext_enabled():
+        return False
+    return min(len(token) for token in tokens) >= ngram_token_size()
+
+
+def create_fulltext_index():
+    """建立ngram全文索引，关闭停用词，避免包含停用词字符的分词被忽略"""
+    with connection.cursor() as cursor:
+        cursor.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+        cursor.execute(
+            f"ALTER TABLE {QueryLog._meta.db_table} ADD FULLTEXT INDEX {FULLTEXT_INDEX} "
+            f"({', '.join(FULLTEXT_COLUMNS)}) WITH PARSER ngram"
+        )
+    cache.delete(_fulltext_cache_key)
+
+
+def search_query_log(queryset, search):
+    """按语句、操作人、别名搜索，关键字的分词都足够长并且存在全文索引时先通过全文索引筛选"""
+    if not search:
+        return queryset
+    queryset = queryset.filter(
+        Q(sqllog__icontains=search)
+        | Q(user_display__icontains=search)
+        | Q(alias__icontains=search)
+    )
+    if use_fulltext(search):
+        queryset = queryset.extra(
+            where=[
+                f"MATCH ({', '.join(FULLTEXT_COLUMNS)}) AGAINST (%s IN BOOLEAN MODE)"
+            ],
+            params=[f'"{search}"'],
+        )
+    return queryset
+
+
+def count_query_log(queryset, exact=False):
+    """
+    统计查询历史数量，匹配行数超过QUERY_LOG_COUNT_LIMIT时返回上限值
+    :param exact: 是否精确统计
+    """
+    limit = settings.QUERY_LOG_COUNT_LIMIT
+    if exact or not limit:
+        return queryset.count()
+    return queryset.order_by().values("id")[:limit].count()
+
+
+def archive_query_log(days, batch_size=10000):
+    """
+    把days天之前的非收藏查询记录迁移到归档表，每批在一个事务中插入归档表并删除
+    :return: 迁移的行数
+    """
+    table = QueryLog._meta.db_table
+    columns = ", ".join(f.column for f in QueryLog._meta.concrete_fields)
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} LIKE {table}")
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    archived = 0
+    while True:
+        ids = list(
+            QueryLog.objects.filter(create_time__lt=cutoff, favorite=False)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return archived
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {ARCHIVE_TABLE} ({columns}) SELECT {columns} "
+                    f"FROM {table} WHERE id >= %s AND id <= %s AND create_time < %s "
+                    f"AND favorite = 0",
+                    (ids[0], ids[-1], cutoff),
+                )
+            deleted, _ = QueryLog.objects.filter(
+                id__gte=ids[0], id__lte=ids[-1], create_time__lt=cutoff, favorite=False
+            ).delete()
+        archived += deleted
+        logger.debug(f"查询历史归档完成，ID范围：[{ids[0]}, {ids[-1]}]")
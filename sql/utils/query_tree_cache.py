@@ -0,0 +1,231 @@
+# -*- coding: UTF-8 -*-
+"""
+goInception语法树解析结果缓存
+脱敏的select list、查询权限的引用表只和语句结构有关，按照 实例、库、去除字面量后的语句指纹 缓存，
+进程内保存解析结果，实例维度的版本号保存在共享缓存中，脱敏字段变更或者DDL工单执行结束后递增版本号使缓存失效
+解析只依赖语句本身，可以通过prefetch提交到有界线程池，与查询检查、查询执行并行，相同语句的解析只会进行一次
+"""
+import copy
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from sql.models import DataMaskingColumns
+
+logger = logging.getLogger("default")
+
+# 字符串、数字、十六进制等字面量，以及注释和连续空白
+_fingerprint_regex = re.compile(
+    r"""
+    (?P<comment>/\*.*?\*/|--[^\n]*|\#[^\n]*)
+    |(?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<ident>`(?:[^`]|``)*`)
+    |(?P<number>\b0x[0-9a-f]+\b|(?<![\w.])[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b)
+    |(?P<space>\s+)
+    """,
+    re.I | re.S | re.X,
+)
+_value_list_regex = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def _fingerprint_replace(match):
+    kind = match.lastgroup
+    if kind in ("string", "number"):
+        return "?"
+    if kind in ("comment", "space"):
+        return " "
+    return match.group()
+
+
+def sql_fingerprint(sql):
+    """去除注释和字面量后的语句指纹，IN列表等多值列表统一为(?+)"""
+    normalized = _fingerprint_regex.sub(_fingerprint_replace, sql)
+    normalized = _value_list_regex.sub("(?+)", normalized)
+    normalized = normalized.strip().rstrip(";").strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _version_key(instance_id):
+    return f"query_tree_cache_version:{instance_id}"
+
+
+class QueryTreeCache:
+    """进程内的LRU缓存，按照实例版本号失效"""
+
+    def __init__(self, max_size=2000, timeout=60 * 60 * 24):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在解析中的语句，相同语句的并发请求等待同一个解析结果
+        self._inflight = {}
+        self._executor = None
+        self._prefetch_slots = None
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        self.prefetches = 0
+        self.prefetch_rejects = 0
+
+    def get_or_set(self, instance, db_name, kind, sql, func, timeout=None):
+        """
+        获取缓存的解析结果，未命中则调用func并缓存结果，func抛出的异常不会被缓存
+        相同语句正在解析时等待其结果，等待的解析失败则由当前线程重新解析，异常与不使用缓存时一致
+        :param instance: 实例对象
+        :param db_name: 库名
+        :param kind: 解析类型，如masking、print
+        :param sql: 原始语句
+        :param func: 未命中时获取解析结果的函数
+        :param timeout: 缓存有效期(秒)，不传时使用self.timeout
+        """
+        timeout = timeout or self.timeout
+        try:
+            version = cache.get(_version_key(instance.id), 0)
+        except Exception as e:
+            logger.warning(f"获取语法树缓存版本失败，跳过缓存，错误信息：{e}")
+            return func()
+        key = (instance.id, db_name, kind, sql_fingerprint(sql))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] == version and now - entry[1] < timeout:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[2])
+            inflight = self._inflight.get((key, version))
+            if inflight:
+                self.joins += 1
+            else:
+                self.misses += 1
+                self._inflight[(key, version)] = Future()
+        if inflight:
+            try:
+                return copy.deepcopy(inflight.result())
+            except Exception:
+                return func()
+        return self._load(key, version, now, func)
+
+    def _load(self, key, version, now, func):
+        """调用func解析并写入缓存，同时通知等待该语句的线程"""
+        inflight = self._inflight[(key, version)]
+        try:
+            value = func()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop((key, version), None)
+            inflight.set_exception(e)
+            raise
+        with self._lock:
+            self._data[key] = (version, now, copy.deepcopy(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._inflight.pop((key, version), None)
+        inflight.set_result(value)
+        return value
+
+    def prefetch(self, instance, db_name, kind, sql, func):
+        """
+        提交到后台线程池提前解析，结果写入缓存，后续get_or_set直接复用或等待其结果
+        线程池繁忙时放弃预取，由请求线程自行解析
+        :return: 是否已提交
+        """
+        executor = self._get_executor()
+        if not executor or not self._prefetch_slots.acquire(blocking=False):
+            with self._lock:
+                self.prefetch_rejects += 1
+            return False
+        with self._lock:
+            self.prefetches += 1
+        try:
+            executor.submit(self._prefetch, instance, db_name, kind, sql, func)
+        except RuntimeError:
+            self._prefetch_slots.release()
+            return False
+        return True
+
+    def _prefetch(self, instance, db_name, kind, sql, func):
+        try:
+            self.get_or_set(instance, db_name, kind, sql, func)
+        except Exception as e:
+            logger.debug(f"语法树预解析失败，由请求线程重新解析，错误信息：{e}")
+        finally:
+            # 后台线程中的数据库连接不会随请求结束关闭，需要主动关闭
+            connections.close_all()
+            self._prefetch_slots.release()
+
+    def _get_executor(self):
+        workers = settings.QUERY_PREFETCH_WORKERS
+        if workers <= 0:
+            return None
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # 排队的任务同样受限，排队过多时解析已经不能与查询并行
+                    self._prefetch_slots = threading.BoundedSemaphore(workers * 2)
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=workers, thread_name_prefix="query_tree_prefetch"
+                    )
+        return self._executor
+
+    def discard(self, instance, db_name, kind, sql):
+        """删除单条语句的解析结果，用于缓存结果与实际执行结果不一致时重新解析"""
+        key = (instance.id, db_name, kind, sql_fingerprint(sql))
+        with self._lock:
+            self._data.pop(key, None)
+
+    @staticmethod
+    def invalidate(instance_id):
+        """递增实例版本号，所有进程中该实例的缓存失效"""
+        key = _version_key(instance_id)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, timeout=None)
+        except Exception as e:
+            logger.warning(f"语法树缓存失效失败，实例ID：{instance_id}，错误信息：{e}")
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.joins = 0
+            self.prefetches = 0
+            self.prefetch_rejects = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0,
+                "inflight": len(self._inflight),
+                "joins": self.joins,
+                "prefetches": self.prefetches,
+                "prefetch_rejects": self.prefetch_rejects,
+            }
+
+
+query_tree_cache = QueryTreeCache()
+
+
+@receiver(post_save, sender=DataMaskingColumns)
+@receiver(post_delete, sender=DataMaskingColumns)
+def invalidate_masking_columns(sender, instance, **kwargs):
+    """脱敏字段配置变更后使对应实例的缓存失效"""
+    query_tree_cache.invalidate(instance.instance_id)
@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+"""
+查询超时看门狗，替代每次查询都写入django-q Schedule的定时终止任务
+进程内按到期时间维护最小堆，由一个后台线程在到期时调用终止函数，正常结束的查询只需要取消，不产生数据库写入
+看门狗只在当前进程内有效，进程退出后由MySQL服务端的max_execution_time兜底
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger("default")
+
+
+class _Watch:
+    __slots__ = ("deadline", "seq", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, seq, callback, args):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class QueryWatchdog:
+    """按到期时间排序的定时器，到期后在独立线程中执行终止函数，避免单个终止阻塞其他到期任务"""
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._cancelled = 0
+        self.watched = 0
+        self.finished = 0
+        self.killed = 0
+        self.kill_failed = 0
+        self.last_kill_time = None
+
+    def watch(self, timeout, callback, *args):
+        """
+        注册一个超时任务
+        :param timeout: 超时时间(秒)
+        :param callback: 到期后调用的终止函数，如kill_query_conn
+        :param args: 终止函数的参数
+        :return: 用于取消的标识
+        """
+        watch = _Watch(time.monotonic() + timeout, next(self._seq), callback, args)
+        with self._cond:
+            self._ensure_thread()
+            heapq.heappush(self._heap, watch)
+            self.watched += 1
+            # 新任务比当前等待的任务更早到期时唤醒后台线程
+            if self._heap[0] is watch:
+                self._cond.notify()
+        return watch
+
+    def cancel(self, watch):
+        """
+        查询结束后取消超时任务，已触发的任务取消无效
+        :return: 任务已触发返回False，此时终止函数可能仍在执行
+        """
+        if watch is None:
+            return True
+        with self._cond:
+            if watch.cancelled:
+                return False
+            watch.cancelled = True
+            self.finished += 1
+            self._cancelled += 1
+            # 取消的任务延迟删除，数量过多时重建堆
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                self._heap = [w for w in self._heap if not w.cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._heap) - self._cancelled,
+                "watched": self.watched,
+                "finished": self.finished,
+                "killed": self.killed,
+                "kill_failed": self.kill_failed,
+                "last_kill_time": self.last_kill_time,
+            }
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="query_watchdog", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                watch = self._heap[0]
+                if watch.cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                    continue
+                delay = watch.deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                # 标记为已处理，之后的cancel不再计数
+                watch.cancelled = True
+            threading.Thread(
+                target=self._fire,
+                args=(watch,),
+                name="query_watchdog_kill",
+                daemon=True,
+            ).start()
+
+    def _fire(self, watch):
+        try:
+            watch.callback(*watch.args)
+            with self._cond:
+                self.killed += 1
+                self.last_kill_time = time.strftime("%Y-%m-%d %H:%M:%S")
+            logger.info(f"查询超时，已终止会话：{watch.args}")
+        except Exception as e:
+            with self._cond:
+                self.kill_failed += 1
+            logger.error(f"终止超时查询失败，参数：{watch.args}，错误信息：{e}")
+        finally:
+            connections.close_all()
+
+
+query_watchdog = QueryWatchdog()
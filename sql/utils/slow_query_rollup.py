@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志汇总，把pt-query-digest写入的明细按 主机/库/checksum 汇总到小时表和天表
+按照明细自增ID增量处理，汇总和进度在同一个事务中提交，重复执行不会重复累加
+自增ID在插入时分配、提交后才可见，观察到的最大ID超过安全延迟后才汇总到该ID，避免跳过晚提交的较小ID
+慢日志统计页面按天表分组，趋势图按小时表换算时区后分组，不再扫描明细表
+"""
+import logging
+
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from sql.models import (
+    SlowQueryHistory,
+    SlowQueryRollupDaily,
+    SlowQueryRollupHourly,
+    SlowQueryRollupState,
+)
+
+logger = logging.getLogger("default")
+
+# 每批处理的明细ID范围
+ROLLUP_BATCH_SIZE = 50000
+
+# 安全延迟(秒)，pt-query-digest自动提交写入，ID分配到提交之间很短
+ROLLUP_SAFETY_LAG = 60
+
+_rollup_sql = """
+INSERT INTO {table} (hostname, db_name, checksum, bucket, ts_cnt, query_time_sum, lock_time_sum,
+    rows_sent_sum, rows_examined_sum, query_time_pct_95_max, ts_max)
+SELECT * FROM (
+    SELECT hostname_max AS hostname, IFNULL(db_max, '') AS db_name, checksum, {bucket} AS bucket,
+        IFNULL(SUM(ts_cnt), 0) AS ts_cnt,
+        IFNULL(SUM(Query_time_sum), 0) AS query_time_sum,
+        IFNULL(SUM(Lock_time_sum), 0) AS lock_time_sum,
+        IFNULL(SUM(Rows_sent_sum), 0) AS rows_sent_sum,
+        IFNULL(SUM(Rows_examined_sum), 0) AS rows_examined_sum,
+        IFNULL(MAX(Query_time_pct_95), 0) AS query_time_pct_95_max,
+        MAX(ts_max) AS ts_max
+    FROM mysql_slow_query_review_history
+    WHERE id > %s AND id <= %s
+    GROUP BY hostname, db_name, checksum, bucket
+) AS r
+ON DUPLICATE KEY UPDATE
+    ts_cnt = {table}.ts_cnt + r.ts_cnt,
+    query_time_sum = {table}.query_time_sum + r.query_time_sum,
+    lock_time_sum = {table}.lock_time_sum + r.lock_time_sum,
+    rows_sent_sum = {table}.rows_sent_sum + r.rows_sent_sum,
+    rows_examined_sum = {table}.rows_examined_sum + r.rows_examined_sum,
+    query_time_pct_95_max = GREATEST({table}.query_time_pct_95_max, r.query_time_pct_95_max),
+    ts_max = GREATEST({table}.ts_max, r.ts_max)"""
+
+_rollup_tables = (
+    (
+        SlowQueryRollupHourly._meta.db_table,
+        "TIMESTAMP(DATE(ts_min), MAKETIME(HOUR(ts_min), 0, 0))",
+    ),
+    (SlowQueryRollupDaily._meta.db_table, "TIMESTAMP(DATE(ts_min))"),
+)
+
+
+def _rollup_target(safety_lag):
+    """
+    本次允许汇总到的明细ID
+    每次执行记录观察到的最大ID和时间，超过安全延迟后比它小的ID都已提交或回滚，可以汇总
+    首次执行没有观察记录，直接汇总到当前最大ID
+    """
+    max_id = SlowQueryHistory.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+    now = timezone.now()
+    with transaction.atomic():
+        state, _ = SlowQueryRollupState.objects.select_for_update().get_or_create(pk=1)
+        if state.pending_time is None or safety_lag <= 0:
+            state.safe_id = max(state.safe_id, max_id)
+            state.pending_id, state.pending_time = max_id, now
+        elif (now - state.pending_time).total_seconds() >= safety_lag:
+            state.safe_id = max(state.safe_id, state.pending_id)
+            state.pending_id, state.pending_time = max_id, now
+        state.save(update_fields=["safe_id", "pending_id", "pending_time"])
+        return state.safe_id
+
+
+def rollup_slow_query(batch_size=ROLLUP_BATCH_SIZE, safety_lag=ROLLUP_SAFETY_LAG):
+    """
+    汇总上次汇总之后新增的慢日志明细
+    pt-query-digest单连接按顺序写入明细，ID递增，重新分析已经汇总过的日志需要使用rebuild重建
+    :param safety_lag: 安全延迟(秒)，观察到的最大ID超过该延迟后才汇总
+    :return: 本次汇总的明细ID范围上限
+    """
+    max_id = _rollup_target(safety_lag)
+    while True:
+        with transaction.atomic():
+            # 锁定进度，定时任务与手动执行的命令不会重复汇总同一批数据
+            state, _ = SlowQueryRollupState.objects.select_for_update().get_or_create(
+                pk=1
+            )
+            if state.last_id >= max_id:
+                return state.last_id
+            end_id = min(state.last_id + batch_size, max_id)
+            with connection.cursor() as cursor:
+                for table, bucket in _rollup_tables:
+                    cursor.execute(
+                        _rollup_sql.format(table=table, bucket=bucket),
+                        (state.last_id, end_id),
+                    )
+            logger.debug(f"慢日志汇总完成，明细ID范围：({state.last_id}, {end_id}]")
+            state.last_id = end_id
+            state.save(update_fields=["last_id", "update_time"])
+
+
+def rebuild_slow_query_rollup(
+    batch_size=ROLLUP_BATCH_SIZE, safety_lag=ROLLUP_SAFETY_LAG
+):
+    """清空汇总表和进度，从头汇总全部明细，汇总到已允许汇总的明细ID为止"""
+    with transaction.atomic():
+        SlowQueryRollupState.objects.select_for_update().get_or_create(pk=1)
+        SlowQueryRollupHourly.objects.all().delete()
+        SlowQueryRollupDaily.objects.all().delete()
+        SlowQueryRollupState.objects.filter(pk=1).update(last_id=0)
+    return rollup_slow_query(batch_size=batch_size, safety_lag=safety_lag)
@@ -1,9 +1,11 @@
 import datetime
-import json
 import re
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 
-from sql.engines.models import ReviewResult
+from sql.engines import get_engine
+from sql.engines.models import ReviewResult, ReviewSet
 from sql.models import SqlWorkflow
 from common.config import SysConfig
 from sql.utils.resource_group import user_groups
@@ -37,7 +39,7 @@ def is_auto_review(workflow_id):
         auto_review = True
         all_affected_rows = 0
         review_content = workflow.sqlworkflowcontent.review_content
-        for review_row in json.loads(review_content):
+        for review_row in ReviewSet.load_rows(review_content):
             review_result = ReviewResult(**review_row)
             # 去除SQL注释 https://github.com/hhyo/Archery/issues/949
             sql = remove_comments(review_result.sql).replace("\n", "").replace("\r", "")
@@ -201,3 +203,21 @@ def can_rollback(user, workflow_id):
     ):
         return can_view(user, workflow_id)
     return result
+
+
+def get_rollback_sql(workflow):
+    """
+    获取工单的回滚语句，return [['源语句'，'回滚语句']]
+    执行完成的工单回滚语句不再变化，配置ROLLBACK_CACHE_TTL后缓存查询结果
+    """
+    cacheable = settings.ROLLBACK_CACHE_TTL and workflow.status == "workflow_finish"
+    key = f"rollback_sql:{workflow.id}"
+    if cacheable:
+        list_backup_sql = cache.get(key)
+        if list_backup_sql is not None:
+            return list_backup_sql
+    query_engine = get_engine(instance=workflow.instance)
+    list_backup_sql = query_engine.get_rollback(workflow=workflow)
+    if cacheable:
+        cache.set(key, list_backup_sql, timeout=settings.ROLLBACK_CACHE_TTL)
+    return list_backup_sql
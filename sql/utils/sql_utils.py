@@ -7,6 +7,8 @@
 """
 import re
 import xml
+from functools import lru_cache
+
 import mybatis_mapper2sql
 import sqlparse
 
@@ -15,6 +17,26 @@ from sql.utils.extract_tables import extract_tables as extract_tables_by_sql_par
 
 __author__ = "hhyo"
 
+# 不使用sqlparse解析时判断语句类型的正则，(DDL, DML)
+_syntax_type_re = {
+    "mysql": (
+        re.compile(r"^alter|^create|^drop|^rename|^truncate", re.I),
+        re.compile(
+            r"^call|^delete|^do|^handler|^insert|^load\s+data|^load\s+xml|^replace|^select|^update",
+            re.I,
+        ),
+    ),
+    "oracle": (
+        re.compile(r"^alter|^create|^drop|^rename|^truncate", re.I),
+        re.compile(r"^delete|^exec|^insert|^select|^update|^with|^merge", re.I),
+    ),
+}
+# 可能包含注释的标记，不包含这些字符的语句不需要去除注释
+_comment_markers = {
+    "mysql": ("/*", "#", "--"),
+    "oracle": ("/*", "--", "rem"),
+}
+
 
 def get_syntax_type(sql, parser=True, db_type="mysql"):
     """
@@ -24,44 +46,51 @@ def get_syntax_type(sql, parser=True, db_type="mysql"):
     :param db_type: 不使用sqlparse解析时需要提供该参数
     :return:
     """
+    if not parser:
+        return get_syntax_types([sql], db_type=db_type)[0]
     sql = remove_comments(sql=sql, db_type=db_type)
-    if parser:
-        try:
-            statement = sqlparse.parse(sql)[0]
-            syntax_type = statement.token_first(skip_cm=True).ttype.__str__()
-            if syntax_type == "Token.Keyword.DDL":
-                syntax_type = "DDL"
-            elif syntax_type == "Token.Keyword.DML":
-                syntax_type = "DML"
-        except Exception:
-            syntax_type = None
-    else:
-        if db_type == "mysql":
-            ddl_re = r"^alter|^create|^drop|^rename|^truncate"
-            dml_re = r"^call|^delete|^do|^handler|^insert|^load\s+data|^load\s+xml|^replace|^select|^update"
-        elif db_type == "oracle":
-            ddl_re = r"^alter|^create|^drop|^rename|^truncate"
-            dml_re = r"^delete|^exec|^insert|^select|^update|^with|^merge"
-        else:
-            # TODO 其他数据库的解析正则
-            return None
-        if re.match(ddl_re, sql, re.I):
+    try:
+        statement = sqlparse.parse(sql)[0]
+        syntax_type = statement.token_first(skip_cm=True).ttype.__str__()
+        if syntax_type == "Token.Keyword.DDL":
             syntax_type = "DDL"
-        elif re.match(dml_re, sql, re.I):
+        elif syntax_type == "Token.Keyword.DML":
             syntax_type = "DML"
-        else:
-            syntax_type = None
+    except Exception:
+        syntax_type = None
     return syntax_type
 
 
-def remove_comments(sql, db_type="mysql"):
+def get_syntax_types(sql_list, db_type="mysql"):
     """
-    去除SQL语句中的注释信息
-    来源:https://stackoverflow.com/questions/35647841/parse-sql-file-with-comments-into-sqlite-with-python
-    :param sql:
+    批量返回SQL语句类型，仅判断DDL和DML，不使用sqlparse解析
+    :param sql_list: SQL语句列表
     :param db_type:
-    :return:
+    :return: 与sql_list一一对应的 DDL/DML/None 列表
     """
+    if db_type not in _syntax_type_re:
+        # TODO 其他数据库的解析正则
+        return [None] * len(sql_list)
+    ddl_re, dml_re = _syntax_type_re[db_type]
+    markers = _comment_markers[db_type]
+    syntax_types = []
+    for sql in sql_list:
+        sql = sql or ""
+        if any(marker in sql for marker in markers):
+            sql = remove_comments(sql=sql, db_type=db_type)
+        else:
+            sql = sql.strip()
+        if ddl_re.match(sql):
+            syntax_types.append("DDL")
+        elif dml_re.match(sql):
+            syntax_types.append("DML")
+        else:
+            syntax_types.append(None)
+    return syntax_types
+
+
+@lru_cache()
+def _comments_regex(db_type):
     sql_comments_re = {
         "oracle": [r"(?:--)[^\n]*\n", r"(?:\W|^)(?:remark|rem)\s+[^\n]*\n"],
         "mysql": [r"(?:#|--\s)[^\n]*\n"],
@@ -73,7 +102,18 @@ def remove_comments(sql, db_type="mysql"):
     elif isinstance(specific_comment_re, list):
         additional_patterns += "|".join(specific_comment_re)
     pattern = r"(\".*?\"|\'.*?\')|(/\*.*?\*/{})".format(additional_patterns)
-    regex = re.compile(pattern, re.MULTILINE | re.DOTALL)
+    return re.compile(pattern, re.MULTILINE | re.DOTALL)
+
+
+def remove_comments(sql, db_type="mysql"):
+    """
+    去除SQL语句中的注释信息
+    来源:https://stackoverflow.com/questions/35647841/parse-sql-file-with-comments-into-sqlite-with-python
+    :param sql:
+    :param db_type:
+    :return:
+    """
+    regex = _comments_regex(db_type)
 
     def _replacer(match):
         if match.group(2):
@@ -5,14 +5,228 @@
 @file: ssh_tunnel.py
 @time: 2020/05/09
 """
-from sshtunnel import SSHTunnelForwarder
-from paramiko import RSAKey
+import hashlib
 import io
+import logging
+import threading
+import time
+
+from django.conf import settings
+from paramiko import RSAKey
+from sshtunnel import SSHTunnelForwarder
+
+logger = logging.getLogger("default")
+
+
+class _SharedTunnel:
+    """一个SSH端口映射，由多个引擎共享，引用计数归零且空闲超时后关闭"""
+
+    def __init__(self, server, key, label):
+        self.server = server
+        self.key = key
+        self.label = label
+        self.refs = 0
+        self.leases = 0
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+
+    @property
+    def local_port(self):
+        return self.server.local_bind_port
+
+    def is_active(self):
+        try:
+            return self.server.is_active
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.server.close()
+        except Exception as e:
+            logger.warning(f"关闭SSH隧道失败，隧道：{self.label}，错误信息：{e}")
+
+
+class SSHTunnelManager:
+    """
+    进程内的SSH隧道管理，按 隧道配置、远端地址、端口 复用端口映射，
+    避免每个引擎都重新进行SSH握手、监听新的本地端口
+    """
+
+    def __init__(self):
+        self._tunnels = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self.hits = 0
+        self.misses = 0
+        self.restarts = 0
+        self.reaped = 0
+
+    def acquire(
+        self,
+        host,
+        port,
+        tun_host,
+        tun_port,
+        tun_user,
+        tun_password,
+        pkey,
+        pkey_password,
+    ):
+        """获取隧道并增加引用计数，已存在的隧道断开时重新建立"""
+        secret = hashlib.sha1(
+            f"{tun_password}\0{pkey}\0{pkey_password}".encode()
+        ).hexdigest()
+        key = (tun_host, int(tun_port), tun_user, secret, host, int(port))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # 同一个隧道只由一个线程建立，SSH握手不阻塞其他隧道的获取
+        with key_lock:
+            stale = None
+            with self._lock:
+                tunnel = self._tunnels.get(key)
+                if tunnel and tunnel.is_active():
+                    self.hits += 1
+                    tunnel.refs += 1
+                    tunnel.leases += 1
+                    tunnel.last_used = time.monotonic()
+                    return tunnel
+                if tunnel:
+                    # 断开的隧道不再分配，仍持有它的引擎释放后关闭
+                    self.restarts += 1
+                    del self._tunnels[key]
+                    if tunnel.refs == 0:
+                        stale = tunnel
+            if stale:
+                stale.close()
+            tunnel = _SharedTunnel(
+                self._start(
+                    host,
+                    port,
+                    tun_host,
+                    tun_port,
+                    tun_user,
+                    tun_password,
+                    pkey,
+                    pkey_password,
+                ),
+                key,
+                label=f"{tun_user}@{tun_host}:{tun_port}->{host}:{port}",
+            )
+            tunnel.refs = 1
+            tunnel.leases = 1
+            with self._lock:
+                self.misses += 1
+                self._tunnels[key] = tunnel
+                self._ensure_reaper()
+        return tunnel
+
+    def release(self, tunnel):
+        """释放引用，已被替换的隧道在没有引用后立即关闭，其余的等待空闲回收"""
+        with self._lock:
+            tunnel.refs -= 1
+            tunnel.last_used = time.monotonic()
+            stale = tunnel.refs == 0 and self._tunnels.get(tunnel.key) is not tunnel
+        if stale:
+            tunnel.close()
+
+    @staticmethod
+    def _start(
+        host, port, tun_host, tun_port, tun_user, tun_password, pkey, pkey_password
+    ):
+        kwargs = dict(
+            ssh_address_or_host=(tun_host, int(tun_port)),
+            ssh_username=tun_user,
+            remote_bind_address=(host, int(port)),
+            set_keepalive=settings.SSH_TUNNEL["KEEPALIVE"],
+        )
+        if pkey:
+            private_key_file_obj = io.StringIO()
+            private_key_file_obj.write(pkey)
+            private_key_file_obj.seek(0)
+            kwargs["ssh_pkey"] = RSAKey.from_private_key(
+                private_key_file_obj, password=pkey_password
+            )
+        else:
+            kwargs["ssh_password"] = tun_password
+        server = SSHTunnelForwarder(**kwargs)
+        server.start()
+        return server
+
+    def reap(self):
+        """关闭没有引用且空闲超时或已断开的隧道"""
+        idle_timeout = settings.SSH_TUNNEL["IDLE_TIMEOUT"]
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                key
+                for key, tunnel in self._tunnels.items()
+                if tunnel.refs == 0
+                and (now - tunnel.last_used > idle_timeout or not tunnel.is_active())
+            ]
+            tunnels = [self._tunnels.pop(key) for key in expired]
+            self.reaped += len(tunnels)
+        for tunnel in tunnels:
+            tunnel.close()
+
+    def _ensure_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(
+                target=self._run_reaper, name="ssh_tunnel_reaper", daemon=True
+            )
+            self._reaper.start()
+
+    def _run_reaper(self):
+        while True:
+            time.sleep(min(60, max(1, settings.SSH_TUNNEL["IDLE_TIMEOUT"])))
+            try:
+                self.reap()
+            except Exception as e:
+                logger.warning(f"回收SSH隧道失败，错误信息：{e}")
+
+    def clear(self):
+        """关闭所有隧道"""
+        with self._lock:
+            tunnels, self._tunnels = list(self._tunnels.values()), {}
+        for tunnel in tunnels:
+            tunnel.close()
+
+    def stats(self):
+        self.reap()
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "tunnels": [
+                    {
+                        "label": tunnel.label,
+                        "local_port": tunnel.local_port,
+                        "active": tunnel.is_active(),
+                        "refs": tunnel.refs,
+                        "leases": tunnel.leases,
+                        "idle": round(now - tunnel.last_used, 1)
+                        if tunnel.refs == 0
+                        else 0,
+                        "created_at": time.strftime(
+                            "%Y-%m-%d %H:%M:%S", time.localtime(tunnel.created_at)
+                        ),
+                    }
+                    for tunnel in self._tunnels.values()
+                ],
+                "hits": self.hits,
+                "misses": self.misses,
+                "restarts": self.restarts,
+                "reaped": self.reaped,
+            }
+
+
+ssh_tunnel_manager = SSHTunnelManager()
 
 
 class SSHConnection(object):
     """
     ssh隧道连接类，用于映射ssh隧道端口到本地，连接结束时需要清理
+    端口映射由ssh_tunnel_manager在进程内共享，清理时只释放引用
     """
 
     def __init__(
@@ -32,31 +246,25 @@ class SSHConnection(object):
         self.tun_port = int(tun_port)
         self.tun_user = tun_user
         self.tun_password = tun_password
+        self.tunnel = ssh_tunnel_manager.acquire(
+            self.host,
+            self.port,
+            self.tun_host,
+            self.tun_port,
+            self.tun_user,
+            self.tun_password,
+            pkey,
+            pkey_password,
+        )
 
-        if pkey:
-            private_key_file_obj = io.StringIO()
-            private_key_file_obj.write(pkey)
-            private_key_file_obj.seek(0)
-            self.private_key = RSAKey.from_private_key(
-                private_key_file_obj, password=pkey_password
-            )
-            self.server = SSHTunnelForwarder(
-                ssh_address_or_host=(self.tun_host, self.tun_port),
-                ssh_username=self.tun_user,
-                ssh_pkey=self.private_key,
-                remote_bind_address=(self.host, self.port),
-            )
-        else:
-            self.server = SSHTunnelForwarder(
-                ssh_address_or_host=(self.tun_host, self.tun_port),
-                ssh_username=self.tun_user,
-                ssh_password=self.tun_password,
-                remote_bind_address=(self.host, self.port),
-            )
-        self.server.start()
+    def close(self):
+        """释放隧道引用，重复调用无影响"""
+        tunnel, self.tunnel = getattr(self, "tunnel", None), None
+        if tunnel:
+            ssh_tunnel_manager.release(tunnel)
 
     def __del__(self):
-        self.server.close()
+        self.close()
 
     def get_ssh(self):
         """
@@ -64,4 +272,4 @@ class SSHConnection(object):
         :param request:
         :return:
         """
-        return "127.0.0.1", self.server.local_bind_port
+        return "127.0.0.1", self.tunnel.local_port
@@ -1,4 +1,6 @@
 # -*- coding:utf-8 -*-
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
 from django_q.tasks import schedule
 from django_q.models import Schedule
 
@@ -6,6 +8,9 @@ import logging
 
 logger = logging.getLogger("default")
 
+SLOW_QUERY_ROLLUP_SCHEDULE = "慢日志汇总"
+DASHBOARD_STATS_SCHEDULE = "dashboard统计汇总"
+
 
 def add_sql_schedule(name, run_date, workflow_id):
     """添加/修改sql定时任务"""
@@ -50,6 +55,45 @@ def add_sync_ding_user_schedule():
     )
 
 
+def add_slow_query_rollup_schedule():
+    """添加慢日志增量汇总定时任务"""
+    del_schedule(name=SLOW_QUERY_ROLLUP_SCHEDULE)
+    schedule(
+        "sql.utils.slow_query_rollup.rollup_slow_query",
+        name=SLOW_QUERY_ROLLUP_SCHEDULE,
+        schedule_type="I",
+        minutes=5,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_dashboard_stats_schedule():
+    """添加dashboard统计增量汇总定时任务"""
+    del_schedule(name=DASHBOARD_STATS_SCHEDULE)
+    schedule(
+        "common.utils.dashboard_stats.refresh_dashboard_stats",
+        name=DASHBOARD_STATS_SCHEDULE,
+        schedule_type="I",
+        minutes=5,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_query_log_archive_schedule(days):
+    """添加查询历史归档定时任务"""
+    del_schedule(name="查询历史归档")
+    schedule(
+        "sql.utils.query_log.archive_query_log",
+        days,
+        name="查询历史归档",
+        schedule_type="D",
+        repeats=-1,
+        timeout=-1,
+    )
+
+
 def del_schedule(name):
     """删除schedule"""
     try:
@@ -67,3 +111,24 @@ def task_info(name):
         return sql_schedule
     except Schedule.DoesNotExist:
         pass
+
+
+@receiver(post_migrate)
+def add_rollup_schedules_on_migrate(sender, **kwargs):
+    """
+    迁移后添加缺失的汇总定时任务，升级的部署不需要手动执行汇总命令
+    新添加的任务立即执行，汇总进度从0开始，首次执行即回填全部历史数据
+    """
+    if sender.label != "sql":
+        return
+    rollup_schedules = {
+        SLOW_QUERY_ROLLUP_SCHEDULE: add_slow_query_rollup_schedule,
+        DASHBOARD_STATS_SCHEDULE: add_dashboard_stats_schedule,
+    }
+    try:
+        for name, add_schedule in rollup_schedules.items():
+            if not Schedule.objects.filter(name=name).exists():
+                add_schedule()
+                logger.info(f"已添加汇总定时任务：{name}")
+    except Exception as e:
+        logger.warning(f"添加汇总定时任务失败，错误信息：{e}")
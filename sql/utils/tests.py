@@ -8,15 +8,17 @@
 
 import datetime
 import json
+import threading
+import time
 from unittest.mock import patch, MagicMock
 
 from django.conf import settings
 from django.contrib.auth.models import Permission, Group
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django_q.models import Schedule
 
 from common.config import SysConfig
-from sql.engines.models import ReviewResult, ReviewSet
+from sql.engines.models import ResultSet, ReviewResult, ReviewSet
 from sql.models import (
     Users,
     SqlWorkflow,
@@ -38,8 +40,36 @@ from sql.utils.sql_review import (
 )
 from sql.utils.sql_utils import *
 from sql.utils.execute_sql import execute, execute_callback
-from sql.utils.tasks import add_sql_schedule, del_schedule, task_info
-from sql.utils.data_masking import data_masking, brute_mask, simple_column_mask
+from sql.utils.tasks import (
+    DASHBOARD_STATS_SCHEDULE,
+    SLOW_QUERY_ROLLUP_SCHEDULE,
+    add_rollup_schedules_on_migrate,
+    add_sql_schedule,
+    del_schedule,
+    task_info,
+)
+from sql.utils.data_masking import (
+    data_masking,
+    prefetch_masking,
+    brute_mask,
+    simple_column_mask,
+    mask_rows,
+)
+from sql.utils.query_tree_cache import (
+    QueryTreeCache,
+    sql_fingerprint,
+    query_tree_cache,
+)
+from sql.utils.query_watchdog import QueryWatchdog
+from sql.utils.metadata_catalog import metadata_catalog
+from sql.utils.ssh_tunnel import SSHConnection, SSHTunnelManager, ssh_tunnel_manager
+from sql.utils.connection_pool import (
+    ConnectionPool,
+    changes_session_state,
+    get_pool,
+    clear_pools,
+    pool_stats,
+)
 
 User = Users
 __author__ = "hhyo"
@@ -68,6 +98,28 @@ class TestSQLUtils(TestCase):
         self.assertEqual(get_syntax_type(ddl_sql, parser=False, db_type="mysql"), "DDL")
         self.assertIsNone(get_syntax_type(other_sql, parser=False, db_type="mysql"))
 
+    def test_get_syntax_types(self):
+        """
+        测试批量语法判断
+        :return:
+        """
+        sql_list = [
+            "select * from users;",
+            "/* comment */ alter table users add id int",
+            "# comment\ninsert into users values (1)",
+            "show engine innodb status",
+            None,
+        ]
+        self.assertEqual(
+            get_syntax_types(sql_list, db_type="mysql"),
+            ["DML", "DDL", "DML", None, None],
+        )
+        self.assertEqual(
+            get_syntax_types(["rem comment\ncreate table t (id int)"], "oracle"),
+            ["DDL"],
+        )
+        self.assertEqual(get_syntax_types(["select 1"], db_type="redis"), [None])
+
     def test_remove_comments(self):
         """
         测试去除SQL注释
@@ -1052,6 +1104,363 @@ class TestTasks(TestCase):
         with self.assertRaises(Schedule.DoesNotExist):
             Schedule.objects.get(name="some_name1")
 
+    @patch("sql.utils.tasks.add_dashboard_stats_schedule")
+    @patch("sql.utils.tasks.add_slow_query_rollup_schedule")
+    def test_add_rollup_schedules_on_migrate(
+        self, _add_slow_query_rollup, _add_dashboard_stats
+    ):
+        """迁移后只添加缺失的汇总定时任务"""
+        add_rollup_schedules_on_migrate(sender=MagicMock(label="common"))
+        _add_slow_query_rollup.assert_not_called()
+        Schedule.objects.create(name=DASHBOARD_STATS_SCHEDULE)
+        add_rollup_schedules_on_migrate(sender=MagicMock(label="sql"))
+        _add_slow_query_rollup.assert_called_once()
+        _add_dashboard_stats.assert_not_called()
+        Schedule.objects.create(name=SLOW_QUERY_ROLLUP_SCHEDULE)
+        add_rollup_schedules_on_migrate(sender=MagicMock(label="sql"))
+        _add_slow_query_rollup.assert_called_once()
+
+
+class TestConnectionPool(TestCase):
+    def tearDown(self):
+        clear_pools()
+
+    def test_acquire_release_reuse(self):
+        creator = MagicMock()
+        pool = ConnectionPool(creator, max_size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertEqual(pool.acquire(), conn)
+        creator.assert_called_once()
+        self.assertEqual(pool.stats()["hits"], 1)
+        self.assertEqual(pool.stats()["misses"], 1)
+
+    def test_release_broken(self):
+        pool = ConnectionPool(MagicMock())
+        conn = pool.acquire()
+        pool.release(conn, broken=True)
+        conn.close.assert_called_once()
+        self.assertEqual(pool.stats()["idle"], 0)
+        self.assertEqual(pool.stats()["discards"], 1)
+
+    def test_release_rollback_uncommitted(self):
+        pool = ConnectionPool(MagicMock())
+        conn = pool.acquire()
+        conn.get_autocommit.return_value = False
+        pool.release(conn)
+        conn.rollback.assert_called_once()
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_release_over_max_size(self):
+        pool = ConnectionPool(
+            MagicMock(side_effect=[MagicMock(), MagicMock()]), max_size=1
+        )
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+        pool.release(conn1)
+        pool.release(conn2)
+        conn2.close.assert_called_once()
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_acquire_evict_idle(self):
+        creator = MagicMock(side_effect=[MagicMock(), MagicMock()])
+        pool = ConnectionPool(creator, max_idle_time=0)
+        conn1 = pool.acquire()
+        pool.release(conn1)
+        conn2 = pool.acquire()
+        self.assertNotEqual(conn1, conn2)
+        conn1.close.assert_called_once()
+        self.assertEqual(pool.stats()["evictions"], 1)
+
+    def test_acquire_health_check(self):
+        creator = MagicMock(side_effect=[MagicMock(), MagicMock()])
+        pool = ConnectionPool(creator, check_interval=-1)
+        conn1 = pool.acquire()
+        conn1.ping.side_effect = RuntimeError("gone away")
+        pool.release(conn1)
+        conn2 = pool.acquire()
+        self.assertNotEqual(conn1, conn2)
+        self.assertEqual(pool.stats()["discards"], 1)
+
+    def test_changes_session_state(self):
+        for sql in (
+            "use some_db",
+            "set profiling=1",
+            "/* comment */ SET @a=1",
+            "select 1; use some_db",
+            "create temporary table t (id int)",
+            "select @a:=1",
+            "select id into @id from t",
+        ):
+            self.assertTrue(changes_session_state(sql), sql)
+        for sql in ("select * from user_settings", "show variables", "", None):
+            self.assertFalse(changes_session_state(sql), sql)
+
+    def test_get_pool_and_stats(self):
+        pool = get_pool(("some_key",), MagicMock(), label="some_label")
+        self.assertIs(get_pool(("some_key",), MagicMock()), pool)
+        self.assertEqual(pool_stats()[0]["label"], "some_label")
+
+
+@patch("sql.utils.ssh_tunnel.SSHTunnelForwarder")
+class TestSSHTunnelManager(TestCase):
+    tunnel_args = ("db_host", 3306, "tun_host", 22, "tun_user", "tun_pwd", None, None)
+
+    def tearDown(self):
+        ssh_tunnel_manager.clear()
+
+    def test_acquire_reuse(self, _forwarder):
+        manager = SSHTunnelManager()
+        t1 = manager.acquire(*self.tunnel_args)
+        t2 = manager.acquire(*self.tunnel_args)
+        self.assertIs(t1, t2)
+        _forwarder.assert_called_once()
+        _forwarder.return_value.start.assert_called_once()
+        self.assertEqual(t1.refs, 2)
+        stats = manager.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["tunnels"][0]["refs"], 2)
+        manager.clear()
+
+    def test_restart_inactive(self, _forwarder):
+        """断开的隧道重新建立，仍持有旧隧道的引擎释放后关闭"""
+        old_server, new_server = MagicMock(), MagicMock()
+        _forwarder.side_effect = [old_server, new_server]
+        manager = SSHTunnelManager()
+        t1 = manager.acquire(*self.tunnel_args)
+        old_server.is_active = False
+        t2 = manager.acquire(*self.tunnel_args)
+        self.assertIsNot(t1, t2)
+        old_server.close.assert_not_called()
+        manager.release(t1)
+        old_server.close.assert_called_once()
+        self.assertEqual(manager.stats()["restarts"], 1)
+        manager.clear()
+
+    @override_settings(SSH_TUNNEL={"KEEPALIVE": 30, "IDLE_TIMEOUT": 0})
+    def test_reap_idle(self, _forwarder):
+        manager = SSHTunnelManager()
+        tunnel = manager.acquire(*self.tunnel_args)
+        manager.reap()
+        _forwarder.return_value.close.assert_not_called()
+        manager.release(tunnel)
+        time.sleep(0.01)
+        manager.reap()
+        _forwarder.return_value.close.assert_called_once()
+        self.assertEqual(manager.stats()["tunnels"], [])
+
+    def test_ssh_connection_release(self, _forwarder):
+        _forwarder.return_value.local_bind_port = 10022
+        conn1 = SSHConnection(*self.tunnel_args)
+        conn2 = SSHConnection(*self.tunnel_args)
+        self.assertEqual(conn1.get_ssh(), ("127.0.0.1", 10022))
+        self.assertEqual(conn2.get_ssh(), ("127.0.0.1", 10022))
+        _forwarder.assert_called_once()
+        tunnel = conn1.tunnel
+        conn1.close()
+        conn1.close()
+        self.assertEqual(tunnel.refs, 1)
+        del conn2
+        self.assertEqual(tunnel.refs, 0)
+
+
+class TestQueryWatchdog(TestCase):
+    def test_watch_kill(self):
+        watchdog = QueryWatchdog()
+        killed = threading.Event()
+        callback = MagicMock(side_effect=lambda *args: killed.set())
+        watchdog.watch(0.05, callback, 1, 100)
+        self.assertTrue(killed.wait(5))
+        callback.assert_called_once_with(1, 100)
+        for _ in range(50):
+            if watchdog.stats()["killed"] == 1:
+                break
+            time.sleep(0.02)
+        self.assertEqual(watchdog.stats()["killed"], 1)
+        self.assertEqual(watchdog.stats()["pending"], 0)
+
+    def test_watch_cancel(self):
+        watchdog = QueryWatchdog()
+        callback = MagicMock()
+        watch = watchdog.watch(0.05, callback, 1, 100)
+        self.assertTrue(watchdog.cancel(watch))
+        time.sleep(0.2)
+        callback.assert_not_called()
+        # 已取消或已触发的任务再次取消返回False
+        self.assertFalse(watchdog.cancel(watch))
+        self.assertEqual(watchdog.stats()["finished"], 1)
+        self.assertEqual(watchdog.stats()["pending"], 0)
+
+
+class TestQueryTreeCache(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(
+            instance_name="some_ins",
+            type="slave",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+
+    def tearDown(self):
+        query_tree_cache.clear()
+        DataMaskingColumns.objects.all().delete()
+        self.ins.delete()
+
+    def test_sql_fingerprint(self):
+        self.assertEqual(
+            sql_fingerprint("select * from users where id=1 and name='a';"),
+            sql_fingerprint(
+                "/* comment */ select * from users\n where id=20 and name='b'"
+            ),
+        )
+        self.assertEqual(
+            sql_fingerprint("select * from users where id in (1,2,3)"),
+            sql_fingerprint("select * from users where id in (4, 5)"),
+        )
+        self.assertNotEqual(
+            sql_fingerprint("select * from users1"),
+            sql_fingerprint("select * from users2"),
+        )
+
+    def test_get_or_set(self):
+        func = MagicMock(return_value=[{"index": 0, "field": "phone"}])
+        r1 = query_tree_cache.get_or_set(
+            self.ins, "db", "masking", "select phone from users where id=1", func
+        )
+        r2 = query_tree_cache.get_or_set(
+            self.ins, "db", "masking", "select phone from users where id=2", func
+        )
+        func.assert_called_once()
+        self.assertEqual(r1, r2)
+        self.assertEqual(query_tree_cache.stats()["hits"], 1)
+
+    def test_get_or_set_exception_not_cached(self):
+        func = MagicMock(side_effect=[RuntimeError("语法错误"), []])
+        with self.assertRaises(RuntimeError):
+            query_tree_cache.get_or_set(self.ins, "db", "masking", "select 1", func)
+        query_tree_cache.get_or_set(self.ins, "db", "masking", "select 1", func)
+        self.assertEqual(func.call_count, 2)
+
+    def test_invalidate_by_masking_columns(self):
+        func = MagicMock(return_value=[])
+        query_tree_cache.get_or_set(self.ins, "db", "masking", "select 1", func)
+        DataMaskingColumns.objects.create(
+            rule_type=1,
+            active=True,
+            instance=self.ins,
+            table_schema="archer_test",
+            table_name="users",
+            column_name="phone",
+        )
+        query_tree_cache.get_or_set(self.ins, "db", "masking", "select 1", func)
+        self.assertEqual(func.call_count, 2)
+
+    def test_prefetch(self):
+        func = MagicMock(return_value=[{"index": 0, "field": "phone"}])
+        self.assertTrue(
+            query_tree_cache.prefetch(
+                self.ins, "db", "masking", "select phone from users where id=1", func
+            )
+        )
+        func2 = MagicMock(return_value=[])
+        r = query_tree_cache.get_or_set(
+            self.ins, "db", "masking", "select phone from users where id=2", func2
+        )
+        self.assertEqual(r, [{"index": 0, "field": "phone"}])
+        func.assert_called_once()
+        func2.assert_not_called()
+
+    def test_prefetch_exception(self):
+        """预解析失败时由请求线程重新解析"""
+        func = MagicMock(side_effect=RuntimeError("语法错误"))
+        query_tree_cache.prefetch(self.ins, "db", "masking", "select 1", func)
+        func2 = MagicMock(return_value=[])
+        r = query_tree_cache.get_or_set(self.ins, "db", "masking", "select 1", func2)
+        self.assertEqual(r, [])
+
+    @override_settings(QUERY_PREFETCH_WORKERS=0)
+    def test_prefetch_disabled(self):
+        tree_cache = QueryTreeCache()
+        func = MagicMock(return_value=[])
+        self.assertFalse(
+            tree_cache.prefetch(self.ins, "db", "masking", "select 1", func)
+        )
+        func.assert_not_called()
+
+
+class TestMetadataCatalog(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(
+            instance_name="some_ins",
+            type="slave",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+        self.engine = MagicMock()
+        self.engine.instance = self.ins
+        self.engine.get_all_tables.return_value = ResultSet(rows=["tb_1", "tb_2"])
+        self.engine.get_all_databases.return_value = ResultSet(rows=["db_1"])
+        # 不同用例的实例ID可能相同，先使实例的缓存失效
+        metadata_catalog.invalidate(self.ins.id)
+
+    def tearDown(self):
+        self.ins.delete()
+
+    def test_get_cached(self):
+        r1 = metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        r2 = metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        self.engine.get_all_tables.assert_called_once_with(db_name="db_1")
+        self.assertEqual(r1.rows, r2.rows)
+
+    def test_error_not_cached(self):
+        self.engine.get_all_tables.return_value = ResultSet()
+        self.engine.get_all_tables.return_value.error = "连接失败"
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        self.assertEqual(self.engine.get_all_tables.call_count, 2)
+
+    def test_invalidate_db(self):
+        """库级失效只影响该库的元数据"""
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_2")
+        metadata_catalog.get(self.engine, "get_all_databases")
+        metadata_catalog.invalidate(self.ins.id, "db_1")
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_2")
+        metadata_catalog.get(self.engine, "get_all_databases")
+        self.assertEqual(self.engine.get_all_tables.call_count, 3)
+        self.engine.get_all_databases.assert_called_once()
+        metadata_catalog.invalidate(self.ins.id)
+        metadata_catalog.get(self.engine, "get_all_databases")
+        self.assertEqual(self.engine.get_all_databases.call_count, 2)
+
+    @override_settings(METADATA_CATALOG_REFRESH=0)
+    @patch("sql.utils.metadata_catalog.get_engine")
+    def test_background_refresh(self, _get_engine):
+        """超过刷新间隔时返回已缓存的数据，后台刷新后读取到新数据"""
+        metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        _get_engine.return_value.get_all_tables.return_value = ResultSet(
+            rows=["tb_1", "tb_2", "tb_3"]
+        )
+        time.sleep(0.01)
+        r = metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        self.assertEqual(r.rows, ["tb_1", "tb_2"])
+        for _ in range(100):
+            if not metadata_catalog._refreshing:
+                break
+            time.sleep(0.05)
+        _get_engine.return_value.close.assert_called_once()
+        with override_settings(METADATA_CATALOG_REFRESH=3600):
+            r = metadata_catalog.get(self.engine, "get_all_tables", db_name="db_1")
+        self.assertEqual(r.rows, ["tb_1", "tb_2", "tb_3"])
+        self.engine.get_all_tables.assert_called_once()
+
 
 class TestDataMasking(TestCase):
     def setUp(self):
@@ -1511,6 +1920,77 @@ class TestDataMasking(TestCase):
             print("test_data_masking_union_support_keyword", r.rows)
             self.assertEqual(r.rows, mask_result_rows)
 
+    @patch("sql.utils.data_masking.GoInceptionEngine")
+    def test_data_masking_star_not_cached(self, _inception):
+        """使用*的语句每次重新解析select list"""
+        _inception.return_value.query_data_masking.return_value = [
+            {
+                "index": 0,
+                "field": "phone",
+                "type": "varchar(80)",
+                "table": "users",
+                "schema": "archer_test",
+                "alias": "phone",
+            }
+        ]
+        sql = """select * from users;"""
+        rows = (("18888888888",),)
+        for _ in range(2):
+            query_result = ReviewSet(column_list=["phone"], rows=rows, full_sql=sql)
+            r = data_masking(self.ins, "archery", sql, query_result)
+            self.assertEqual(r.rows, [["188****8888"]])
+        self.assertEqual(_inception.return_value.query_data_masking.call_count, 2)
+        self.assertFalse(prefetch_masking(self.ins, "archery", sql))
+
+    @patch("sql.utils.data_masking.GoInceptionEngine")
+    def test_data_masking_cached_columns_changed(self, _inception):
+        """缓存的select list与结果集的列不一致时重新解析"""
+        phone = {
+            "index": 0,
+            "field": "phone",
+            "type": "varchar(80)",
+            "table": "users",
+            "schema": "archer_test",
+            "alias": "phone",
+        }
+        name = dict(phone, field="name", alias="name")
+        _inception.return_value.query_data_masking.side_effect = [
+            [phone, dict(name, index=1)],
+            [dict(name, index=0), dict(phone, index=1)],
+        ]
+        sql = """select phone, name from users where id = 1;"""
+        query_result = ReviewSet(
+            column_list=["phone", "name"], rows=(("18888888888", "a"),), full_sql=sql
+        )
+        r = data_masking(self.ins, "archery", sql, query_result)
+        self.assertEqual(r.rows, [["188****8888", "a"]])
+        query_result = ReviewSet(
+            column_list=["name", "phone"], rows=(("a", "18888888888"),), full_sql=sql
+        )
+        r = data_masking(self.ins, "archery", sql, query_result)
+        self.assertEqual(r.rows, [["a", "188****8888"]])
+        self.assertEqual(_inception.return_value.query_data_masking.call_count, 2)
+        query_tree_cache.clear()
+
+    def test_mask_rows(self):
+        masking_rules = {
+            1: {"rule_regex": "(.{3})(.*)(.{4})", "hide_group": 2},
+            2: {"rule_regex": "(.*)(@.*)", "hide_group": 1},
+        }
+        hit_columns = [
+            {"index": 0, "rule_type": 1},
+            {"index": 2, "rule_type": 2},
+            {"index": 1, "rule_type": 3},
+        ]
+        rows = (
+            ("18888888888", 1, "a@b.com"),
+            ("1888", 2, None),
+        )
+        r = mask_rows(rows, hit_columns, masking_rules)
+        self.assertEqual(r, [["188****8888", 1, "****@b.com"], ["1888", 2, None]])
+        # 没有可用的脱敏规则时原样返回
+        self.assertEqual(mask_rows(rows, [{"index": 0, "rule_type": 3}], {}), rows)
+
     def test_brute_mask(self):
         sql = """select * from users;"""
         rows = (("18888888888",), ("18888888889",), ("18888888810",))
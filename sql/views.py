@@ -7,12 +7,12 @@ from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.models import Group
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, FileResponse, Http404
+from django.http import HttpResponseRedirect, Http404, StreamingHttpResponse
 from django.urls import reverse
 
 from archery import settings
 from common.config import SysConfig
-from sql.engines import get_engine, engine_map
+from sql.engines import engine_map
 from common.utils.permission import superuser_required
 from common.utils.convert import Convert
 from sql.utils.tasks import task_info
@@ -39,6 +39,7 @@ from sql.utils.sql_review import (
     can_cancel,
     can_view,
     can_rollback,
+    get_rollback_sql,
 )
 from common.utils.const import Const, WorkflowType
 from sql.utils.resource_group import user_groups, user_instances, auth_group_users
@@ -280,28 +281,26 @@ def rollback(request):
     # 直接下载回滚语句
     if download:
         try:
-            query_engine = get_engine(instance=workflow.instance)
-            list_backup_sql = query_engine.get_rollback(workflow=workflow)
+            list_backup_sql = get_rollback_sql(workflow)
         except Exception as msg:
             logger.error(traceback.format_exc())
             context = {"errMsg": msg}
             return render(request, "error.html", context)
 
-        # 获取数据，存入目录
-        path = os.path.join(settings.BASE_DIR, "downloads/rollback")
-        os.makedirs(path, exist_ok=True)
-        file_name = f"{path}/rollback_{workflow_id}.sql"
-        with open(file_name, "w") as f:
-            for sql in list_backup_sql:
-                f.write(f"/*{sql[0]}*/\n{sql[1]}\n")
-        # 返回
-        response = FileResponse(open(file_name, "rb"))
+        # 每次输出一批语句，不在服务端落盘
+        def rollback_file():
+            for i in range(0, len(list_backup_sql), 500):
+                yield "".join(
+                    f"/*{sql[0]}*/\n{sql[1]}\n" for sql in list_backup_sql[i : i + 500]
+                )
+
+        response = StreamingHttpResponse(rollback_file())
         response["Content-Type"] = "application/octet-stream"
         response[
             "Content-Disposition"
         ] = f'attachment;filename="rollback_{workflow_id}.sql"'
         return response
-    # 异步获取，并在页面展示，如果数据量大加载会缓慢
+    # 页面分页获取并展示
     else:
         rollback_workflow_name = f"【回滚工单】原工单Id:{workflow_id} ,{workflow.workflow_name}"
         context = {
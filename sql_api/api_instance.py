@@ -13,6 +13,7 @@ from .pagination import CustomizedPagination
 from .filters import InstanceFilter
 from sql.models import Instance, Tunnel, AliyunRdsConfig
 from sql.engines import get_engine
+from sql.utils.metadata_catalog import metadata_catalog
 from django.http import Http404
 import MySQLdb
 
@@ -192,16 +193,25 @@ class InstanceResource(views.APIView):
             schema_name = query_engine.escape_string(schema_name)
             tb_name = query_engine.escape_string(tb_name)
             if resource_type == "database":
-                resource = query_engine.get_all_databases()
+                resource = metadata_catalog.get(query_engine, "get_all_databases")
             elif resource_type == "schema" and db_name:
-                resource = query_engine.get_all_schemas(db_name=db_name)
+                resource = metadata_catalog.get(
+                    query_engine, "get_all_schemas", db_name=db_name
+                )
             elif resource_type == "table" and db_name:
-                resource = query_engine.get_all_tables(
-                    db_name=db_name, schema_name=schema_name
+                resource = metadata_catalog.get(
+                    query_engine,
+                    "get_all_tables",
+                    db_name=db_name,
+                    schema_name=schema_name,
                 )
             elif resource_type == "column" and db_name and tb_name:
-                resource = query_engine.get_all_columns_by_tb(
-                    db_name=db_name, tb_name=tb_name, schema_name=schema_name
+                resource = metadata_catalog.get(
+                    query_engine,
+                    "get_all_columns_by_tb",
+                    db_name=db_name,
+                    tb_name=tb_name,
+                    schema_name=schema_name,
                 )
             else:
                 raise serializers.ValidationError({"errors": "不支持的资源类型或者参数不完整！"})
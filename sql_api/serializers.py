@@ -18,10 +18,12 @@ from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from sql.engines import get_engine
+from sql.engines.models import ReviewSet
 from sql.utils.workflow_audit import Audit, get_auditor
 from sql.utils.resource_group import user_instances
 from common.utils.const import WorkflowType
 from common.config import SysConfig
+import json
 import traceback
 import logging
 
@@ -430,6 +432,17 @@ class WorkflowContentSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"errors": str(e)})
         return workflow_content
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # 审核和执行结果按列式格式保存，接口仍返回[{}]格式
+        for key in ("review_content", "execute_result"):
+            if data.get(key, "").startswith("{"):
+                try:
+                    data[key] = json.dumps(ReviewSet.load_rows(data[key]))
+                except (ValueError, KeyError, TypeError):
+                    pass
+        return data
+
     class Meta:
         model = SqlWorkflowContent
         fields = (